@@ -0,0 +1,39 @@
+'''
+Suites ran by `selftest/results.py`, which are interrupted and resumed, or
+ran more than once with different outcomes and merged.
+
+Environment variables control how they run:
+
+`SELFTEST_BLOCK`
+    The last suite creates the file named by it then blocks until it's
+    killed.
+`SELFTEST_FAIL`
+    If set, the test of the `varies` suite fails.
+'''
+import os
+import time
+
+import whimsy.suite as suite
+import whimsy.test as test
+
+
+def passing(fixtures):
+    pass
+
+def varies(fixtures):
+    if os.environ.get('SELFTEST_FAIL'):
+        test.fail('Failing since SELFTEST_FAIL is set.')
+
+def blocking(fixtures):
+    path = os.environ.get('SELFTEST_BLOCK')
+    if path is None:
+        return
+    open(path, 'w').close()
+    while True:
+        time.sleep(1)
+
+
+suite.TestSuite('first', tests=[test.TestFunction(passing, name='first')])
+suite.TestSuite('varies', tests=[test.TestFunction(varies, name='varies')])
+suite.TestSuite('blocking', tests=[test.TestFunction(blocking,
+                                                     name='blocking')])
@@ -0,0 +1,271 @@
+#!/usr/bin/env python2
+'''
+Focused checks of how whimsy stores results, which `selftest/run.py` only
+exercises when everything goes well: reading a damaged result file,
+resuming a run which was killed, and merging runs of the same suites.
+
+Results are written by whimsy processes ran on the suites in
+`selftest/suites` and `selftest/interrupted`, and read back with
+:mod:`whimsy.resultfile`.
+
+Usage: `python2 selftest/results.py [unittest arguments]`
+'''
+import cPickle as pickle
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import run
+
+interrupted_dir = os.path.join(run.selftest_dir, 'interrupted')
+
+# Seconds to wait for a blocked test to start.
+start_timeout = 60
+
+# Importing whimsy parses the command line, give it one it accepts.
+sys.path.insert(0, run.base_dir)
+_argv = sys.argv
+sys.argv = [_argv[0], 'list', run.suites_dir]
+import whimsy.resultfile as resultfile
+from whimsy.config import constants
+sys.argv = _argv
+
+
+def start(cwd, args, env=None):
+    '''
+    Start whimsy with the arguments, adding env to its environment.
+
+    :returns: The :class:`subprocess.Popen` object of the process.
+    '''
+    environment = run.environment()
+    environment.update(env or {})
+    return subprocess.Popen(run.whimsy_command(*args), cwd=cwd,
+                            env=environment, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+
+def whimsy(cwd, *args, **env):
+    '''
+    Run whimsy with the arguments, adding the keyword arguments to its
+    environment.
+
+    :returns: The output of whimsy.
+    '''
+    process = start(cwd, args, env)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise AssertionError('whimsy %s exited with %d:\n%s'
+                             % (' '.join(args), process.returncode, output))
+    return output
+
+
+def read_results(path):
+    '''Return the results read from the result file at path.'''
+    with open(path, 'rb') as fstream:
+        reader = resultfile.ResultReader(fstream)
+        return (list(reader), [suite.uid for suite in reader.suites()])
+
+
+class ResultFileTest(unittest.TestCase):
+    '''Reading result files which are incomplete or damaged.'''
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp(prefix='whimsy-selftest-')
+        result_path = os.path.join(cls.tempdir, 'results')
+        whimsy(cls.tempdir, 'run', run.suites_dir,
+               '--result-path', result_path)
+        with open(os.path.join(result_path, constants.pickle_filename),
+                  'rb') as fstream:
+            cls.data = fstream.read()
+        (cls.results, cls.suite_uids) = read_results(
+                os.path.join(result_path, constants.pickle_filename))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def write(self, data):
+        path = os.path.join(self.tempdir, 'damaged')
+        with open(path, 'wb') as fstream:
+            fstream.write(data)
+        return path
+
+    def index_offset(self):
+        '''Return the offset of the index frame.'''
+        trailer = self.data[-resultfile._trailer.size:]
+        return resultfile._trailer.unpack(trailer)[0]
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.suite_uids), 7)
+        self.assertEqual([result.uid for result in self.results][-1],
+                         self.suite_uids[-1])
+        with open(self.write(self.data), 'rb') as fstream:
+            reader = resultfile.ResultReader(fstream)
+            for result in self.results:
+                self.assertEqual(reader.lookup(result.uid).uid, result.uid)
+            self.assertIsNone(reader.lookup('no-such-uid'))
+
+    def test_without_index(self):
+        # As left by a run which was killed before it finished.
+        path = self.write(self.data[:self.index_offset()])
+        (results, suite_uids) = read_results(path)
+        self.assertEqual([result.uid for result in results],
+                         [result.uid for result in self.results])
+        self.assertEqual(suite_uids, self.suite_uids)
+
+    def test_truncated_frame(self):
+        # The last suite was being written when the run was killed.
+        end = self.index_offset()
+        for cut in (1, resultfile._frame.size, resultfile._frame.size + 1):
+            (results, suite_uids) = read_results(
+                    self.write(self.data[:end - cut]))
+            self.assertEqual(len(results), len(self.results) - 1)
+            self.assertEqual(suite_uids, self.suite_uids[:-1])
+
+    def test_corrupt_frame(self):
+        end = self.index_offset()
+        data = self.data[:end - 1] + chr(ord(self.data[end - 1]) ^ 0xff)
+        (results, suite_uids) = read_results(self.write(data))
+        self.assertEqual(len(results), len(self.results) - 1)
+        self.assertEqual(suite_uids, self.suite_uids[:-1])
+
+    def test_corrupt_index(self):
+        # Falls back to scanning the frames.
+        offset = self.index_offset() + resultfile._frame.size
+        data = self.data[:offset] + chr(ord(self.data[offset]) ^ 0xff) \
+                + self.data[offset + 1:]
+        (results, suite_uids) = read_results(self.write(data))
+        self.assertEqual(len(results), len(self.results))
+        self.assertEqual(suite_uids, self.suite_uids)
+
+    def test_legacy(self):
+        # Written before results were framed, a stream of pickles.
+        data = ''.join(pickle.dumps(result, constants.pickle_protocol)
+                       for result in self.results)
+        (results, suite_uids) = read_results(self.write(data))
+        self.assertEqual([result.uid for result in results],
+                         [result.uid for result in self.results])
+        self.assertEqual(suite_uids, self.suite_uids)
+
+        # Including one left partially written.
+        (results, suite_uids) = read_results(self.write(data[:-1]))
+        self.assertEqual(suite_uids, self.suite_uids[:-1])
+
+
+
+class ResumeTest(unittest.TestCase):
+    '''Resuming a run, with `run --resume`, after it was killed.'''
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='whimsy-selftest-')
+        self.result_path = os.path.join(self.tempdir, 'results')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def args(self, *args):
+        return ('run', interrupted_dir, '--result-path', self.result_path,
+                '--events', self.result_path + '.events') + args
+
+    def run_killed(self, *args):
+        '''
+        Run whimsy, killing it once the blocking suite starts.
+
+        :returns: The output of whimsy.
+        '''
+        marker = os.path.join(self.tempdir, 'blocked')
+        if os.path.exists(marker):
+            os.remove(marker)
+        process = start(self.tempdir, self.args(*args),
+                        {'SELFTEST_BLOCK': marker})
+        deadline = time.time() + start_timeout
+        while not os.path.exists(marker):
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                self.fail('The blocking suite did not start:\n%s'
+                          % process.communicate()[0])
+            time.sleep(0.1)
+        process.kill()
+        return process.communicate()[0]
+
+    def suite_names(self):
+        (_, suite_uids) = read_results(
+                os.path.join(self.result_path, constants.pickle_filename))
+        return [uid.rpartition(':')[2] for uid in suite_uids]
+
+    def test_resume_after_kill(self):
+        self.run_killed()
+        self.assertEqual(self.suite_names(), ['first', 'varies'])
+
+        # Killing the resumed run keeps the suites it resumed.
+        output = self.run_killed('--resume')
+        self.assertIn('2 suites already finished and 1 remain', output)
+        self.assertEqual(self.suite_names(), ['first', 'varies'])
+
+        whimsy(self.tempdir, *self.args('--resume'))
+        self.assertEqual(self.suite_names(), ['first', 'varies', 'blocking'])
+        # Only the remaining suite was ran.
+        self.assertEqual(run.outcomes(self.result_path).values(), ['PASS'])
+
+    def test_resume_finished(self):
+        whimsy(self.tempdir, *self.args())
+        output = whimsy(self.tempdir, *self.args('--resume'))
+        self.assertIn('3 suites already finished and 0 remain', output)
+        self.assertEqual(self.suite_names(), ['first', 'varies', 'blocking'])
+
+
+
+class MergeTest(unittest.TestCase):
+    '''Merging runs of the same suites with the `merge` command.'''
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp(prefix='whimsy-selftest-')
+        cls.failed = os.path.join(cls.tempdir, 'failed')
+        cls.passed = os.path.join(cls.tempdir, 'passed')
+        whimsy(cls.tempdir, 'run', interrupted_dir,
+               '--result-path', cls.failed, SELFTEST_FAIL='1')
+        whimsy(cls.tempdir, 'run', interrupted_dir,
+               '--result-path', cls.passed)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def merge(self, *sources):
+        '''
+        Merge the sources.
+
+        :returns: A dictionary mapping uid->outcome name of every result.
+        '''
+        merged = os.path.join(self.tempdir, 'merged')
+        whimsy(self.tempdir, 'merge', *(sources + ('--result-path', merged)))
+        (results, suite_uids) = read_results(
+                os.path.join(merged, constants.pickle_filename))
+        uids = [result.uid for result in results]
+        self.assertEqual(len(uids), len(set(uids)),
+                         'Results were repeated: %s' % uids)
+        self.assertEqual(len(suite_uids), 3)
+        return dict((result.uid, result.outcome.name) for result in results)
+
+    def varies_outcome(self, outcomes):
+        return [outcome for (uid, outcome) in outcomes.items()
+                if uid.endswith('TestCase:varies')]
+
+    def test_last_source_kept(self):
+        self.assertEqual(
+                self.varies_outcome(self.merge(self.failed, self.passed)),
+                ['PASS'])
+        self.assertEqual(
+                self.varies_outcome(self.merge(self.passed, self.failed)),
+                ['FAIL'])
+
+    def test_same_source(self):
+        outcomes = self.merge(self.passed, self.passed)
+        self.assertEqual(set(outcomes.values()), set(['PASS']))
+
+
+if __name__ == '__main__':
+    unittest.main()
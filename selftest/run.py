@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+'''
+Runs the suites in `selftest/suites` in each way whimsy can run tests and
+checks that every mode reports the same outcomes.
+
+Each mode is ran by a separate whimsy process with its own result path,
+writing its --events to a file. The outcome of every test read back from the
+events must match the outcome its name starts with, and every mode must have
+ran the same tests as the serial run. The output captured for the tests in
+:data:`outputs` is read back with `show-output`.
+
+Importing whimsy parses the command line, so this only runs whimsy in
+subprocesses.
+
+Usage: `python2 selftest/run.py [mode ...]`, all modes are ran if none are
+given. Results stored by the runs are checked in more detail by
+`selftest/results.py`.
+'''
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+selftest_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(selftest_dir)
+suites_dir = os.path.join(selftest_dir, 'suites')
+
+# Dictionary mapping mode name->arguments of the run command.
+modes = OrderedDict((
+    ('serial', []),
+    ('jobs', ['-j', '2', '--max-cpus', '2']),
+    ('test-threads', ['--test-threads', '2']),
+    ('coroutines', ['--coroutines', '2']),
+    ('coordinator', None),
+))
+
+# Dictionary mapping test name->text its captured stdout must contain.
+outputs = {
+    'PASS-subprocess': 'Output of a subprocess',
+}
+
+# Number of workers the coordinator mode starts.
+coordinator_workers = 2
+
+# Seconds a mode may take before it is considered hung.
+timeout = 120
+
+# Seconds workers are given to exit once the coordinator has finished.
+worker_grace_period = 5
+
+
+def whimsy_command(*args):
+    return [sys.executable, '-m', 'whimsy.main'] + list(args)
+
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+            [base_dir] + env.get('PYTHONPATH', '').split(os.pathsep))
+    return env
+
+
+def wait(processes, deadline):
+    '''
+    Wait for the processes to exit, killing them once the deadline passes.
+
+    :returns: True if all processes exited on their own.
+    '''
+    while time.time() < deadline:
+        if all(process.poll() is not None for process in processes):
+            return True
+        time.sleep(0.1)
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return False
+
+
+def run_mode(mode, result_path, log):
+    '''
+    Run the suites in the given mode, writing results to result_path and
+    whimsy's output to log.
+
+    :returns: An error message, None if the mode ran to completion.
+    '''
+    env = environment()
+    # Ran outside of the repository so whimsy is imported by its absolute
+    # path, uids depend on it.
+    cwd = os.path.dirname(result_path)
+
+    def start(*args):
+        return subprocess.Popen(whimsy_command(*args), stdout=log,
+                                stderr=subprocess.STDOUT, env=env, cwd=cwd)
+
+    deadline = time.time() + timeout
+    common = [suites_dir, '--result-path', result_path,
+              '--events', result_path + '.events']
+    if modes[mode] is not None:
+        process = start('run', *(common + modes[mode]))
+        workers = []
+    else:
+        address = result_path + '.socket'
+        process = start('coordinator', '--address', address, *common)
+        workers = [start('worker', suites_dir, '--address', address)
+                   for _ in range(coordinator_workers)]
+    if not wait([process], deadline):
+        wait(workers, time.time())
+        return 'timed out after %d seconds' % timeout
+    # A worker which is still starting up when another worker has ran every
+    # suite finds the coordinator gone, so only the coordinator's exit
+    # status is checked.
+    wait(workers, time.time() + worker_grace_period)
+    if process.returncode != 0:
+        return 'exited with %d' % process.returncode
+    return None
+
+
+def outcomes(result_path):
+    '''Return a dictionary mapping uid->outcome name of each test.'''
+    results = {}
+    with open(result_path + '.events', 'r') as fstream:
+        for line in fstream:
+            event = json.loads(line)
+            if event.get('kind') != 'test':
+                continue
+            if event['event'] == 'outcome':
+                results[event['uid']] = event['outcome']
+            elif event['event'] == 'skip':
+                results[event['uid']] = 'SKIP'
+    return results
+
+
+def captured_output(uid, result_path):
+    '''Return the stdout captured for the test with the uid.'''
+    return subprocess.check_output(
+            whimsy_command('show-output', uid, '--result-path', result_path),
+            env=environment(), cwd=os.path.dirname(result_path))
+
+
+def check(mode, results, expected_uids, result_path):
+    '''Return a list of problems with the results of a mode.'''
+    problems = []
+    for (uid, outcome) in sorted(results.items()):
+        # uids end with the name of the test.
+        name = uid.rpartition(':')[2]
+        expected = name.split('-')[0]
+        if outcome != expected:
+            problems.append('%s was %s rather than %s'
+                            % (uid, outcome, expected))
+        if name in outputs \
+                and outputs[name] not in captured_output(uid, result_path):
+            problems.append('%s did not capture %r'
+                            % (uid, outputs[name]))
+    if expected_uids is not None:
+        for uid in sorted(expected_uids - set(results)):
+            problems.append('%s has no result' % uid)
+        for uid in sorted(set(results) - expected_uids):
+            problems.append('%s was not ran serially' % uid)
+    return problems
+
+
+def main(selected):
+    for mode in selected:
+        if mode not in modes:
+            sys.exit('Unknown mode %s, choose from %s'
+                     % (mode, ', '.join(modes)))
+
+    tempdir = tempfile.mkdtemp(prefix='whimsy-selftest-')
+    expected_uids = None
+    failed = []
+    try:
+        for mode in selected:
+            result_path = os.path.join(tempdir, mode)
+            log_path = result_path + '.log'
+            with open(log_path, 'w') as log:
+                error = run_mode(mode, result_path, log)
+            if error is None:
+                results = outcomes(result_path)
+                problems = check(mode, results, expected_uids,
+                                 result_path)
+                if mode == 'serial':
+                    expected_uids = set(results)
+            else:
+                problems = [error]
+
+            if problems:
+                failed.append(mode)
+                print('FAIL %s' % mode)
+                for problem in problems:
+                    print('    %s' % problem)
+                print('    Output of whimsy:')
+                with open(log_path, 'r') as log:
+                    for line in log:
+                        print('    | %s' % line.rstrip())
+            else:
+                print('PASS %s' % mode)
+    finally:
+        shutil.rmtree(tempdir)
+
+    if failed:
+        sys.exit('Modes with unexpected results: %s' % ', '.join(failed))
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(modes)
+    if 'serial' not in selected:
+        # Other modes are compared to the tests the serial run ran.
+        selected.insert(0, 'serial')
+    main(selected)
@@ -0,0 +1,70 @@
+'''
+Suites ran by `selftest/run.py` in each way whimsy can run tests.
+
+The name of every test starts with the outcome it should have, whichever way
+it is ran. `selftest/run.py` also checks the captured output of some
+tests.
+'''
+import time
+
+import whimsy.eventloop as eventloop
+import whimsy.fixture as fixture
+import whimsy.helper as helper
+import whimsy.suite as suite
+import whimsy.test as test
+
+
+def passing(fixtures):
+    time.sleep(0.05)
+
+def failing(fixtures):
+    test.assertTrue(False, 'This test was bound to fail')
+
+def skipping(fixtures):
+    test.skip('Skip this test.')
+
+def coroutine(fixtures):
+    yield eventloop.log_call_async(['sleep', '0.1'])
+
+def subprocess_output(fixtures):
+    helper.log_call(['echo', 'Output of a subprocess'])
+
+def uses_fixture(fixtures):
+    assert fixtures['counter'].built
+
+
+class CounterFixture(fixture.Fixture):
+    '''Fixture which is built once by whichever suite needs it first.'''
+    def __init__(self):
+        super(CounterFixture, self).__init__('counter', build_once=True)
+
+
+counter = CounterFixture()
+
+suite.TestSuite('passing', tests=[
+        test.TestFunction(passing, name='PASS-first'),
+        test.TestFunction(passing, name='PASS-second')])
+
+suite.TestSuite('fail-fast', tests=[
+        test.TestFunction(failing, name='FAIL-first'),
+        test.TestFunction(passing, name='SKIP-after-failure')])
+
+suite.TestSuite('keep-going', fail_fast=False, tests=[
+        test.TestFunction(failing, name='FAIL-keep-going'),
+        test.TestFunction(skipping, name='SKIP-skipped'),
+        test.TestFunction(passing, name='PASS-after-failure')])
+
+suite.TestSuite('concurrent', tests=[
+        suite.TestList([test.TestFunction(passing, name='PASS-thread-%d' % i)
+                        for i in range(4)], concurrent=True)])
+
+suite.TestSuite('coroutines', tests=[
+        test.TestFunction(coroutine, name='PASS-coroutine-%d' % i,
+                          coroutine=True)
+        for i in range(2)])
+
+suite.TestSuite('fixtures', fixtures={'counter': counter}, tests=[
+        test.TestFunction(uses_fixture, name='PASS-fixture')])
+
+suite.TestSuite('subprocess', tests=[
+        test.TestFunction(subprocess_output, name='PASS-subprocess')])
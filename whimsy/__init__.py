@@ -1,6 +1,6 @@
 from test import *
 from fixture import *
-from suite import TestSuite
+from suite import TestSuite, Resources
 from result import Outcome
 from helper import *
 from config import *
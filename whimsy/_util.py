@@ -42,6 +42,21 @@ class _EnumVal(object):
         return self.val.__cmp__(other.val)
 
 
+_size_suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(size):
+    '''
+    Return the number of bytes given by size. Size may be a number or
+    a string with an optional K, M, G or T suffix, e.g. '8G'.
+    '''
+    if isinstance(size, str):
+        size = size.strip().upper().rstrip('B')
+        if size and size[-1] in _size_suffixes:
+            return int(float(size[:-1]) * _size_suffixes[size[-1]])
+        return int(size)
+    return size
+
+
 class Timer(object):
     def __init__(self, start=False):
         self.reset()
@@ -0,0 +1,364 @@
+'''
+Stores the output captured for each test in a compressed archive rather than
+a directory of files per test.
+
+With the --output-archive flag, each process appends the captured
+`system-out` and `system-err` of its tests to a single append-only file in
+the result path, `output-<pid>.archive`. Each stream is stored as a separate
+zlib compressed record and its offset is appended to an index file next to
+the archive, so a run creates a couple of files per process rather than
+a directory per test.
+
+Records are keyed by the path the output would have been written to relative
+to the result path, so the rest of the framework can keep referring to
+outputs by the paths returned by
+:func:`whimsy.result.test_results_output_path`. :func:`open_output`,
+:func:`iter_output` and :func:`read_output` read an output back by seeking
+into whichever archive holds it, falling back to the plain file if the
+output wasn't archived.
+
+If a test's output is stored more than once (e.g. by the `rerun` command),
+the latest record is used. Archives are removed at the start of each `run`.
+'''
+import collections
+import contextlib
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from config import config
+from helper import mkdir_p
+
+# Suffixes of the archive and index files.
+archive_suffix = '.archive'
+index_suffix = '.index'
+
+# Output is mostly repetitive text, the fastest level compresses it well.
+_compress_level = 1
+
+# Bytes to read, compress and decompress at once.
+_chunk_size = 64 * 1024
+
+# Compressed bytes kept in memory by an ArchiveWriter before spilling to
+# a temporary file.
+_spool_size = 1024 * 1024
+
+
+def enabled():
+    '''Return True if captured output should be archived.'''
+    return config.output_archive
+
+
+def output_key(path):
+    '''Return the key of the output which would be written to path.'''
+    return os.path.relpath(path, config.result_path)
+
+
+class ArchiveWriter(object):
+    '''
+    File-like object which compresses what is written to it, appending it to
+    an :class:`OutputArchive` as a single record once closed.
+
+    Concurrent tests each have their own writers, so records are never
+    interleaved in the archive.
+    '''
+    def __init__(self, archive, key):
+        self.archive = archive
+        self.key = key
+        self.closed = False
+        self._size = 0
+        self._compressor = zlib.compressobj(_compress_level)
+        self._spool = tempfile.SpooledTemporaryFile(_spool_size)
+
+    def write(self, data):
+        self._size += len(data)
+        self._spool.write(self._compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._spool.write(self._compressor.flush())
+        self._spool.seek(0)
+        self.archive.append(self.key, self._spool, self._size)
+        self._spool.close()
+
+
+class OutputArchive(object):
+    '''
+    Append-only file of compressed output records along with the index of
+    their offsets.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        mkdir_p(os.path.dirname(path))
+        self._fstream = open(path, 'ab')
+        self._index = open(path + index_suffix, 'ab')
+
+    def writer(self, path):
+        '''
+        Return a file-like :class:`ArchiveWriter` which stores the output
+        which would have been written to path.
+        '''
+        return ArchiveWriter(self, output_key(path))
+
+    def append(self, key, fstream, size):
+        '''
+        Append the compressed data read from fstream as the record of key.
+
+        :param size: Size of the data before it was compressed.
+        '''
+        with self._lock:
+            self._fstream.seek(0, os.SEEK_END)
+            offset = self._fstream.tell()
+            for chunk in iter(lambda: fstream.read(_chunk_size), ''):
+                self._fstream.write(chunk)
+            self._fstream.flush()
+            entry = {'key': key, 'offset': offset,
+                     'length': self._fstream.tell() - offset,
+                     'size': size, 'time': time.time()}
+            self._index.write(json.dumps(entry) + '\n')
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._fstream.close()
+            self._index.close()
+
+
+class ArchiveReader(object):
+    '''
+    Reads the records of all archives in a result path.
+
+    Indexes are read incrementally, so records appended by other processes
+    (e.g. --jobs workers) since the last lookup are found.
+    '''
+    def __init__(self, result_path):
+        self.result_path = result_path
+        self._lock = threading.Lock()
+        # Dictionary mapping index path->bytes of it which have been read.
+        self._read = {}
+        # Dictionary mapping key->(archive path, index entry)
+        self._entries = {}
+
+    def refresh(self):
+        '''Read any entries appended to the indexes since the last call.'''
+        pattern = os.path.join(self.result_path,
+                               '*' + archive_suffix + index_suffix)
+        for index_path in glob.glob(pattern):
+            read = self._read.get(index_path, 0)
+            if os.path.getsize(index_path) <= read:
+                continue
+            archive_path = index_path[:-len(index_suffix)]
+            with open(index_path, 'rb') as fstream:
+                fstream.seek(read)
+                for line in fstream:
+                    if not line.endswith('\n'):
+                        # The entry is still being written.
+                        break
+                    read += len(line)
+                    entry = json.loads(line)
+                    current = self._entries.get(entry['key'])
+                    if current is None or current[1]['time'] <= entry['time']:
+                        self._entries[entry['key']] = (archive_path, entry)
+            self._read[index_path] = read
+
+    def lookup(self, key):
+        '''Return the :code:`(archive path, entry)` of key or None.'''
+        with self._lock:
+            self.refresh()
+            return self._entries.get(key)
+
+    def keys(self):
+        with self._lock:
+            self.refresh()
+            return list(self._entries)
+
+    def iter_entry(self, archive_path, entry):
+        '''
+        Return an iterator over the decompressed chunks of the record of an
+        entry returned by :func:`lookup`.
+        '''
+        decompressor = zlib.decompressobj()
+        with open(archive_path, 'rb') as fstream:
+            fstream.seek(entry['offset'])
+            remaining = entry['length']
+            while remaining:
+                chunk = fstream.read(min(remaining, _chunk_size))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+
+_archive = None
+_readers = {}
+
+
+def archive():
+    '''
+    Return the archive this process appends output to, creating it if it
+    isn't open. A process forked from one with an archive opens its own.
+    '''
+    global _archive
+    path = os.path.join(config.result_path,
+                        'output-%d%s' % (os.getpid(), archive_suffix))
+    if _archive is None or _archive.path != path:
+        _archive = OutputArchive(path)
+    return _archive
+
+
+def reader(result_path=None):
+    '''Return the :class:`ArchiveReader` of the result path.'''
+    if result_path is None:
+        result_path = config.result_path
+    if result_path not in _readers:
+        _readers[result_path] = ArchiveReader(result_path)
+    return _readers[result_path]
+
+
+def clear(result_path=None):
+    '''Remove the archives of a previous run from the result path.'''
+    if result_path is None:
+        result_path = config.result_path
+    global _archive
+    if _archive is not None:
+        _archive.close()
+        _archive = None
+    _readers.pop(result_path, None)
+    for suffix in (archive_suffix, archive_suffix + index_suffix):
+        for path in glob.glob(os.path.join(result_path, '*' + suffix)):
+            os.remove(path)
+
+
+def open_output(path):
+    '''
+    Return a writable file-like object to capture the output which would be
+    written to path, archiving it with --output-archive.
+    '''
+    if enabled():
+        return archive().writer(path)
+    return open(path, 'w')
+
+
+def write_output(path, data):
+    '''Store data as the output which would be written to path.'''
+    if not enabled():
+        mkdir_p(os.path.dirname(path))
+    with contextlib.closing(open_output(path)) as fstream:
+        fstream.write(data)
+
+
+def iter_output(path):
+    '''
+    Return an iterator over chunks of the output written to path, which is
+    empty if no output was stored for it.
+    '''
+    chunks = _find_output(path)
+    return iter(()) if chunks is None else chunks
+
+
+def read_output(path):
+    '''Return the output written to path, None if none was stored.'''
+    chunks = _find_output(path)
+    return None if chunks is None else ''.join(chunks)
+
+
+def head_and_tail(path, limit):
+    '''
+    Return at most limit bytes of the output written to path, taken from its
+    start and end.
+
+    :returns: A tuple :code:`(head, omitted, tail)` of the start of the
+        output, the number of bytes left out, and its end. If the output
+        fits within limit it's all in head.
+    '''
+    tail_size = limit // 2
+    head_size = limit - tail_size
+    location = _locate(path)
+    if location is None:
+        return ('', 0, '')
+    if location[0] == 'file':
+        # Seek rather than reading what will be left out.
+        with open(path, 'r') as fstream:
+            size = os.fstat(fstream.fileno()).st_size
+            if size <= limit:
+                return (fstream.read(), 0, '')
+            head = fstream.read(head_size)
+            fstream.seek(size - tail_size)
+            return (head, size - limit, fstream.read(tail_size))
+
+    # Records are compressed as a single stream, read through the middle.
+    head = []
+    head_length = 0
+    tail = collections.deque()
+    tail_length = 0
+    total = 0
+    for chunk in reader().iter_entry(*location[1]):
+        total += len(chunk)
+        if head_length < head_size:
+            head.append(chunk[:head_size - head_length])
+            head_length += len(head[-1])
+            chunk = chunk[len(head[-1]):]
+        if chunk:
+            tail.append(chunk)
+            tail_length += len(chunk)
+            while tail_length - len(tail[0]) >= tail_size:
+                tail_length -= len(tail.popleft())
+    tail = ''.join(tail)
+    if total <= limit:
+        return (''.join(head) + tail, 0, '')
+    return (''.join(head), total - limit, tail[len(tail) - tail_size:])
+
+
+def output_location(path):
+    '''
+    Return a description of where the output written to path is stored,
+    None if none was stored.
+    '''
+    location = _locate(path)
+    if location is None:
+        return None
+    if location[0] == 'file':
+        return path
+    return '%s (%s)' % (location[1][0], location[1][1]['key'])
+
+
+def _locate(path):
+    # Prefer the kind of storage this run writes to, so a rerun with or
+    # without --output-archive finds the output it just wrote.
+    if enabled() or not os.path.exists(path):
+        found = reader().lookup(output_key(path))
+        if found is not None:
+            return ('archive', found)
+    if os.path.exists(path):
+        return ('file', path)
+    return None
+
+
+def _find_output(path):
+    location = _locate(path)
+    if location is None:
+        return None
+    if location[0] == 'file':
+        return _iter_file(path)
+    return reader().iter_entry(*location[1])
+
+
+def _iter_file(path):
+    with open(path, 'r') as fstream:
+        for chunk in iter(lambda: fstream.read(_chunk_size), ''):
+            yield chunk
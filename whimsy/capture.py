@@ -0,0 +1,357 @@
+'''
+Captures the stdout and stderr of this process (and all of its subprocesses)
+into the files of the test which is running, while still writing it to the
+console.
+
+Unlike :func:`whimsy.tee.tee`, which starts two `tee` processes and
+redirects the file descriptors for every test, a :class:`CaptureEngine`
+redirects stdout and stderr into pipes once. A single reader thread copies
+whatever arrives on the pipes in large chunks to the original stdout and
+stderr and to the current target files. Moving on to the next test only
+switches the target files.
+
+>>> with capture('system-out', 'system-err'):
+...     print 'This goes to the console and system-out'
+
+How output is captured is chosen by the --capture mode:
+
+`tee`
+    Write output to the test's files and the console.
+`file-only`
+    Only write output to the test's files. The default with --jobs or
+    --progress.
+`tail`
+    Keep only the last --capture-tail bytes of each stream in memory and
+    write them to the test's files if the test does not pass.
+`none`
+    Don't capture output at all, it is only written to the console.
+
+The engine captures the whole process, so only one test at a time. Tests
+running concurrently in threads or on an event loop are instead captured with
+:func:`thread_capture`, which only redirects the current thread's Python
+output and the output of subprocesses it starts with
+:func:`whimsy.helper.log_call`.
+'''
+import atexit
+import collections
+import contextlib
+import errno
+import fcntl
+import os
+import select
+import sys
+import threading
+
+from config import config
+from _util import parse_size
+import archive
+import logger
+import tee
+
+modes = ('tee', 'file-only', 'tail', 'none')
+
+# Bytes to copy from a pipe at once.
+_chunk_size = 64 * 1024
+
+
+def _flush():
+    # Queued log records belong with the output written before them.
+    logger.flush()
+    for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+        try:
+            stream.flush()
+        except (AttributeError, IOError, ValueError):
+            pass
+
+
+def _write_all(fd, data):
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[written:]
+
+
+class _Stream(object):
+    '''A redirected file descriptor and the pipe its output is read from.'''
+    def __init__(self, fd):
+        self.fd = fd
+        self.original = os.dup(fd)
+        (self.read_fd, write_fd) = os.pipe()
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        self.target = None
+        self.echo = True
+
+    def copy(self):
+        '''Copy everything waiting in the pipe to the outputs.'''
+        while True:
+            try:
+                data = os.read(self.read_fd, _chunk_size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                return
+            if self.echo:
+                _write_all(self.original, data)
+            if self.target is not None:
+                self.target.write(data)
+
+    def retarget(self, target, echo=True):
+        if self.target is not None:
+            self.target.close()
+        self.target = target
+        self.echo = echo
+
+    def restore(self):
+        os.dup2(self.original, self.fd)
+        os.close(self.original)
+        self.retarget(None)
+
+
+class CaptureEngine(object):
+    '''
+    Redirects stdout and stderr into pipes read by a single thread, which
+    copies their output to the console and to the files given to
+    :func:`switch`.
+    '''
+    def __init__(self):
+        self.pid = None
+        self._streams = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def capturing(self):
+        '''True while output is written to the files of a test.'''
+        return any(stream.target is not None for stream in self._streams)
+
+    def start(self):
+        '''Redirect stdout and stderr and start the reader thread.'''
+        _flush()
+        self.pid = os.getpid()
+        self._streams = [_Stream(sys.__stdout__.fileno()),
+                         _Stream(sys.__stderr__.fileno())]
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._read)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        '''Copy any remaining output and restore stdout and stderr.'''
+        if not self.running:
+            return
+        _flush()
+        with self._lock:
+            for stream in self._streams:
+                stream.copy()
+                stream.restore()
+        _write_all(self._wakeup[1], 'x')
+        self._thread.join()
+        self._thread = None
+        for stream in self._streams:
+            os.close(stream.read_fd)
+        for fd in self._wakeup:
+            os.close(fd)
+        self._streams = []
+
+    def switch(self, stdout_target=None, stderr_target=None, echo=True):
+        '''
+        Write output to the given targets from now on. Output written before
+        the call still goes to the previous targets, which are closed.
+
+        :param stdout_target: File-like object to write stdout to, None to
+            only write it to the console.
+
+        :param echo: If False, output isn't written to the console.
+        '''
+        _flush()
+        with self._lock:
+            for (stream, target) in zip(self._streams,
+                                        (stdout_target, stderr_target)):
+                stream.copy()
+                stream.retarget(target, echo)
+
+    def _read(self):
+        fds = [stream.read_fd for stream in self._streams]
+        fds.append(self._wakeup[0])
+        while True:
+            try:
+                (readable, _, _) = select.select(fds, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wakeup[0] in readable:
+                return
+            with self._lock:
+                for stream in self._streams:
+                    if stream.read_fd in readable:
+                        stream.copy()
+
+
+_engine = None
+
+
+def capturing():
+    '''
+    Return True if the capture engine of this process is writing output to
+    the files of a test.
+    '''
+    return _engine is not None and _engine.pid == os.getpid() \
+            and _engine.capturing
+
+
+logger.add_capture_check(capturing)
+
+
+def engine():
+    '''
+    Return the capture engine of this process, starting it if it isn't
+    running. A process forked from one with an engine starts its own.
+    '''
+    global _engine
+    if _engine is None or _engine.pid != os.getpid():
+        _engine = CaptureEngine()
+        _engine.start()
+        atexit.register(_engine.stop)
+    return _engine
+
+
+class TailBuffer(object):
+    '''
+    File-like object which keeps only the last `size` bytes written to it,
+    writing them to a file when :func:`save` is called.
+    '''
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._chunks = collections.deque()
+        self._length = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        while self._chunks \
+                and self._length - len(self._chunks[0]) >= self.size:
+            self._length -= len(self._chunks.popleft())
+
+    def save(self):
+        data = ''.join(self._chunks)
+        archive.write_output(self.path, data[-self.size:] if self.size else '')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Captured(object):
+    '''
+    Returned by :func:`capture`. In `tail` mode the tails are only written
+    to disk if :func:`keep` is called.
+    '''
+    def __init__(self, targets=()):
+        self.targets = targets
+        self.kept = False
+
+    def keep(self):
+        self.kept = True
+
+
+def capture_mode():
+    '''
+    Return the --capture mode, which defaults to `file-only` when suites
+    run in parallel or --progress is shown and `tee` otherwise.
+    '''
+    if config.capture is not None:
+        return config.capture
+    return 'file-only' if config.jobs > 1 or config.progress else 'tee'
+
+
+@contextlib.contextmanager
+def capture(stdout_path, stderr_path, mode=None):
+    '''
+    Context manager which captures stdout and stderr into the given files
+    with the process' :class:`CaptureEngine`.
+
+    :param mode: One of :data:`modes`, if None uses :func:`capture_mode`.
+
+    :returns: A :class:`Captured` object as the context.
+    '''
+    if mode is None:
+        mode = capture_mode()
+    if mode == 'none':
+        yield Captured()
+        return
+
+    captured = Captured(_targets(stdout_path, stderr_path, mode))
+    capture_engine = engine()
+    capture_engine.switch(*captured.targets, echo=(mode == 'tee'))
+    try:
+        yield captured
+    finally:
+        capture_engine.switch()
+        _finish(captured, mode)
+
+
+@contextlib.contextmanager
+def thread_capture(stdout_path, stderr_path, mode=None):
+    '''
+    Context manager which captures the output of the current thread into the
+    given files, see :func:`whimsy.tee.thread_streams`. Other threads are
+    not affected so concurrent tests each get their own files.
+
+    Output is never echoed to the console since that of concurrent tests
+    would be interleaved, so `tee` behaves as `file-only`. Runners echo the
+    files as they report the test instead.
+
+    :returns: A :class:`Captured` object as the context.
+    '''
+    if mode is None:
+        mode = capture_mode()
+    if mode == 'none':
+        yield Captured()
+        return
+
+    captured = Captured(_targets(stdout_path, stderr_path, mode))
+    previous = tee.current_capture()
+    tee.set_capture({'stdout': captured.targets[0],
+                     'stderr': captured.targets[1]})
+    try:
+        yield captured
+    finally:
+        tee.set_capture(previous)
+        for target in captured.targets:
+            target.close()
+        _finish(captured, mode)
+
+
+def _targets(stdout_path, stderr_path, mode):
+    if mode == 'tail':
+        size = parse_size(config.capture_tail)
+        return (TailBuffer(stdout_path, size), TailBuffer(stderr_path, size))
+    return (archive.open_output(stdout_path),
+            archive.open_output(stderr_path))
+
+
+def _finish(captured, mode):
+    if mode == 'tail' and captured.kept:
+        for target in captured.targets:
+            target.save()
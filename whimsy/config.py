@@ -167,6 +167,25 @@ _defaults.base_dir = os.path.abspath(os.path.join(absdirpath(__file__),
                                                   os.pardir))
 _defaults.result_path = os.path.join(os.getcwd(), '.testing-results')
 _defaults.list_only_failed = False
+_defaults.timeout = None
+_defaults.test_threads = 1
+_defaults.coroutines = 1
+_defaults.jobs = 1
+_defaults.capture = None
+_defaults.capture_tail = '64K'
+_defaults.output_archive = False
+_defaults.async_logging = False
+_defaults.progress = False
+_defaults.resume = False
+_defaults.copy_output = False
+_defaults.events = None
+_defaults.history_db = None
+_defaults.history_keep = 100
+_defaults.stage_dir = None
+_defaults.junit_output = 'inline'
+_defaults.junit_output_limit = '1M'
+_defaults.timeout_percentile = None
+_defaults.timeout_multiplier = 3.0
 
 def set_default_build_dir(build_dir):
     '''
@@ -188,6 +207,8 @@ config.add_post_processor('build_dir', set_default_build_dir)
 # common string names used across the test framework. A simple typo in
 # a string can take a lot of debugging to uncover the issue, attribute errors
 # are easier to notice and most autocompletion systems detect them.
+constants.pickle_filename = 'pickle'
+constants.junit_filename = 'junit.xml'
 constants.system_out_name = 'system-out'
 constants.system_err_name = 'system-err'
 constants.x86_tag = 'X86'
@@ -259,6 +280,32 @@ class Argument(object):
         return copy.deepcopy(self)
 
 
+def _shard(value):
+    '''
+    Argument type which parses a shard given as K/N into a tuple (K, N).
+    '''
+    try:
+        (index, count) = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be given as K/N')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard K/N must have 1 <= K <= N')
+    return (index, count)
+
+
+def _positive_int(value):
+    '''
+    Argument type which parses an integer of at least 1.
+    '''
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not an integer' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
 class _StickyInt:
     '''
     A class that is used to cheat the verbosity count incrementer by
@@ -310,10 +357,50 @@ common_args = [
         default=_defaults.base_dir,
         help='Directory to change to in order to exec scons.'),
     Argument(
-        '-j', '--threads',
+        '--threads',
         action='store',
         default=1,
         help='Number of threads to run SCons with.'),
+    Argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of worker processes to run test suites in.'),
+    Argument(
+        '--test-threads',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of threads to run the tests of a concurrent TestList'
+             ' (e.g. gem5 verifiers) in.'),
+    Argument(
+        '--coroutines',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of suites to run at once on an event loop in this'
+             ' process. Suites of coroutine tests (e.g. gem5 runs) then wait'
+             ' on their simulations together.'),
+    Argument(
+        '--max-cpus',
+        action='store',
+        type=int,
+        default=None,
+        help='Number of cpus suites ran by --jobs workers may use at once.'
+             ' Defaults to the number of cpus on the host.'),
+    Argument(
+        '--max-memory',
+        action='store',
+        default=None,
+        help='Memory suites ran by --jobs workers may use at once, e.g. 16G.'
+             ' Defaults to the memory of the host.'),
+    Argument(
+        '--setup-threads',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of independent fixtures which may be setup at once.'),
     Argument(
         '-v',
         action='count',
@@ -326,6 +413,162 @@ common_args = [
         default=os.getcwd(),
         help='Path to read a testing.ini config in'
     ),
+    Argument(
+        '--order',
+        action='store',
+        choices=('discovery', 'longest-first', 'failed-first'),
+        default='discovery',
+        help='Order to run suites in. longest-first and failed-first use the'
+             ' results of the previous run.'
+    ),
+    Argument(
+        '--shard',
+        action='store',
+        type=_shard,
+        default=None,
+        help='Only run the Kth of N shards of the suites, given as K/N.'
+             ' Shards are balanced using the runtimes in --shard-history,'
+             ' which every shard must be given.'
+    ),
+    Argument(
+        '--shard-history',
+        action='store',
+        default=None,
+        help='Result directory of a previous run used to balance shards.'
+             ' Every shard must be given the same results, e.g. a copy kept'
+             ' from before the shards were ran. Without it shards only use the'
+             ' durations suites declare, or else a hash of their uid.'
+    ),
+    Argument(
+        '--address',
+        action='store',
+        default='localhost:7117',
+        help='Address the coordinator listens on, either host:port or the'
+             ' path of a UNIX socket.'
+    ),
+    Argument(
+        '--authkey',
+        action='store',
+        default=None,
+        help='Key workers must give to connect to the coordinator.'
+    ),
+    Argument(
+        '--pipeline',
+        action='store_true',
+        default=False,
+        help='Build fixtures in the background and start running each suite'
+             ' as soon as its fixtures are built.'
+    ),
+    Argument(
+        '--timeout',
+        action='store',
+        type=float,
+        default=None,
+        help='Seconds a test may run before it is stopped, for tests which'
+             ' do not set their own timeout.'
+    ),
+    Argument(
+        '--timeout-percentile',
+        action='store',
+        type=float,
+        default=None,
+        help='Derive the timeout of tests which do not set their own from'
+             ' this percentile of their runtimes in the previous results.'
+    ),
+    Argument(
+        '--timeout-multiplier',
+        action='store',
+        type=float,
+        default=3.0,
+        help='Multiple of the --timeout-percentile runtime a test may run'
+             ' for.'
+    ),
+    Argument(
+        '--capture',
+        action='store',
+        choices=('tee', 'file-only', 'tail', 'none'),
+        default=None,
+        help='How to capture the output of tests. tee: write it to the'
+             ' console and the test\'s files, file-only: only write it to the'
+             ' files, tail: only keep the last --capture-tail bytes and write'
+             ' them if the test fails, none: don\'t capture it. Defaults to'
+             ' file-only with --jobs and tee otherwise.'
+    ),
+    Argument(
+        '--capture-tail',
+        action='store',
+        default='64K',
+        help='Bytes of each output stream the tail --capture mode keeps,'
+             ' e.g. 64K.'
+    ),
+    Argument(
+        '--output-archive',
+        action='store_true',
+        default=False,
+        help='Store the captured output of tests in one compressed archive'
+             ' per process in the result path rather than in a directory'
+             ' per test.'
+    ),
+    Argument(
+        '--events',
+        action='store',
+        default=None,
+        help='File or FIFO to write each event of the run to as it happens,'
+             ' as a line of JSON.'
+    ),
+    Argument(
+        '--history-db',
+        action='store',
+        default=None,
+        help='SQLite database to append the results of each run to. Its'
+             ' history is used in place of the last results for ordering'
+             ' and timeouts.'
+    ),
+    Argument(
+        '--history-keep',
+        action='store',
+        type=_positive_int,
+        default=_defaults.history_keep,
+        help='Number of runs to keep in --history-db, at least 1. Older'
+             ' runs are deleted.'
+    ),
+    Argument(
+        '--progress',
+        action='store_true',
+        default=False,
+        help='Show the progress of the run, with an estimate of the time'
+             ' left, rather than a line for every test which passes.'
+    ),
+    Argument(
+        '--async-logging',
+        action='store_true',
+        default=False,
+        help='Write log messages to the console from a background thread,'
+             ' which also writes those of --jobs workers in order.'
+    ),
+    Argument(
+        '--stage-dir',
+        action='store',
+        default=None,
+        help='Local directory (e.g. on tmpfs) to write results to before'
+             ' they are copied to the result path in the background.'
+    ),
+    Argument(
+        '--junit-output',
+        action='store',
+        choices=('inline', 'reference'),
+        default='inline',
+        help='Whether the junit report includes the output of each test or'
+             ' only refers to where it is stored.'
+    ),
+    Argument(
+        '--junit-output-limit',
+        action='store',
+        default='1M',
+        help='Bytes of each output stream of a test the junit report'
+             ' includes, taken from its start and end, e.g. 1M. 0 includes'
+             ' all of it.'
+    ),
     Argument(
         '--skip-build',
         action='store_true',
@@ -394,13 +637,46 @@ class RunParser(ArgParser):
 
         super(RunParser, self).__init__(parser)
 
+        Argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='Resume a run which was interrupted, only running the'
+                 ' suites which have no results in --result-path.'
+        ).add_to(parser)
+
         common_args.uid.add_to(parser)
         common_args.skip_build.add_to(parser)
+        common_args.result_path.add_to(parser)
         common_args.directory.add_to(parser)
         common_args.build_dir.add_to(parser)
         common_args.base_dir.add_to(parser)
         common_args.fail_fast.add_to(parser)
         common_args.threads.add_to(parser)
+        common_args.jobs.add_to(parser)
+        common_args.max_cpus.add_to(parser)
+        common_args.max_memory.add_to(parser)
+        common_args.setup_threads.add_to(parser)
+        common_args.test_threads.add_to(parser)
+        common_args.coroutines.add_to(parser)
+        common_args.timeout.add_to(parser)
+        common_args.timeout_percentile.add_to(parser)
+        common_args.timeout_multiplier.add_to(parser)
+        common_args.capture.add_to(parser)
+        common_args.capture_tail.add_to(parser)
+        common_args.output_archive.add_to(parser)
+        common_args.async_logging.add_to(parser)
+        common_args.progress.add_to(parser)
+        common_args.events.add_to(parser)
+        common_args.history_db.add_to(parser)
+        common_args.history_keep.add_to(parser)
+        common_args.stage_dir.add_to(parser)
+        common_args.junit_output.add_to(parser)
+        common_args.junit_output_limit.add_to(parser)
+        common_args.pipeline.add_to(parser)
+        common_args.order.add_to(parser)
+        common_args.shard.add_to(parser)
+        common_args.shard_history.add_to(parser)
         common_args.list_only_failed.add_to(parser)
 
         # Modify the help statement for the tags common_arg
@@ -445,6 +721,19 @@ class ListParser(ArgParser):
             default=False,
             help='List all tags.'
         ).add_to(parser)
+        Argument(
+            '--shards',
+            action='store',
+            type=int,
+            default=None,
+            help='List the suites in each of the given number of shards.'
+        ).add_to(parser)
+        common_args.shard_history.add_to(parser)
+        failed = common_args.list_only_failed.copy()
+        failed.kwargs['help'] = ('List the suites and tests which failed in'
+                                 ' the results in --result-path.')
+        failed.add_to(parser)
+        common_args.result_path.add_to(parser)
 
         common_args.directory.add_to(parser)
         mytags = common_args.tags.copy()
@@ -462,16 +751,209 @@ class RerunParser(ArgParser):
         super(RerunParser, self).__init__(parser)
 
         common_args.skip_build.add_to(parser)
+        common_args.result_path.add_to(parser)
         common_args.directory.add_to(parser)
         common_args.build_dir.add_to(parser)
         common_args.base_dir.add_to(parser)
         common_args.fail_fast.add_to(parser)
         common_args.threads.add_to(parser)
+        common_args.jobs.add_to(parser)
+        common_args.max_cpus.add_to(parser)
+        common_args.max_memory.add_to(parser)
+        common_args.setup_threads.add_to(parser)
+        common_args.test_threads.add_to(parser)
+        common_args.coroutines.add_to(parser)
+        common_args.timeout.add_to(parser)
+        common_args.timeout_percentile.add_to(parser)
+        common_args.timeout_multiplier.add_to(parser)
+        common_args.capture.add_to(parser)
+        common_args.capture_tail.add_to(parser)
+        common_args.output_archive.add_to(parser)
+        common_args.async_logging.add_to(parser)
+        common_args.progress.add_to(parser)
+        common_args.events.add_to(parser)
+        common_args.history_db.add_to(parser)
+        common_args.history_keep.add_to(parser)
+        common_args.stage_dir.add_to(parser)
+        common_args.pipeline.add_to(parser)
+        common_args.order.add_to(parser)
+        common_args.shard.add_to(parser)
+        common_args.shard_history.add_to(parser)
         common_args.list_only_failed.add_to(parser)
 
 
+class CoordinatorParser(ArgParser):
+    '''
+    Parser for the \'coordinator\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'coordinator',
+            help='''Hand out tests to workers and collect their results.'''
+        )
+        super(CoordinatorParser, self).__init__(parser)
+
+        common_args.result_path.add_to(parser)
+        common_args.directory.add_to(parser)
+        common_args.address.add_to(parser)
+        common_args.authkey.add_to(parser)
+        common_args.fail_fast.add_to(parser)
+        common_args.order.add_to(parser)
+        common_args.shard.add_to(parser)
+        common_args.shard_history.add_to(parser)
+        common_args.output_archive.add_to(parser)
+        common_args.async_logging.add_to(parser)
+        common_args.progress.add_to(parser)
+        common_args.events.add_to(parser)
+        common_args.history_db.add_to(parser)
+        common_args.history_keep.add_to(parser)
+        common_args.stage_dir.add_to(parser)
+        common_args.junit_output.add_to(parser)
+        common_args.junit_output_limit.add_to(parser)
+
+        mytags = common_args.tags.copy()
+        mytags.kwargs['help'] = ('Only run items marked with one of the given'
+                                 ' tags.')
+        mytags.add_to(parser)
+
+
+class WorkerParser(ArgParser):
+    '''
+    Parser for the \'worker\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'worker',
+            help='''Run tests handed out by a coordinator.'''
+        )
+        super(WorkerParser, self).__init__(parser)
+
+        common_args.directory.add_to(parser)
+        common_args.address.add_to(parser)
+        common_args.authkey.add_to(parser)
+        common_args.skip_build.add_to(parser)
+        common_args.build_dir.add_to(parser)
+        common_args.base_dir.add_to(parser)
+        common_args.fail_fast.add_to(parser)
+        common_args.threads.add_to(parser)
+        common_args.setup_threads.add_to(parser)
+        common_args.test_threads.add_to(parser)
+        common_args.timeout.add_to(parser)
+        common_args.timeout_percentile.add_to(parser)
+        common_args.timeout_multiplier.add_to(parser)
+        common_args.capture.add_to(parser)
+        common_args.capture_tail.add_to(parser)
+        common_args.output_archive.add_to(parser)
+        common_args.async_logging.add_to(parser)
+
+
+class ShowOutputParser(ArgParser):
+    '''
+    Parser for the \'show-output\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'show-output',
+            help='''Show the output captured for a test.'''
+        )
+        super(ShowOutputParser, self).__init__(parser)
+
+        Argument(
+            'uid',
+            action='store',
+            help='UID of the test case to show the output of.'
+        ).add_to(parser)
+        common_args.result_path.add_to(parser)
+
+
+class HistoryParser(ArgParser):
+    '''
+    Parser for the \'history\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'history',
+            help='''Query the results of previous runs in --history-db.'''
+        )
+        super(HistoryParser, self).__init__(parser)
+
+        Argument(
+            '--slowest',
+            action='store',
+            type=int,
+            default=None,
+            help='List the given number of tests with the longest mean'
+                 ' runtime.'
+        ).add_to(parser)
+        Argument(
+            '--trend',
+            action='store',
+            default=None,
+            help='List the outcome and runtime of the test or suite with the'
+                 ' given uid in every run.'
+        ).add_to(parser)
+        Argument(
+            '--flipped',
+            action='store_true',
+            default=False,
+            help='List tests whose outcome changed between runs.'
+        ).add_to(parser)
+        Argument(
+            '--runs',
+            action='store',
+            type=int,
+            default=10,
+            help='Number of the latest runs --slowest and --flipped look at.'
+        ).add_to(parser)
+        Argument(
+            '--compact',
+            action='store_true',
+            default=False,
+            help='Delete runs beyond --history-keep and reclaim their space.'
+        ).add_to(parser)
+        history_db = common_args.history_db.copy()
+        history_db.kwargs['required'] = True
+        history_db.add_to(parser)
+        common_args.history_keep.add_to(parser)
+
+
+class MergeParser(ArgParser):
+    '''
+    Parser for the \'merge\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'merge',
+            help='''Merge the results of several runs into --result-path.'''
+        )
+        super(MergeParser, self).__init__(parser)
+
+        Argument(
+            'sources',
+            action='store',
+            nargs='+',
+            help='Result paths of the runs to merge. If a suite ran in more'
+                 ' than one, its result from the last given is kept.'
+        ).add_to(parser)
+        Argument(
+            '--copy-output',
+            action='store_true',
+            default=False,
+            help='Copy captured output to --result-path rather than'
+                 ' referring to it in the merged result paths.'
+        ).add_to(parser)
+        common_args.result_path.add_to(parser)
+        common_args.junit_output.add_to(parser)
+        common_args.junit_output_limit.add_to(parser)
+
+
 # Setup parser and subcommands
 baseparser = CommandParser()
 runparser = RunParser(baseparser.subparser)
 listparser = ListParser(baseparser.subparser)
 rerunparser = RerunParser(baseparser.subparser)
+coordinatorparser = CoordinatorParser(baseparser.subparser)
+workerparser = WorkerParser(baseparser.subparser)
+showoutputparser = ShowOutputParser(baseparser.subparser)
+historyparser = HistoryParser(baseparser.subparser)
+mergeparser = MergeParser(baseparser.subparser)
@@ -0,0 +1,149 @@
+'''
+Contains the :class:`CoroutineRunner` which runs several
+:class:`TestSuite` instances at once on a single
+:class:`whimsy.eventloop.EventLoop`.
+
+Most of the time of a gem5 test is spent waiting on the simulation
+subprocess. When the test is a coroutine (such as the gem5 run test created
+by :func:`whimsy.gem5.suite.gem5_verify_config`) it waits on its subprocess
+through the event loop, so a single process can keep many light simulations
+running without a worker process or thread for each.
+
+Each suite is ran as a task by its own runner which buffers its results and
+captures the output of each test with
+:func:`whimsy.capture.thread_capture`.
+Fixtures are setup with :func:`whimsy.fixture.setup_fixtures_async` (see
+:func:`whimsy.runner.Runner.setup_unbuilt_async`), so suites sharing
+a fixture wait on a single setup of it. Results are reported in the
+order suites were given along with the output tests captured, as if the suites
+had been ran one after the other.
+
+Tests which are not coroutines block the event loop while they run, so they
+gain nothing from this runner.
+'''
+import collections
+import traceback
+
+from config import config
+import eventloop
+from eventloop import Return, CancelledError
+from logger import log
+from result import Outcome
+from runner import Runner, FixturePipeline, _BufferedLogger, \
+        thread_local_output
+from capture import thread_capture
+
+
+class _TaskRunner(Runner):
+    '''
+    Runs a single suite as a task of the :class:`CoroutineRunner`.
+    '''
+    def _capture(self, fstdout_name, fstderr_name):
+        return thread_capture(fstdout_name, fstderr_name)
+
+
+class CoroutineRunner(Runner):
+    '''
+    A :class:`Runner` which runs suites concurrently on an event loop.
+    '''
+    def __init__(self, suites=tuple(), result_loggers=tuple(),
+                 timeouts=None, coroutines=None):
+        '''
+        :param coroutines: Number of suites to run at once. If None, uses the
+            config's coroutines.
+
+        .. seealso:: :func:`Runner.__init__`
+        '''
+        super(CoroutineRunner, self).__init__(suites, result_loggers,
+                                              timeouts)
+        if coroutines is None:
+            coroutines = config.coroutines
+        self.coroutines = coroutines
+
+    def run_suites(self, suites):
+        '''
+        Run the given suites, up to `coroutines` at once, reporting their
+        results in the order the suites were given.
+
+        If the --fail-fast flag was given, the first failing suite will cause
+        all running suites to be cancelled.
+
+        :returns: The set of outcomes of the suites which were ran.
+        '''
+        if isinstance(suites, FixturePipeline):
+            # Suites setup their own fixtures on the event loop, waiting on
+            # the pipeline would only block the loop.
+            suites = suites.suites
+        with thread_local_output():
+            return eventloop.run(self._run_suites(suites))
+
+    def _run_suites(self, suites):
+        semaphore = eventloop.Semaphore(self.coroutines)
+        running = collections.deque()
+        outcomes = set()
+        self._stopped = False
+
+        def report_finished():
+            while running and running[0][2].done():
+                (test_suite, buffered, task) = running.popleft()
+                outcome = task.result()
+                if outcome is not None:
+                    buffered.replay(self.result_loggers,
+                                    after_begin=self._echo_output)
+                    outcomes.add(outcome)
+
+        for test_suite in suites:
+            yield semaphore.acquire()
+            report_finished()
+            if self._stopped:
+                semaphore.release()
+                break
+            buffered = _BufferedLogger()
+            task = eventloop.ensure_future(
+                    self._run_suite_task(test_suite, buffered, semaphore,
+                                         running))
+            running.append((test_suite, buffered, task))
+
+        for (_, _, task) in list(running):
+            yield task
+            report_finished()
+        raise Return(outcomes)
+
+    def _run_suite_task(self, test_suite, buffered, semaphore, running):
+        '''
+        Coroutine which runs the suite with a :class:`_TaskRunner`
+        recording its results into buffered.
+
+        :returns: The outcome of the suite, None if it was cancelled.
+        '''
+        self._suite_started(test_suite)
+        runner = _TaskRunner(result_loggers=(buffered,),
+                             timeouts=self.timeouts)
+        runner.fixture_failures = self.fixture_failures
+        try:
+            outcome = yield runner.run_suite_async(test_suite)
+        except CancelledError:
+            outcome = None
+        except Exception:
+            log.warn('Exception raised while running %s' % test_suite.name)
+            log.warn(traceback.format_exc())
+            # The buffered calls may leave items unfinished, only report the
+            # suite as errored.
+            buffered.calls = [
+                    ('begin', (test_suite,), {}),
+                    ('set_current_outcome', (Outcome.ERROR,),
+                     {'runtime': 0}),
+                    ('end_current', (), {})]
+            outcome = Outcome.ERROR
+        finally:
+            semaphore.release()
+
+        if outcome in Outcome.failfast and config.fail_fast \
+                and not self._stopped:
+            self._stopped = True
+            log.bold('Suite failed with the --fail-fast flag provided.')
+            log.bold('Cancelling remaining suites.')
+            for (_, _, task) in running:
+                if task is not eventloop.current_task():
+                    task.cancel()
+        raise Return(outcome)
@@ -0,0 +1,361 @@
+'''
+Implements the `coordinator` and `worker` commands which distribute
+:class:`TestSuite` instances across processes on any number of hosts.
+
+The coordinator and each worker load the same tree of tests. The coordinator
+listens on a TCP (`host:port`) or UNIX socket address and hands out the uids
+of suites to workers as they ask for work. A worker looks the suite up with
+:func:`whimsy.loader.TestLoader.get_uid`, runs it while recording results
+with a :class:`whimsy.parallel.ResultRecorder`, and sends the recorded
+results back along with the contents of the captured `system-out` and
+`system-err` files.
+
+The coordinator replays results into its own :class:`ResultLogger`
+instances in the order suites were given, so there is a single console
+stream, pickle and junit file for the whole run. If a worker disconnects
+while running a suite, that suite is handed out again to the next worker
+which asks for work.
+
+Messages are pickled, so an `authkey` should be used for any address which
+untrusted hosts can reach.
+
+.. seealso:: :mod:`whimsy.parallel`
+'''
+import collections
+import os
+import socket
+import threading
+import time
+import traceback
+import Queue
+from multiprocessing.connection import Listener, Client
+
+import archive
+from config import config, constants
+from helper import joinpath, OrderedDict
+from logger import log
+from parallel import ResultRecorder, replay, _suite_key
+from result import Outcome, test_results_output_path
+from runner import Runner
+from suite import SuiteList
+
+# Timeout used while waiting on results. Python2 will ignore
+# KeyboardInterrupt while blocking on a lock without a timeout.
+_poll_timeout = 0.5
+
+# Number of seconds a worker will keep trying to connect to the coordinator.
+connect_timeout = 30
+
+
+def parse_address(address):
+    '''
+    Parse the given address string into an address for
+    :mod:`multiprocessing.connection`.
+
+    :param address: Either `host:port` for a TCP socket or a path for a UNIX
+        socket.
+    '''
+    (host, sep, port) = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def _read_output(fname):
+    if fname is None:
+        return None
+    return archive.read_output(fname)
+
+
+def _collect_outputs(events):
+    '''
+    Return a dictionary mapping filename->contents of all captured output
+    files referenced in the recorded events.
+    '''
+    outputs = {}
+    for event in events:
+        if event[0] == 'set_current_outcome':
+            for key in ('fstdout_name', 'fstderr_name'):
+                fname = event[2].get(key)
+                if fname is not None:
+                    outputs[fname] = _read_output(fname)
+    return outputs
+
+
+def _localize_outputs(test_suite, events, outputs):
+    '''
+    Write the captured outputs sent by a worker into our own result path,
+    updating the events to refer to the local files.
+    '''
+    testcases = test_suite.testcases
+    current = []
+    for event in events:
+        if event[0] == 'begin':
+            current.append(event[1])
+        elif event[0] == 'end_current':
+            current.pop()
+        elif event[0] == 'set_current_outcome' \
+                and current and current[-1] is not _suite_key:
+            outdir = test_results_output_path(testcases[current[-1]])
+            kwargs = event[2]
+            for (key, name) in (
+                    ('fstdout_name', constants.system_out_name),
+                    ('fstderr_name', constants.system_err_name)):
+                if key not in kwargs:
+                    continue
+                fname = joinpath(outdir, name)
+                archive.write_output(fname, outputs.get(kwargs[key]) or '')
+                kwargs[key] = fname
+
+
+class _WorkQueue(object):
+    '''
+    Queue of suite uids to hand out to workers. Uids of suites which were
+    handed out to a worker that disconnected are placed back at the front.
+    '''
+    def __init__(self, uids):
+        self._uids = collections.deque(uids)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def get(self):
+        '''Return the next uid or None if there is no more work.'''
+        with self._lock:
+            if self._closed or not self._uids:
+                return None
+            return self._uids.popleft()
+
+    def requeue(self, uid):
+        with self._lock:
+            self._uids.appendleft(uid)
+
+    def close(self):
+        '''Stop handing out work.'''
+        with self._lock:
+            self._closed = True
+
+
+class CoordinatorRunner(Runner):
+    '''
+    A :class:`Runner` which hands suites out to remote workers rather than
+    running them itself.
+    '''
+    def __init__(self, suites=tuple(), result_loggers=tuple(), address=None,
+                 authkey=None):
+        '''
+        :param address: Address to listen for workers on. See
+            :func:`parse_address`.
+
+        :param authkey: Key workers must use to connect.
+
+        .. seealso:: :func:`Runner.__init__`
+        '''
+        super(CoordinatorRunner, self).__init__(suites, result_loggers)
+        self.address = address
+        self.authkey = authkey
+
+    def run(self):
+        '''
+        Distribute our suites to workers. Fixtures are setup by the workers
+        so none are setup here.
+        '''
+        for logger in self.result_loggers:
+            logger.begin_testing()
+        outcomes = self.run_suites(self.suites)
+        for logger in self.result_loggers:
+            logger.end_testing()
+        return self._suite_outcome(outcomes)
+
+    def run_suites(self, suites):
+        '''
+        Hand the suites out to workers, replaying their results into our
+        loggers in the order the suites were given.
+
+        :returns: The set of outcomes of the suites which were ran.
+        '''
+        # Workers can only look up a single suite for each uid.
+        unique = OrderedDict()
+        for suite in suites:
+            if suite.uid in unique:
+                log.warn('Multiple suites have the uid %s, only one will be'
+                         ' ran.' % suite.uid)
+            unique[suite.uid] = suite
+        suites = list(unique.values())
+        uids = list(unique)
+        indices = {uid: idx for idx, uid in enumerate(uids)}
+
+        work = _WorkQueue(uids)
+        finished = Queue.Queue()
+        started = Queue.Queue()
+        listener = Listener(parse_address(self.address),
+                            authkey=self.authkey)
+        log.display('Waiting for workers on %s' % (listener.address,))
+
+        closed = threading.Event()
+        acceptor = threading.Thread(target=self._accept,
+                                    args=(listener, closed, work, finished,
+                                          started))
+        acceptor.setDaemon(True)
+        acceptor.start()
+
+        completed = {}
+        outcomes = set()
+        next_idx = 0
+        try:
+            while next_idx < len(suites):
+                self._report_started(started, suites, indices)
+                try:
+                    (uid, outcome, events, outputs) = \
+                            finished.get(True, _poll_timeout)
+                except Queue.Empty:
+                    continue
+                idx = indices[uid]
+                if idx in completed or idx < next_idx:
+                    # Ran twice after a worker was thought to be lost.
+                    continue
+                outcome = Outcome.enums[outcome]
+                completed[idx] = (outcome, events, outputs)
+
+                if outcome in Outcome.failfast and config.fail_fast:
+                    log.bold('Suite failed with the --fail-fast flag'
+                             ' provided.')
+                    log.bold('No more suites will be handed out.')
+                    work.close()
+                    break
+
+                while next_idx in completed:
+                    outcomes.add(self._replay(suites[next_idx],
+                                              *completed.pop(next_idx)))
+                    next_idx += 1
+        finally:
+            work.close()
+            closed.set()
+            listener.close()
+
+        for idx in sorted(completed):
+            outcomes.add(self._replay(suites[idx], *completed[idx]))
+        return outcomes
+
+    def _report_started(self, started, suites, indices):
+        while True:
+            try:
+                (uid, worker) = started.get_nowait()
+            except Queue.Empty:
+                return
+            self._suite_started(suites[indices[uid]], worker)
+
+    def _replay(self, test_suite, outcome, events, outputs):
+        _localize_outputs(test_suite, events, outputs)
+        replay(test_suite, events, self.result_loggers)
+        return outcome
+
+    def _accept(self, listener, closed, work, finished, started):
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception:
+                # The listener was closed, or a client failed to
+                # authenticate.
+                if closed.is_set():
+                    return
+                log.warn('Failed to accept a worker connection.')
+                log.debug(traceback.format_exc())
+                continue
+            handler = threading.Thread(target=self._serve,
+                                       args=(connection, work, finished,
+                                             started))
+            handler.setDaemon(True)
+            handler.start()
+
+    def _serve(self, connection, work, finished, started):
+        '''
+        Hand out work to a single worker until there is none left or the
+        worker disconnects.
+        '''
+        uid = None
+        try:
+            worker = connection.recv()
+            log.display('Worker connected: %s' % worker)
+            while True:
+                uid = work.get()
+                if uid is None:
+                    connection.send(('done',))
+                    break
+                connection.send(('run', uid))
+                started.put((uid, worker))
+                (_, result_uid, outcome, events, outputs) = connection.recv()
+                finished.put((result_uid, outcome, events, outputs))
+                uid = None
+        except (EOFError, IOError, socket.error):
+            log.warn('Lost connection to a worker.')
+            if uid is not None:
+                log.warn('Handing out %s again.' % uid)
+                work.requeue(uid)
+        finally:
+            connection.close()
+
+
+def run_worker(loader, address, authkey=None, timeouts=None):
+    '''
+    Connect to the coordinator at address, running each suite it hands us
+    until it tells us there is no work left.
+
+    :param loader: A :class:`whimsy.loader.TestLoader` which has loaded the
+        same tests as the coordinator.
+
+    :param timeouts: :class:`whimsy.watchdog.TimeoutPolicy` used to run
+        tests. If None, uses the config's timeout.
+    '''
+    address = parse_address(address)
+    deadline = time.time() + connect_timeout
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+            break
+        except (IOError, socket.error):
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+    try:
+        connection.send('%s:%d' % (socket.gethostname(), os.getpid()))
+        while True:
+            message = connection.recv()
+            if message[0] == 'done':
+                break
+            uid = message[1]
+            test_suite = loader.get_uid(uid)
+            if test_suite is None:
+                log.warn('Coordinator gave us the unknown suite %s' % uid)
+                (outcome, events) = _errored()
+            else:
+                log.display('Running %s' % uid)
+                (outcome, events) = _run_suite(test_suite, timeouts)
+            connection.send(('result', uid, outcome.val, events,
+                             _collect_outputs(events)))
+    finally:
+        connection.close()
+
+
+def _run_suite(test_suite, timeouts=None):
+    recorder = ResultRecorder(test_suite)
+    runner = Runner(result_loggers=(recorder,), timeouts=timeouts)
+    try:
+        failed_builds = runner.setup_unbuilt(
+                SuiteList((test_suite,)).iter_fixtures(),
+                setup_lazy_init=False)
+        for (fixture, error) in failed_builds:
+            log.warn('Failed to build %s\n%s' % (fixture, error))
+        outcome = runner.run_suite(test_suite)
+    except Exception:
+        log.warn(traceback.format_exc())
+        return _errored()
+    return (outcome, recorder.events)
+
+
+def _errored():
+    '''Return the outcome and events of a suite which failed to run.'''
+    events = [('begin', _suite_key),
+              ('set_current_outcome', Outcome.ERROR.val, {'runtime': 0}),
+              ('end_current',)]
+    return (Outcome.ERROR, events)
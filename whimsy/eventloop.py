@@ -0,0 +1,599 @@
+'''
+A small event loop for generator based coroutines, used to run coroutine
+tests and fixture setups (for instance many gem5 simulations) concurrently
+in a single thread.
+
+Python 2 has no asyncio so coroutines are plain generators. A coroutine
+waits on an awaitable by yielding it, the yield expression then evaluates to
+the awaitable's result (or raises its exception). Since a generator cannot
+return a value, a coroutine returns one by raising :class:`Return`.
+
+An awaitable is one of:
+
+* Another coroutine, which is ran to completion as part of the same task.
+* A :class:`Future`, such as a :class:`Task` or the result of
+  :func:`log_call_async`, :func:`sleep`, :func:`gather` or :func:`wait_for`.
+* A list or tuple of awaitables, which are waited on together as with
+  :func:`gather`.
+* None, which simply lets other tasks run.
+
+An example:
+
+>>> def run_twice(command):
+...     results = yield [log_call_async(command), log_call_async(command)]
+...     yield sleep(1)
+...     raise Return(results)
+>>> run(run_twice(['echo', 'hello']))
+
+Each :class:`Task` remembers the output redirection of
+:func:`whimsy.capture.thread_capture` which was active when it last ran, so
+a task running within a capture keeps writing to its own files while other
+tasks run.
+'''
+import collections
+import errno
+import heapq
+import itertools
+import os
+import select
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+
+import multiplex
+import tee
+from helper import CalledProcessError, _track_process, _untrack_process
+
+# Longest time to block waiting for events. Python2 ignores interrupts while
+# blocking in select without a timeout.
+_max_block = 0.5
+
+# How often to check whether subprocesses which closed their output have
+# exited.
+_process_poll_interval = 0.05
+
+# Bytes to read from a subprocess pipe at once.
+_read_size = 64 * 1024
+
+
+class Return(Exception):
+    '''Raised by a coroutine to return a value.'''
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class CancelledError(BaseException):
+    '''
+    Raised in the coroutine of a :class:`Task` which was cancelled. Like
+    KeyboardInterrupt this is not an Exception, so it isn't caught by tests
+    catching every Exception.
+    '''
+
+
+class TimeoutError(Exception):
+    '''
+    Raised by :func:`wait_for` if the awaitable does not finish in time.
+
+    :var timeout: The timeout in seconds.
+    :var stack: The formatted stack of the task when it timed out.
+    '''
+    def __init__(self, timeout, stack=None):
+        super(TimeoutError, self).__init__(
+                'Timed out after %.2f seconds.' % timeout)
+        self.timeout = timeout
+        self.stack = stack
+
+
+class Future(object):
+    '''
+    The result of an operation which may not have finished yet.
+    '''
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''
+        Return the result of the future, or raise its exception if it
+        failed.
+        '''
+        if not self._done:
+            raise RuntimeError('Future has not finished.')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exc_info(self):
+        '''
+        Return the :func:`sys.exc_info` tuple of the exception of the future,
+        None if it did not fail.
+        '''
+        return self._exc_info
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        '''
+        :param exception: An exception instance or a :func:`sys.exc_info`
+            tuple.
+        '''
+        if not isinstance(exception, tuple):
+            exception = (type(exception), exception, None)
+        self._exc_info = exception
+        self._finish()
+
+    def add_done_callback(self, callback):
+        '''Call callback with this future once it's done.'''
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError('Future has already finished.')
+        self._done = True
+        (callbacks, self._callbacks) = (self._callbacks, [])
+        for callback in callbacks:
+            callback(self)
+
+
+_local = threading.local()
+
+
+def get_event_loop():
+    '''Return the event loop running in the current thread.'''
+    loops = getattr(_local, 'loops', None)
+    if not loops:
+        raise RuntimeError('There is no event loop running in this thread.')
+    return loops[-1]
+
+
+def current_task():
+    '''Return the :class:`Task` currently running, None if there is none.'''
+    return getattr(_local, 'task', None)
+
+
+class Task(Future):
+    '''
+    Runs a coroutine on an :class:`EventLoop`. The task is a future for the
+    coroutine's result.
+
+    :var capture: Output redirection (see :func:`whimsy.tee.current_capture`)
+        to use while the task runs.
+    '''
+    def __init__(self, coroutine, loop):
+        super(Task, self).__init__()
+        self._loop = loop
+        self._stack = [coroutine]
+        self._waiting = None
+        self._children = []
+        self.processes = []
+        self.capture = tee.current_capture()
+
+        parent = current_task()
+        if parent is not None:
+            parent._children = [child for child in parent._children
+                                if not child.done()]
+            parent._children.append(self)
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self, exception=None):
+        '''
+        Stop the task and tasks it started by raising exception
+        (a :class:`CancelledError` by default) in their coroutines. Processes
+        they started with :func:`log_call_async` are killed.
+        '''
+        if self.done():
+            return
+        if exception is None:
+            exception = CancelledError()
+        for child in self._children:
+            child.cancel()
+        for process in self.processes:
+            _kill(process)
+        self._waiting = None
+        self._loop.call_soon(self._step, None,
+                             (type(exception), exception, None))
+
+    def format_stack(self):
+        '''Return the formatted stack of coroutines the task is running.'''
+        lines = []
+        for generator in self._stack:
+            if generator.gi_frame is not None:
+                lines.extend(traceback.format_stack(generator.gi_frame))
+        return ''.join(lines)
+
+    def _wakeup(self, future):
+        self._loop.call_soon(self._resume, future)
+
+    def _resume(self, future):
+        if future is not self._waiting:
+            # We were cancelled while waiting on the future.
+            return
+        if future.exc_info() is not None:
+            self._step(None, future.exc_info())
+        else:
+            self._step(future._result, None)
+
+    def _step(self, value, exc_info):
+        if self.done():
+            return
+        self._waiting = None
+
+        saved_task = current_task()
+        saved_capture = tee.current_capture()
+        _local.task = self
+        tee.set_capture(self.capture)
+        try:
+            self._advance(value, exc_info)
+        finally:
+            self.capture = tee.current_capture()
+            tee.set_capture(saved_capture)
+            _local.task = saved_task
+
+    def _advance(self, value, exc_info):
+        while True:
+            generator = self._stack[-1]
+            try:
+                if exc_info is not None:
+                    awaitable = generator.throw(*exc_info)
+                else:
+                    awaitable = generator.send(value)
+            except Return as ret:
+                (value, exc_info) = (ret.value, None)
+            except StopIteration:
+                (value, exc_info) = (None, None)
+            except (Exception, CancelledError):
+                (value, exc_info) = (None, sys.exc_info())
+            else:
+                if isinstance(awaitable, types.GeneratorType):
+                    self._stack.append(awaitable)
+                    (value, exc_info) = (None, None)
+                    continue
+                try:
+                    future = ensure_future(awaitable, self._loop)
+                except TypeError:
+                    (value, exc_info) = (None, sys.exc_info())
+                    continue
+                if awaitable is None:
+                    self._loop.call_soon(self._step, None, None)
+                    return
+                self._waiting = future
+                future.add_done_callback(self._wakeup)
+                return
+
+            # The coroutine on top of the stack finished.
+            self._stack.pop()
+            if not self._stack:
+                if exc_info is not None:
+                    self.set_exception(exc_info)
+                else:
+                    self.set_result(value)
+                return
+
+
+class _Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    '''
+    Runs :class:`Task` objects, waking them up as the timers, file
+    descriptors and subprocesses they wait on become ready.
+    '''
+    def __init__(self):
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._readers = {}
+        self._exiting = []
+
+    def call_soon(self, callback, *args):
+        '''Call the callback on the next iteration of the loop.'''
+        self._ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Call the callback after delay seconds.
+
+        :returns: A handle with a `cancel` method.
+        '''
+        timer = _Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers,
+                       (timer.when, next(self._sequence), timer))
+        return timer
+
+    def add_reader(self, fd, callback):
+        '''Call the callback whenever fd is readable.'''
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def wait_process(self, process, callback):
+        '''Call the callback with the process once it has exited.'''
+        self._exiting.append((process, callback))
+
+    def create_task(self, coroutine):
+        '''Start running the coroutine, returning its :class:`Task`.'''
+        return Task(coroutine, self)
+
+    def run_until_complete(self, awaitable):
+        '''
+        Run the loop until the awaitable has finished.
+
+        :returns: The result of the awaitable.
+        '''
+        loops = getattr(_local, 'loops', None)
+        if loops is None:
+            loops = _local.loops = []
+        loops.append(self)
+        try:
+            future = ensure_future(awaitable, self)
+            while not future.done():
+                self._run_once()
+        finally:
+            loops.pop()
+        return future.result()
+
+    def _run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        elif not self._readers and not self._exiting:
+            raise RuntimeError('Deadlock, no task can make progress.')
+        else:
+            timeout = _max_block
+        if self._exiting:
+            timeout = min(timeout, _process_poll_interval)
+        timeout = min(timeout, _max_block)
+
+        if self._readers:
+            try:
+                (readable, _, _) = select.select(list(self._readers), [], [],
+                                                 timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                self._ready.append((self._readers[fd], ()))
+        elif timeout:
+            time.sleep(timeout)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+
+        exiting = []
+        for (process, callback) in self._exiting:
+            if process.poll() is None:
+                exiting.append((process, callback))
+            else:
+                self._ready.append((callback, (process,)))
+        self._exiting = exiting
+
+        for _ in range(len(self._ready)):
+            (callback, args) = self._ready.popleft()
+            callback(*args)
+
+
+def ensure_future(awaitable, loop=None):
+    '''
+    Return a :class:`Future` for the given awaitable, starting a task if it
+    is a coroutine.
+    '''
+    if loop is None:
+        loop = get_event_loop()
+    if isinstance(awaitable, Future):
+        return awaitable
+    elif isinstance(awaitable, types.GeneratorType):
+        return Task(awaitable, loop)
+    elif isinstance(awaitable, (list, tuple)):
+        return gather(*awaitable)
+    elif awaitable is None:
+        future = Future()
+        future.set_result(None)
+        return future
+    raise TypeError('%r is not awaitable.' % (awaitable,))
+
+
+def run(awaitable):
+    '''
+    Run the awaitable on a new :class:`EventLoop`, returning its result.
+    '''
+    return EventLoop().run_until_complete(awaitable)
+
+
+def sleep(seconds):
+    '''Return a future which finishes after the given number of seconds.'''
+    future = Future()
+    get_event_loop().call_later(seconds, future.set_result, None)
+    return future
+
+
+def gather(*awaitables):
+    '''
+    Run the awaitables concurrently, returning a future for the list of
+    their results. If any fail the future raises the first of their
+    exceptions once all have finished.
+    '''
+    loop = get_event_loop()
+    futures = [ensure_future(awaitable, loop) for awaitable in awaitables]
+    result = Future()
+    remaining = [len(futures)]
+
+    def finished(_):
+        remaining[0] -= 1
+        if remaining[0]:
+            return
+        for future in futures:
+            if future.exc_info() is not None:
+                result.set_exception(future.exc_info())
+                return
+        result.set_result([future._result for future in futures])
+
+    if not futures:
+        result.set_result([])
+    for future in futures:
+        future.add_done_callback(finished)
+    return result
+
+
+def wait_for(awaitable, timeout):
+    '''
+    Wait for the awaitable for at most timeout seconds. If it doesn't finish
+    in time its task is cancelled and :class:`TimeoutError` is raised.
+
+    :param timeout: Seconds to wait, None to wait forever.
+    '''
+    loop = get_event_loop()
+    future = ensure_future(awaitable, loop)
+    if timeout is None:
+        return future
+    result = Future()
+
+    def expire():
+        if future.done():
+            return
+        stack = None
+        if isinstance(future, Task):
+            stack = future.format_stack()
+            future.cancel()
+        result.set_exception(TimeoutError(timeout, stack))
+
+    timer = loop.call_later(timeout, expire)
+
+    def finished(_):
+        timer.cancel()
+        if result.done():
+            return
+        if future.exc_info() is not None:
+            result.set_exception(future.exc_info())
+        else:
+            result.set_result(future._result)
+
+    future.add_done_callback(finished)
+    return result
+
+
+class Semaphore(object):
+    '''
+    Limits the number of tasks which may run a section at once.
+
+    >>> yield semaphore.acquire()
+    >>> try:
+    ...     yield do_work()
+    ... finally:
+    ...     semaphore.release()
+    '''
+    def __init__(self, value=1):
+        self._value = value
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        '''Return a future which finishes once the semaphore is acquired.'''
+        future = Future()
+        if self._value > 0:
+            self._value -= 1
+            future.set_result(None)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def release(self):
+        if self._waiters:
+            self._waiters.popleft().set_result(None)
+        else:
+            self._value += 1
+
+
+class Lock(Semaphore):
+    '''A :class:`Semaphore` which one task may hold at a time.'''
+    def __init__(self):
+        super(Lock, self).__init__(1)
+
+
+def _kill(process):
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def log_call_async(command, *popenargs, **kwargs):
+    '''
+    Coroutine version of :func:`whimsy.helper.log_call`. Starts the command
+    and returns a future which finishes once it has exited, raising
+    :class:`CalledProcessError` if it failed.
+
+    The process is started in its own session and is killed if the task
+    which started it is cancelled.
+    '''
+    (process, cmdstr, stdout_sink, stderr_sink) = \
+            multiplex.popen(command, *popenargs, **kwargs)
+    _track_process(process)
+
+    loop = get_event_loop()
+    task = current_task()
+    if task is not None:
+        task.processes.append(process)
+    future = Future()
+    open_pipes = [2]
+
+    def exited(process):
+        _untrack_process(process)
+        if task is not None and process in task.processes:
+            task.processes.remove(process)
+        if future.done():
+            return
+        if process.returncode != 0:
+            future.set_exception(
+                    CalledProcessError(process.returncode, cmdstr))
+        else:
+            future.set_result(process.returncode)
+
+    def reader(pipe, sink):
+        fd = pipe.fileno()
+
+        def read():
+            data = os.read(fd, _read_size)
+            if data:
+                sink.write(data)
+                return
+            loop.remove_reader(fd)
+            pipe.close()
+            sink.close()
+            open_pipes[0] -= 1
+            if not open_pipes[0]:
+                loop.wait_process(process, exited)
+        return read
+
+    loop.add_reader(process.stdout.fileno(),
+                    reader(process.stdout, stdout_sink))
+    loop.add_reader(process.stderr.fileno(),
+                    reader(process.stderr, stderr_sink))
+    return future
@@ -0,0 +1,124 @@
+'''
+Streams the events of a run as JSON Lines with the --events option, so
+dashboards can follow a run as it happens rather than waiting for the JUnit
+report.
+
+An :class:`EventLogger` writes a JSON object on its own line for each event,
+flushing it as soon as it's written. Every object has the name of the
+event and the time it happened::
+
+    {"event":"begin","kind":"test","uid":"gem5/x86/hello","time":1500000000.1}
+    {"event":"outcome","kind":"test","uid":"gem5/x86/hello","outcome":"PASS",
+     "runtime":2.5,"reason":null,"timed_out":false,"time":1500000002.6}
+
+The events are:
+
+* ``begin_testing`` and ``end_testing`` at the start and end of the run.
+* ``started`` when a runner with workers starts a suite, with the
+  ``worker`` running it.
+* ``begin`` when a suite or test starts being reported, followed by its
+  ``outcome`` with its ``runtime`` and the ``reason`` it didn't pass.
+* ``skip`` for a test which was skipped along with the ``reason``.
+* ``fixture_setup`` with the ``fixture`` name, ``runtime`` and ``error``
+  if it failed, and ``fixture_teardown``.
+
+The path may be a FIFO, opening it waits for a reader.
+'''
+import json
+import threading
+import time
+
+from config import config
+from result import ResultLogger
+from suite import TestSuite
+
+# Created once, json.dumps creates an encoder each call given options. Keys
+# aren't sorted since that rules out the C encoder.
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+# Start of each line, the name and time of the event come first.
+_prefix = '{"event":"%s","time":%.6f'
+
+
+def _text(value):
+    '''Return value as text which can be encoded as JSON, None as is.'''
+    if value is None:
+        return None
+    if not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, str):
+        # Reasons may hold output which isn't UTF-8.
+        value = value.decode('utf-8', 'replace')
+    return value
+
+
+def _kind(item):
+    return 'suite' if isinstance(item, TestSuite) else 'test'
+
+
+class EventLogger(ResultLogger):
+    '''
+    :class:`whimsy.result.ResultLogger` which writes each event of the run
+    to a file stream as a line of JSON.
+    '''
+    def __init__(self, fstream):
+        self.fstream = fstream
+        self._items = []
+        # Fixtures may be setup by the --pipeline thread.
+        self._lock = threading.Lock()
+
+    def _write(self, event, **fields):
+        line = _prefix % (event, time.time())
+        if fields:
+            line += ',' + _encoder.encode(fields)[1:]
+        else:
+            line += '}'
+        line += '\n'
+        with self._lock:
+            self.fstream.write(line)
+            self.fstream.flush()
+
+    def begin_testing(self):
+        self._write('begin_testing')
+
+    def suite_started(self, test_suite, worker=None):
+        self._write('started', uid=test_suite.uid, worker=worker)
+
+    def begin(self, item):
+        self._items.append(item)
+        self._write('begin', kind=_kind(item), uid=item.uid)
+
+    def skip(self, item, reason=None, **kwargs):
+        self._write('skip', kind=_kind(item), uid=item.uid,
+                    reason=_text(reason))
+
+    def set_current_outcome(self, outcome, runtime=None, reason=None,
+                            timed_out=False, **kwargs):
+        item = self._items[-1]
+        self._write('outcome', kind=_kind(item), uid=item.uid,
+                    outcome=outcome.name, runtime=runtime,
+                    reason=_text(reason), timed_out=timed_out)
+
+    def end_current(self):
+        self._items.pop()
+
+    def fixture_setup(self, fixture, runtime, error=None):
+        self._write('fixture_setup', fixture=_text(fixture.name),
+                    runtime=runtime, error=_text(error))
+
+    def fixture_teardown(self, fixture):
+        self._write('fixture_teardown', fixture=_text(fixture.name))
+
+    def end_testing(self):
+        self._write('end_testing')
+        self.fstream.close()
+
+
+def event_loggers():
+    '''
+    Return a tuple of the result loggers which should be added to a run,
+    empty if there is no --events path.
+    '''
+    if config.events is None:
+        return ()
+    return (EventLogger(open(config.events, 'w')),)
@@ -1,7 +1,17 @@
 '''
-Exposes the :class:`~Fixture` class.
+Exposes the :class:`~Fixture` class and :func:`setup_fixtures`, which sets up
+a collection of fixtures and their requirements, running independent setups
+concurrently. :func:`setup_fixtures_async` does the same on
+a :class:`whimsy.eventloop.EventLoop`.
 '''
-from helper import cacheresult
+import Queue
+import threading
+import traceback
+
+from eventloop import Return, ensure_future
+from helper import cacheresult, OrderedSet
+from logger import log
+from _util import Timer
 
 class Fixture(object):
     '''
@@ -65,10 +75,31 @@ class Fixture(object):
         other_fixture.required_by.append(self)
 
     def setup(self):
-        '''Call setup of fixtures we require.'''
+        '''Call setup of fixtures we require which are not yet built.'''
+        self._built = True
+        for fixture in self.requires:
+            if not fixture.built:
+                fixture.setup()
+
+    def setup_async(self):
+        '''
+        Coroutine version of :func:`setup` used when fixtures are setup on
+        an event loop (see :mod:`whimsy.eventloop`). Fixtures which spend
+        their setup waiting on subprocesses should override this so other
+        tasks can run meanwhile, by default it calls :func:`setup`.
+        '''
+        self.setup()
+        yield
+
+    def setup_requires_async(self):
+        '''
+        Coroutine version of :meth:`Fixture.setup` for overrides of
+        :func:`setup_async` to call.
+        '''
         self._built = True
         for fixture in self.requires:
-            fixture.setup()
+            if not fixture.built:
+                yield fixture.setup_async()
 
     def teardown(self):
         '''Empty method, meant to be overriden if fixture requires teardown.'''
@@ -78,3 +109,183 @@ class Fixture(object):
         # This is a method that will be created by the test loader in order to
         # manually remove a fixture.
         __no_collect__ = NotImplemented
+
+
+class FixtureSetupError(Exception):
+    '''Signals that a fixture could not be setup since a requirement failed.'''
+
+
+# Timeout used when waiting for a fixture to finish setup.
+_wait_timeout = 60 * 60 * 24 * 365
+
+def _setup_fixture(fixture):
+    '''
+    Setup the given fixture.
+
+    :returns: A tuple :code:`(fixture, runtime, error)` where error is None
+        or the formatted traceback of the failure.
+    '''
+    timer = Timer()
+    timer.start()
+    error = None
+    try:
+        fixture.setup()
+    except Exception:
+        error = traceback.format_exc()
+    return (fixture, timer.stop(), error)
+
+
+def _setup_fixture_async(fixture):
+    '''Coroutine version of :func:`_setup_fixture`.'''
+    timer = Timer()
+    timer.start()
+    error = None
+    try:
+        yield fixture.setup_async()
+    except Exception:
+        error = traceback.format_exc()
+    raise Return((fixture, timer.stop(), error))
+
+
+def _log_setup(result):
+    (fixture, runtime, error) = result
+    if error is None:
+        log.info('Setup fixture %s in %.2f seconds' % (fixture.name, runtime))
+    else:
+        log.info('Failed to setup fixture %s' % fixture.name)
+
+
+def _unbuilt_requirements(fixtures):
+    '''
+    Return an OrderedSet of the unbuilt fixtures and the unbuilt fixtures
+    they transitively require.
+    '''
+    nodes = OrderedSet()
+    stack = [fixture for fixture in fixtures if not fixture.built]
+    while stack:
+        fixture = stack.pop()
+        if fixture not in nodes:
+            nodes.add(fixture)
+            stack.extend(req for req in fixture.requires if not req.built)
+    return nodes
+
+
+def _setup_worker(work, done):
+    for fixture in iter(work.get, None):
+        done.put(_setup_fixture(fixture))
+
+
+def setup_fixtures(fixtures, threads=1):
+    '''
+    Setup the given fixtures along with any unbuilt fixtures they require.
+
+    A graph is built from the :code:`requires` and :code:`required_by`
+    attributes of the fixtures. A fixture is only setup once all fixtures it
+    requires have been setup, but fixtures which do not depend on each other
+    are setup concurrently on up to `threads` threads. If a fixture fails to
+    setup, fixtures which require it are not setup and fail as well.
+
+    :param fixtures: Iterable of fixtures to setup. Fixtures which are already
+        built are ignored.
+
+    :param threads: Maximum number of fixtures to setup at once.
+
+    :returns: A list of :code:`(fixture, runtime, error)` tuples in the order
+        fixtures finished, error is None if the fixture was setup successfully
+        otherwise a string describing the failure.
+    '''
+    nodes = _unbuilt_requirements(fixtures)
+    waiting_on = {fixture: set(req for req in fixture.requires
+                               if req in nodes)
+                  for fixture in nodes}
+    ready = [fixture for fixture in nodes if not waiting_on[fixture]]
+    results = []
+
+    def finish(result):
+        (fixture, runtime, error) = result
+        results.append(result)
+        _log_setup(result)
+        for dependent in fixture.required_by:
+            if dependent not in waiting_on:
+                continue
+            if error is None:
+                waiting_on[dependent].discard(fixture)
+                if not waiting_on[dependent]:
+                    ready.append(dependent)
+            else:
+                # Fail the dependent along with everything depending on it.
+                del waiting_on[dependent]
+                finish((dependent, 0, 'Required fixture %s failed to setup.'
+                        % fixture.name))
+        waiting_on.pop(fixture, None)
+
+    if threads <= 1:
+        while ready:
+            finish(_setup_fixture(ready.pop(0)))
+        return results
+
+    work = Queue.Queue()
+    done = Queue.Queue()
+    workers = [threading.Thread(target=_setup_worker, args=(work, done))
+               for _ in range(min(threads, len(nodes)))]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+
+    running = 0
+    try:
+        while ready or running:
+            while ready:
+                work.put(ready.pop(0))
+                running += 1
+            # Python2 ignores interrupts while waiting without a timeout.
+            finish(done.get(True, _wait_timeout))
+            running -= 1
+    finally:
+        for worker in workers:
+            work.put(None)
+    return results
+
+
+# Dictionary mapping fixture->Task of setups in progress on an event loop.
+_setups_in_progress = {}
+
+def setup_fixtures_async(fixtures):
+    '''
+    Coroutine version of :func:`setup_fixtures`. Fixtures are setup with
+    their :func:`Fixture.setup_async` as tasks on the running event loop,
+    each starting once the fixtures it requires have been setup.
+
+    A fixture which another task is already setting up is waited on rather
+    than setup again, so concurrent suites sharing a fixture (e.g. a gem5
+    binary) only build it once.
+
+    :returns: The same list as :func:`setup_fixtures`.
+    '''
+    nodes = _unbuilt_requirements(fixtures)
+    tasks = {}
+    results = []
+
+    def setup(fixture):
+        for required in fixture.requires:
+            if required in tasks:
+                (_, _, error) = yield tasks[required]
+                if error is not None:
+                    result = (fixture, 0, 'Required fixture %s failed to'
+                              ' setup.' % required.name)
+                    break
+        else:
+            setup_task = _setups_in_progress.get(fixture)
+            if setup_task is None:
+                setup_task = ensure_future(_setup_fixture_async(fixture))
+                _setups_in_progress[fixture] = setup_task
+            result = yield setup_task
+            _setups_in_progress.pop(fixture, None)
+        _log_setup(result)
+        results.append(result)
+        raise Return(result)
+
+    for fixture in nodes:
+        tasks[fixture] = ensure_future(setup(fixture))
+    yield list(tasks.values())
+    raise Return(results)
@@ -1,6 +1,8 @@
 import os
 import tempfile
+import threading
 
+from ..eventloop import Lock, log_call_async
 from ..fixture import Fixture
 from ..config import config, constants
 from ..helper import log_call, cacheresult, joinpath, absdirpath
@@ -31,6 +33,13 @@ class SConsFixture(Fixture):
     about to be ran, then will invocate a single instance of SCons for all
     targets.
 
+    If the --pipeline flag was given, targets are instead built one at a time
+    as each :class:`SConsTarget` is setup so tests can start running as soon as
+    their own target is built.
+
+    When setup on an event loop with :func:`setup_async`, scons runs as a
+    subprocess of the loop so other tasks keep running during the build.
+
     :param directory: The directory which scons will -C (cd) into before
     executing. If None is provided, will choose the config base_dir.
     '''
@@ -38,14 +47,44 @@ class SConsFixture(Fixture):
         super(SConsFixture, self).__init__(name, *args, lazy_init=True)
         self.directory = directory if directory else config.base_dir
         self.targets = []
+        # SCons can't safely run more than once at a time in the same tree.
+        self._lock = threading.Lock()
+        self._async_lock = Lock()
 
     @cacheresult
     def setup(self):
         super(SConsFixture, self).setup()
-        targets = set(self.required_by)
+        if config.skip_build:
+            log.debug('Skipping build of %s' % self.name)
+        elif not config.pipeline:
+            self.build(set(self.required_by))
+
+    def setup_async(self):
+        if self.built:
+            return
+        yield self.setup_requires_async()
+        if config.skip_build:
+            log.debug('Skipping build of %s' % self.name)
+        elif not config.pipeline:
+            yield self.build_async(set(self.required_by))
+
+    def _command(self, targets):
         command = ['scons', '-C', self.directory, '-j', str(config.threads)]
         command.extend([target.target for target in targets])
-        log_call(command)
+        return command
+
+    def build(self, targets):
+        '''Invocate scons to build the given SConsTarget objects.'''
+        with self._lock:
+            log_call(self._command(targets))
+
+    def build_async(self, targets):
+        '''Coroutine version of :func:`build`.'''
+        yield self._async_lock.acquire()
+        try:
+            yield log_call_async(self._command(targets))
+        finally:
+            self._async_lock.release()
 
     def teardown(self):
         pass
@@ -81,9 +120,19 @@ class SConsTarget(Fixture):
 
     def setup(self):
         super(SConsTarget, self).setup()
-        self.invocation.setup()
+        if not self.invocation.built:
+            self.invocation.setup()
+        if config.pipeline and not config.skip_build:
+            self.invocation.build((self,))
         return self
 
+    def setup_async(self):
+        yield self.setup_requires_async()
+        if not self.invocation.built:
+            yield self.invocation.setup_async()
+        if config.pipeline and not config.skip_build:
+            yield self.invocation.build_async((self,))
+
 class Gem5Fixture(SConsTarget):
     def __init__(self, isa, optimization):
         target = joinpath(isa.upper(), 'gem5.%s' % optimization)
@@ -99,6 +148,12 @@ class Gem5Fixture(SConsTarget):
         else:
             super(Gem5Fixture, self).setup()
 
+    def setup_async(self):
+        if config.skip_build:
+            log.debug('Skipping build of %s' % self.target)
+        else:
+            yield super(Gem5Fixture, self).setup_async()
+
 
 class MakeFixture(Fixture):
     def __init__(self, directory, *args, **kwargs):
@@ -111,10 +166,19 @@ class MakeFixture(Fixture):
 
     def setup(self):
         super(MakeFixture, self).setup()
+        log_call(self._command())
+
+    def setup_async(self):
+        if self.built:
+            return
+        yield self.setup_requires_async()
+        yield log_call_async(self._command())
+
+    def _command(self):
         targets = set(self.required_by)
         command = ['make', '-C', self.directory]
         command.extend([target.target for target in targets])
-        log_call(command)
+        return command
 
 
 class MakeTarget(Fixture):
@@ -141,9 +205,13 @@ class MakeTarget(Fixture):
 
     def setup(self):
         super(MakeTarget, self).setup()
-        self.make_fixture.setup()
+        if not self.make_fixture.built:
+            self.make_fixture.setup()
         return self
 
+    def setup_async(self):
+        yield self.setup_requires_async()
+
 class TestProgram(MakeTarget):
     def __init__(self, program, isa, os, recompile=False):
         make_dir = joinpath('test-progs', program)
@@ -160,3 +228,7 @@ class TestProgram(MakeTarget):
             super(MakeTarget, self).setup()
         elif not os.path.exists(self.path):
             super(MakeTarget, self).setup()
+
+    def setup_async(self):
+        if self.recompile or not os.path.exists(self.path):
+            yield self.setup_requires_async()
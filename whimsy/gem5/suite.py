@@ -3,7 +3,8 @@ import copy
 
 from ..test import TestFunction
 from ..suite import TestList, TestSuite
-from ..helper import log_call, CalledProcessError
+from ..eventloop import log_call_async
+from ..helper import CalledProcessError
 from ..config import constants, config
 from ..loader import no_collect
 from fixture import TempdirFixture, Gem5Fixture, VariableFixture
@@ -17,7 +18,9 @@ def gem5_verify_config(name,
                        tags=[],
                        fixtures=[],
                        valid_isas=constants.supported_isas,
-                       valid_optimizations=constants.supported_optimizations):
+                       valid_optimizations=constants.supported_optimizations,
+                       resources=None,
+                       timeout=None):
     '''
     Helper class to generate common gem5 tests using verifiers.
 
@@ -42,6 +45,11 @@ def gem5_verify_config(name,
 
     :param valid_optimizations: An interable with the optimization levels that
     this test can be ran for. (E.g. opt, debug)
+
+    :param resources: :class:`whimsy.suite.Resources` expected to be used by
+    the gem5 run. (E.g. cpus, memory and duration of a full-system boot.)
+
+    :param timeout: Seconds the gem5 run may take before it is killed.
     '''
     for verifier in verifiers:
         no_collect(verifier)
@@ -71,7 +79,10 @@ def gem5_verify_config(name,
             # this is listed first.
             gem5_subtest = TestFunction(
                     _create_test_run_gem5(config, config_args, gem5_args),
-                    name=_name)
+                    name=_name,
+                    resources=resources,
+                    timeout=timeout,
+                    coroutine=True)
 
             # Create copies of the verifier subtests for this isa and
             # optimization.
@@ -84,8 +95,10 @@ def gem5_verify_config(name,
 
                 verifier_tests.append(verifier)
 
-            # Place the verifier subtests into a collection.
-            verifier_collection = TestList(verifier_tests, fail_fast=False)
+            # Place the verifier subtests into a collection. Verifiers only
+            # read the output of the gem5 run so they can run concurrently.
+            verifier_collection = TestList(verifier_tests, fail_fast=False,
+                                           concurrent=True)
 
             # Create the gem5 target for the specific architecture and
             # optimization level.
@@ -117,6 +130,7 @@ def _create_test_run_gem5(config, config_args, gem5_args):
     def test_run_gem5(fixtures):
         '''
         Simple \'test\' which runs gem5 and saves the result into a tempdir.
+        This is a coroutine so many gem5 runs can wait on the same event loop.
 
         NOTE: Requires fixtures: tempdir, gem5
         '''
@@ -152,7 +166,7 @@ def _create_test_run_gem5(config, config_args, gem5_args):
         # Config_args should set up the program args.
         command.extend(config_args)
         try:
-            log_call(command)
+            yield log_call_async(command)
         except CalledProcessError as e:
             returncode.value = e.returncode
             if e.returncode != 1:
@@ -6,6 +6,9 @@ Helper classes for writing tests with this test library.
     `subprocess.check_call()` but will pipe output to the
     log at a low verbosity level.
 
+* :func:`start_call`, :func:`wait_calls`
+    Start many processes like :func:`log_call` and wait on them together.
+
 * :func:`cacheresult`
     A function decorator which will cache results for a function given the
     same arguments. (A poor man's python3 `lru_cache`.)
@@ -22,11 +25,13 @@ Helper classes for writing tests with this test library.
 * :func:`mkdir_p`
     Same thing as mkdir -p
 '''
+import atexit
 import errno
-import subprocess
+import signal
 import tempfile
+import time
 import os
-from threading import Thread
+import threading
 from collections import MutableSet
 
 # We will export CalledProcessError
@@ -36,9 +41,11 @@ from subprocess import CalledProcessError
 # everyone has python 2.7
 from collections import OrderedDict
 
-import logger
+import multiplex
 __all__ = [
         'log_call',
+        'start_call',
+        'wait_calls',
         'CalledProcessError',
         'mkdir_p',
         'cacheresult',
@@ -49,6 +56,126 @@ __all__ = [
         ]
 
 
+# Seconds to wait after asking the remaining subprocesses to terminate at
+# exit before killing them.
+exit_grace_period = 2
+
+_processes_lock = threading.Lock()
+# Dictionary mapping thread ident->list of Popen objects started by
+# log_call in that thread which are still running.
+_processes = {}
+
+
+def running_processes(ident):
+    '''
+    Return a list of the processes started by :func:`log_call` in the thread
+    with the given ident which are still running. Used by
+    :class:`whimsy.watchdog.Watchdog` to kill the processes of a test which
+    timed out.
+    '''
+    with _processes_lock:
+        return [process for process in _processes.get(ident, ())
+                if process.poll() is None]
+
+
+def _signal_groups(processes, signum):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signum)
+        except OSError:
+            pass
+
+
+def terminate_processes():
+    '''
+    Terminate the process groups of every process started by
+    :func:`log_call` which is still running, killing them if they are still
+    running after :data:`exit_grace_period` seconds.
+
+    Processes are started in their own session, so unlike the rest of the
+    foreground process group they don't receive the SIGINT of a Ctrl-C, or
+    a signal sent to the whole group. This is called on an interrupt, on a
+    SIGTERM or SIGHUP, at exit, and when a --jobs worker is terminated so
+    they are not left running.
+    '''
+    with _processes_lock:
+        processes = [process for processes in _processes.values()
+                     for process in processes if process.poll() is None]
+    if not processes:
+        return
+    _signal_groups(processes, signal.SIGTERM)
+    deadline = time.time() + exit_grace_period
+    while time.time() < deadline \
+            and any(process.poll() is None for process in processes):
+        time.sleep(0.05)
+    # Children of a process which exited may still be in its group.
+    _signal_groups(processes, signal.SIGKILL)
+
+atexit.register(terminate_processes)
+
+
+def _track_process(process):
+    with _processes_lock:
+        processes = _processes.setdefault(threading.current_thread().ident,
+                                          [])
+        # Processes of start_call which were never waited on are dropped
+        # once they exit.
+        processes[:] = [p for p in processes if p.poll() is None]
+        processes.append(process)
+
+
+def _untrack_process(process):
+    ident = threading.current_thread().ident
+    with _processes_lock:
+        processes = _processes.get(ident, [])
+        if process in processes:
+            processes.remove(process)
+        if not processes:
+            _processes.pop(ident, None)
+
+
+def start_call(command, *popenargs, **kwargs):
+    '''
+    Start the given command like :func:`log_call` but without waiting for
+    it, so many processes can be started and waited on together with
+    :func:`wait_calls`.
+
+    The output of every process is read by a single
+    :class:`whimsy.multiplex.ProcessMultiplexer` thread rather than by
+    threads of its own.
+
+    :returns: A :class:`whimsy.multiplex.ProcessHandle` to wait on.
+    '''
+    (process, cmdstr, stdout_sink, stderr_sink) = \
+            multiplex.popen(command, *popenargs, **kwargs)
+    _track_process(process)
+    return multiplex.multiplexer().add(process, cmdstr,
+                                       stdout_sink, stderr_sink)
+
+
+def wait_calls(handles):
+    '''
+    Wait for all of the processes started by :func:`start_call`.
+
+    :raises CalledProcessError: Of the first process which failed, once all
+        have exited.
+    '''
+    failure = None
+    for handle in handles:
+        try:
+            handle.wait()
+        except CalledProcessError as e:
+            if failure is None:
+                failure = e
+        finally:
+            # Keep processes we stopped waiting on (e.g. on an interrupt)
+            # tracked so they can still be terminated.
+            if handle.process.poll() is not None:
+                _untrack_process(handle.process)
+    if failure is not None:
+        raise failure
+
+
 def log_call(command, *popenargs, **kwargs):
     '''
     Calls the given process and automatically logs the command and output.
@@ -56,55 +183,22 @@ def log_call(command, *popenargs, **kwargs):
     If stdout or stderr are provided output will also be piped into those
     streams as well.
 
+    The process is started in its own session (and so process group) so that
+    it and any children it starts can be killed if the calling test times
+    out. It is then also killed by :func:`terminate_processes` if whimsy is
+    interrupted or exits while it is running.
+
+    If the calling thread's output is captured by
+    :func:`whimsy.capture.thread_capture`, the output of the process is
+    written to its files rather than logged.
+
     :params stdout: Iterable of items to write to as we read from the
         subprocess.
 
     :params stderr: Iterable of items to write to as we read from the
         subprocess.
     '''
-    if isinstance(command, str):
-        cmdstr = command
-    else:
-        cmdstr = ' '.join(command)
-
-    logger.log.trace('Logging call to command: %s' % cmdstr)
-
-    stdout_redirect = kwargs.get('stdout', tuple())
-    stderr_redirect = kwargs.get('stderr', tuple())
-
-    if hasattr(stdout_redirect, 'write'):
-        stdout_redirect = (stdout_redirect,)
-    if hasattr(stderr_redirect, 'write'):
-        stderr_redirect = (stderr_redirect,)
-
-    kwargs['stdout'] = subprocess.PIPE
-    kwargs['stderr'] = subprocess.PIPE
-    p = subprocess.Popen(command, *popenargs, **kwargs)
-
-    def log_output(log_level, pipe, redirects=tuple()):
-        # Read iteractively, don't allow input to fill the pipe.
-        for line in iter(pipe.readline, ''):
-            for r in redirects:
-                r.write(line)
-            line = line.rstrip()
-            logger.log.log(log_level, line)
-
-    stdout_thread = Thread(target=log_output,
-                           args=(logger.TRACE, p.stdout, stdout_redirect))
-    stdout_thread.setDaemon(True)
-    stderr_thread = Thread(target=log_output,
-                           args=(logger.TRACE, p.stderr, stderr_redirect))
-    stderr_thread.setDaemon(True)
-
-    stdout_thread.start()
-    stderr_thread.start()
-
-    retval = p.wait()
-    stdout_thread.join()
-    stderr_thread.join()
-    # Return the return exit code of the process.
-    if retval != 0:
-        raise CalledProcessError(retval, cmdstr)
+    wait_calls((start_call(command, *popenargs, **kwargs),))
 
 
 # lru_cache stuff (Introduced in python 3.2+)
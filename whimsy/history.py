@@ -0,0 +1,122 @@
+'''
+Provides access to the results of previous test runs so they can be used to
+guide how future runs are scheduled.
+
+Results of the last run are read back out of the internal pickle file written
+by :class:`whimsy.result.InternalLogger`, or those of every run kept in the
+--history-db database if one was given (see :mod:`whimsy.store`).
+'''
+import math
+import os
+
+from config import config, constants
+from helper import joinpath
+from logger import log
+from result import InternalLogger, Outcome
+import store
+
+
+class ResultHistory(object):
+    '''
+    Runtimes and outcomes of previously ran test items, keyed by uid.
+
+    :var runtimes: Dictionary mapping uid->runtime in seconds.
+    :var outcomes: Dictionary mapping uid->:class:`Outcome`.
+    :var samples: Dictionary mapping uid->list of every runtime recorded.
+    '''
+    def __init__(self, results=tuple()):
+        '''
+        :param results: Iterable of :class:`whimsy.result.TestResult`
+            objects, later results for the same uid override earlier ones.
+        '''
+        self.runtimes = {}
+        self.outcomes = {}
+        self.samples = {}
+        for result in results:
+            self.add(result)
+
+    def add(self, result):
+        '''Record the given TestResult.'''
+        # Unpickled outcomes are copies, use our own instance of the enum.
+        self.add_sample(result.uid, result.runtime,
+                        Outcome.enums[result.outcome.val])
+
+    def add_sample(self, uid, runtime, outcome):
+        '''Record a runtime and :class:`Outcome` of the item with uid.'''
+        self.runtimes[uid] = runtime
+        self.samples.setdefault(uid, []).append(runtime)
+        self.outcomes[uid] = outcome
+
+    def runtime(self, uid, default=None):
+        '''Return the last recorded runtime of the item with the given uid.'''
+        return self.runtimes.get(uid, default)
+
+    def percentile(self, uid, percentile, default=None):
+        '''
+        Return the given percentile (0-100) of the recorded runtimes of the
+        item with the given uid, using the nearest rank.
+        '''
+        samples = self.samples.get(uid)
+        if not samples:
+            return default
+        samples = sorted(samples)
+        rank = int(math.ceil(percentile / 100.0 * len(samples)))
+        return samples[min(max(rank, 1), len(samples)) - 1]
+
+    def outcome(self, uid, default=None):
+        '''Return the last recorded outcome of the item with the given uid.'''
+        return self.outcomes.get(uid, default)
+
+    def __len__(self):
+        return len(self.runtimes)
+
+
+def load_history(result_path=None):
+    '''
+    Load the results of the previous run stored in result_path.
+
+    :param result_path: Directory results were saved in. If None, uses the
+        --history-db database if given, otherwise the config's result_path.
+
+    :returns: A :class:`ResultHistory`, empty if there were no readable
+        results.
+    '''
+    if result_path is None and config.history_db is not None \
+            and os.path.exists(config.history_db):
+        return load_stored_history()
+    if result_path is None:
+        result_path = config.result_path
+    path = joinpath(result_path, constants.pickle_filename)
+    if not os.path.exists(path):
+        return ResultHistory()
+
+    try:
+        with open(path, 'rb') as fstream:
+            results = InternalLogger.load(fstream).results
+    except Exception as e:
+        log.warn('Unable to load previous results from %s: %s' % (path, e))
+        return ResultHistory()
+    return ResultHistory(results)
+
+
+def load_stored_history():
+    '''
+    Load the results of every run kept in the --history-db database.
+
+    :returns: A :class:`ResultHistory`, empty if the database couldn't be
+        read.
+    '''
+    outcomes = {outcome.name: outcome for outcome in Outcome.enums}
+    history = ResultHistory()
+    try:
+        result_store = store.open_store()
+        try:
+            for (uid, outcome, runtime) in result_store.samples():
+                history.add_sample(uid, runtime, outcomes.get(outcome))
+        finally:
+            result_store.close()
+    except Exception as e:
+        log.warn('Unable to load previous results from %s: %s'
+                 % (config.history_db, e))
+        return ResultHistory()
+    return history
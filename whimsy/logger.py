@@ -1,13 +1,27 @@
 '''
 Provides a common logging system. With ability to add additional logging
 levels.
+
+With the --async-logging flag, :func:`start_queue` replaces the console
+handler with a :class:`QueueHandler` which only puts records on a queue. A
+:class:`LogWriter` thread formats and writes them, so logging never waits on
+a slow terminal. Processes forked from this one (the --jobs workers) send
+their records back to the writer, so parallel runs share one ordered console
+stream. The queue is flushed at exit, when a FATAL record is logged, and
+before :mod:`whimsy.capture` switches the test output is captured into.
 '''
 # TODO: Should add a debug flag system.
 
+import atexit
 import logging as _logging
+import multiprocessing
+import os
 import sys
+import threading
+import Queue
 
 import terminal
+import tee
 
 # Logging level to be used to always display information to the user
 def add_logging_level(name, val):
@@ -81,3 +95,165 @@ saved_stdout = sys.stdout
 stdout_logger = _logging.StreamHandler(saved_stdout)
 stdout_logger.formatter = ConsoleLogFormatter()
 log.addHandler(stdout_logger)
+
+
+# Timeout used while waiting for the writer. Python2 ignores interrupts while
+# waiting without a timeout.
+_wait_timeout = 0.5
+
+# Callables returning True while the output of this process is captured into
+# the files of a test, see :func:`add_capture_check`.
+_capture_checks = []
+
+
+def add_capture_check(check):
+    '''
+    Register a callable which returns True while output written by this
+    process is captured into the files of a test. A forked process handles
+    its records itself rather than sending them to the :class:`LogWriter`
+    while any check returns True, so they are captured with the test.
+    '''
+    _capture_checks.append(check)
+
+
+def capturing():
+    '''
+    Return True if output written by this process is captured into the files
+    of a test, see :func:`add_capture_check`.
+    '''
+    return any(check() for check in _capture_checks)
+
+
+class LogWriter(object):
+    '''
+    Threads which handle the records put on a queue by :class:`QueueHandler`
+    with the console handler, in the order they were logged.
+
+    Records of processes forked after the writer was created arrive on a
+    separate queue, so a worker killed while writing to it can't hold up the
+    records of this process.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self._forwarded = multiprocessing.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        receiver = threading.Thread(target=self._receive)
+        receiver.setDaemon(True)
+        receiver.start()
+
+    def forward(self, record):
+        '''Send a record logged by a forked process to the writer.'''
+        # Arguments and exceptions may not pickle, the console formatter
+        # only needs the message.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self._forwarded.put(record)
+
+    def flush(self):
+        '''Wait until every record put on the queue has been handled.'''
+        if self._thread is None or os.getpid() != self.pid:
+            return
+        done = threading.Event()
+        self.queue.put(('flush', done))
+        while not done.wait(_wait_timeout):
+            pass
+
+    def stop(self):
+        if self._thread is None or os.getpid() != self.pid:
+            return
+        self.flush()
+        self.queue.put(('stop', None))
+        self._thread.join()
+        self._thread = None
+
+    def _write(self):
+        while True:
+            (task, arg) = self.queue.get()
+            if task == 'stop':
+                return
+            if task == 'flush':
+                arg.set()
+                continue
+            self.handler.handle(arg)
+
+    def _receive(self):
+        while True:
+            self.queue.put(('record', self._forwarded.get()))
+
+
+class QueueHandler(_logging.Handler):
+    '''
+    Handler which only puts records on the queue of a :class:`LogWriter`.
+
+    Records logged by a thread captured by
+    :func:`whimsy.capture.thread_capture` are handled immediately, the
+    console handler writes them to the thread's files. So are those of
+    a forked process while its output is captured.
+    '''
+    def __init__(self, writer):
+        _logging.Handler.__init__(self)
+        self.writer = writer
+
+    def handle(self, record):
+        # No need for the handler lock, the queue has its own.
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        writer = self.writer
+        if tee.current_capture() is not None:
+            writer.handler.handle(record)
+        elif os.getpid() == writer.pid:
+            writer.queue.put(('record', record))
+            if record.levelno == FATAL:
+                writer.flush()
+        elif capturing():
+            writer.handler.handle(record)
+        else:
+            writer.forward(record)
+
+
+_writer = None
+
+
+def start_queue():
+    '''
+    Hand records logged to the console over to a :class:`LogWriter` thread
+    until :func:`stop_queue` is called or the program exits.
+    '''
+    global _writer
+    if _writer is not None:
+        return
+    _writer = LogWriter(stdout_logger)
+    _writer.start()
+    log.removeHandler(stdout_logger)
+    log.addHandler(QueueHandler(_writer))
+    atexit.register(stop_queue)
+
+
+def stop_queue():
+    '''Write any queued records and log to the console directly again.'''
+    global _writer
+    if _writer is None or os.getpid() != _writer.pid:
+        return
+    _writer.stop()
+    for handler in list(log.handlers):
+        if isinstance(handler, QueueHandler):
+            log.removeHandler(handler)
+    log.addHandler(stdout_logger)
+    _writer = None
+
+
+def flush():
+    '''Wait for any queued records to be written.'''
+    if _writer is not None:
+        _writer.flush()
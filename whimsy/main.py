@@ -9,23 +9,54 @@ There are three commands which this program handles:
 
 * run - By default will search for and run all tests in the current
     and children directories reporting the results through the terminal,
-    saving them to a pickle file, and saving them to a junit file.
+    saving them to a pickle file, and saving them to a junit file. Given
+    ``-j N`` suites will be spread across N worker processes.
 
 * rerun - Load all tests and then rerun the tests which failed in the previous
     run.
 
 * list  - List tests with various querying options.
+
+* coordinator - Load tests and hand out suites to any number of workers,
+    collecting their results as the run command would.
+
+* worker - Connect to a coordinator and run the suites it hands out.
+
+* show-output - Show the output captured for a test in the previous run,
+    whether it was stored in its own files or with ``--output-archive``.
+
+* history - Query the results of previous runs kept with ``--history-db``.
+
+* merge - Merge the results of several runs, such as shards run on different
+    machines, into one result path.
 '''
+import os
+import signal
+import sys
+
+import archive
+import events
 import logger
+import merge
+import progress
 import query
 import result
+import resultfile
+import schedule
+import staging
+import store
 
-from helper import joinpath, mkdir_p
-from config import config
+from helper import joinpath, mkdir_p, terminate_processes
+from config import config, constants
+from coroutine import CoroutineRunner
+from distributed import CoordinatorRunner, run_worker
+from history import ResultHistory, load_history
 from loader import TestLoader
 from logger import log
+from parallel import ParallelRunner
 from runner import Runner
 from terminal import separator
+from watchdog import TimeoutPolicy
 
 # TODO: Standardize separator usage.
 # Probably make it the caller responsiblity to place separators and internal
@@ -42,6 +73,91 @@ def load_tests():
     testloader.load_root(config.directory)
     return testloader
 
+def create_runner(suites, loggers=tuple(), timeouts=None):
+    '''
+    Create the runner for the given suites, using a worker pool if more than
+    one job was requested or an event loop if more than one coroutine was.
+    '''
+    if config.jobs > 1:
+        runner = ParallelRunner(suites, loggers, jobs=config.jobs)
+    elif config.coroutines > 1:
+        runner = CoroutineRunner(suites, loggers,
+                                 coroutines=config.coroutines)
+    else:
+        runner = Runner(suites, loggers)
+    if timeouts is not None:
+        runner.timeouts = timeouts
+    return runner
+
+def console_logger(suites):
+    '''
+    Create the logger which reports results to the console, showing the
+    progress of the run with the --progress flag.
+    '''
+    if config.progress:
+        return progress.ProgressLogger(suites, load_history())
+    return result.ConsoleLogger()
+
+def timeout_policy():
+    '''
+    Create the timeout policy given by the config, loading the previous
+    results if timeouts are derived from them.
+    '''
+    history = None
+    if config.timeout_percentile is not None:
+        history = load_history()
+    return TimeoutPolicy.from_config(history)
+
+def order_suites(suites):
+    '''
+    Order the suites using the config's ordering policy.
+    '''
+    if config.order == schedule.default_ordering_policy:
+        return suites
+    return schedule.order_suites(suites, config.order, load_history())
+
+def shard_history():
+    '''
+    Return the history shards are balanced with. Only the --shard-history
+    is used, the result path and --history-db change with every shard which
+    is ran so shards computed from them would not partition the suites.
+    '''
+    if config.shard_history is None:
+        return ResultHistory()
+    return load_history(config.shard_history)
+
+def select_shard(suites):
+    '''
+    Return the suites in the shard given by the config, or all suites if
+    there is no shard.
+    '''
+    if config.shard is None:
+        return suites
+    suites = schedule.select_shard(suites, config.shard, shard_history())
+    log.display('Running %d suites in shard %d/%d' % ((len(suites),)
+                                                      + config.shard))
+    return suites
+
+def resumed_results():
+    '''
+    Return the results of the suites which finished in the run being
+    resumed, in the order they finished.
+    '''
+    path = joinpath(config.result_path, constants.pickle_filename)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as fstream:
+        return list(resultfile.ResultReader(fstream).suites())
+
+def result_file_path():
+    '''
+    Return the path to write the result file to. A resumed run writes a new
+    file which replaces the old one once it holds the finished suites, see
+    :func:`whimsy.result.InternalLogger.resume`.
+    '''
+    path = joinpath(config.result_path, constants.pickle_filename)
+    return path + '.resume' if config.resume else path
+
 def dorun():
     '''
     Handle the `run` command.
@@ -55,15 +171,38 @@ def dorun():
     else:
         suites = loader.suites
 
+    # Select our shard and order suites using the previous results before we
+    # overwrite them.
+    suites = select_shard(suites)
+    suites = order_suites(suites)
+    timeouts = timeout_policy()
+
+    resumed = []
+    if config.resume:
+        # Only run the suites without results, keeping their outputs.
+        resumed = resumed_results()
+        finished = set(suite_result.uid for suite_result in resumed)
+        suites = [suite for suite in suites if suite.uid not in finished]
+        log.display('Resuming, %d suites already finished and %d remain.'
+                    % (len(resumed), len(suites)))
+    console = console_logger(suites)
+
     # Create directory to save junit and internal results in.
     mkdir_p(config.result_path)
+    if not config.resume:
+        archive.clear()
 
-    with open(joinpath(config.result_path, 'pickle'), 'w') as result_file,\
-         open(joinpath(config.result_path, 'junit.xml'), 'w') as junit_f:
+    with staging.staged_results() as staging_loggers, \
+         open(result_file_path(), 'wb') as result_file,\
+         open(joinpath(config.result_path, constants.junit_filename), 'w')\
+            as junit_f:
 
         junit_logger = result.JUnitLogger(junit_f, result_file)
-        console_logger = result.ConsoleLogger()
-        loggers = (junit_logger, console_logger)
+        if config.resume:
+            junit_logger.resume(resumed, replace=joinpath(
+                    config.result_path, constants.pickle_filename))
+        loggers = (junit_logger, console) + staging_loggers \
+                + store.store_loggers() + events.event_loggers()
 
         log.display(separator())
         log.bold('Running Tests')
@@ -72,31 +211,86 @@ def dorun():
             test_item = loader.get_uid(config.uid)
             results = Runner.run_items(test_item)
         else:
-            testrunner = Runner(suites, loggers)
+            testrunner = create_runner(suites, loggers, timeouts)
             results = testrunner.run()
 
 def dorerun():
     '''
     Handle the `rerun` command.
     '''
-    # Load previous results
+    # Find the suites which failed in the previous results.
     # TODO Catch bad file path error or load error.
-    with open(joinpath(config.result_path, 'pickle'), 'r') as old_fstream:
-        old_formatter = result.InternalLogger.load(old_fstream)
+    with open(joinpath(config.result_path, constants.pickle_filename), 'rb')\
+            as old_fstream:
+        failed = [suite.uid for suite in resultfile.ResultReader(
+                old_fstream).suites((result.Outcome.FAIL,
+                                     result.Outcome.ERROR))]
 
     # Load tests
     loader = load_tests()
 
     # Get the self contained suites which hold tests that fail and run each.
-    reruns = []
-    for suite in old_formatter.suites:
-        if suite.outcome in (result.Outcome.FAIL, result.Outcome.ERROR):
-            suite = loader.get_uid(suite.uid)
-            reruns.append(suite)
+    reruns = [loader.get_uid(uid) for uid in failed]
 
     # Run only the suites we need to rerun.
-    testrunner = Runner(reruns)
-    testrunner.run()
+    reruns = select_shard(reruns)
+    reruns = order_suites(reruns)
+    timeouts = timeout_policy()
+    console = console_logger(reruns)
+
+    with staging.staged_results() as staging_loggers:
+        loggers = (console,) + staging_loggers + store.store_loggers() \
+                + events.event_loggers()
+        testrunner = create_runner(reruns, loggers, timeouts)
+        testrunner.run()
+
+def docoordinator():
+    '''
+    Handle the `coordinator` command.
+    '''
+    loader = load_tests()
+
+    if config.tags:
+        suites = []
+        for tag in config.tags:
+            suites.extend(loader.suites_with_tag(tag))
+    else:
+        suites = loader.suites
+    suites = select_shard(suites)
+    suites = order_suites(suites)
+    console = console_logger(suites)
+
+    mkdir_p(config.result_path)
+    archive.clear()
+
+    with staging.staged_results() as staging_loggers, \
+         open(joinpath(config.result_path, constants.pickle_filename), 'wb')\
+            as result_file,\
+         open(joinpath(config.result_path, constants.junit_filename), 'w')\
+            as junit_f:
+
+        junit_logger = result.JUnitLogger(junit_f, result_file)
+        loggers = (junit_logger, console) + staging_loggers \
+                + store.store_loggers() + events.event_loggers()
+
+        log.display(separator())
+        log.bold('Running Tests')
+        log.display('')
+        testrunner = CoordinatorRunner(suites, loggers,
+                                       address=config.address,
+                                       authkey=config.authkey)
+        testrunner.run()
+
+def doworker():
+    '''
+    Handle the `worker` command.
+    '''
+    loader = load_tests()
+    log.display(separator())
+    log.bold('Running Tests for %s' % config.address)
+    log.display('')
+    run_worker(loader, config.address, authkey=config.authkey,
+               timeouts=timeout_policy())
 
 def dolist():
     '''
@@ -113,15 +307,89 @@ def dolist():
         query.list_fixtures(loader)
     if config.all_tags:
         query.list_tags(loader)
+    if config.shards:
+        query.list_shards(loader, config.shards, shard_history())
+    if config.list_only_failed:
+        with open(joinpath(config.result_path, constants.pickle_filename),
+                  'rb') as fstream:
+            query.list_failed(resultfile.ResultReader(fstream),
+                              (result.Outcome.FAIL, result.Outcome.ERROR))
+
+def doshow_output():
+    '''
+    Handle the `show-output` command.
+    '''
+    outdir = result.uid_output_path(config.uid)
+    shown = False
+    for (name, stream) in ((constants.system_out_name, sys.stdout),
+                           (constants.system_err_name, sys.stderr)):
+        for chunk in archive.iter_output(joinpath(outdir, name)):
+            stream.write(chunk)
+            shown = shown or bool(chunk)
+    if not shown:
+        log.warn('No output was captured for %s' % config.uid)
+
+def dohistory():
+    '''
+    Handle the `history` command.
+    '''
+    result_store = store.open_store()
+    try:
+        if config.slowest:
+            query.list_slowest(result_store, config.slowest, config.runs)
+        if config.trend:
+            query.list_trend(result_store, config.trend)
+        if config.flipped:
+            query.list_flipped(result_store, config.runs)
+        if config.compact:
+            result_store.retain(config.history_keep)
+            result_store.compact()
+    finally:
+        result_store.close()
+
+def domerge():
+    '''
+    Handle the `merge` command.
+    '''
+    merged = merge.merge(config.sources, config.result_path,
+                         config.copy_output)
+    log.display('Merged the results of %d suites into %s'
+                % (merged, config.result_path))
+
+def _terminate(signum, frame):
+    # Subprocesses of tests are in their own sessions, so a SIGTERM or SIGHUP
+    # sent to our process group doesn't reach them. Kill them before we go.
+    terminate_processes()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
 
 def main():
     # Start logging verbosity at its minimum
     logger.set_logging_verbosity(0)
     # Then do parsing of the arguments to init config.
     logger.set_logging_verbosity(config.verbose)
+    if config.async_logging:
+        logger.start_queue()
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, _terminate)
+
+    if config.stage_dir is not None:
+        # Finish copying the results of a killed run before reading them.
+        staging.recover(config.stage_dir)
 
     # 'do' the given command.
-    globals()['do'+config.command]()
+    try:
+        globals()['do'+config.command.replace('-', '_')]()
+    except KeyboardInterrupt:
+        # Subprocesses of tests are in their own sessions and don't see the
+        # interrupt. Kill them now rather than at exit, since exit waits on
+        # any test threads which are waiting on them.
+        terminate_processes()
+        raise
+    finally:
+        # Write queued messages before any traceback.
+        logger.flush()
 
 if __name__ == '__main__':
     main()
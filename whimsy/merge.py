@@ -0,0 +1,145 @@
+'''
+Merges the results of several runs, e.g. the shards of a run spread across
+machines, into one result path with the `merge` command.
+
+The result file of each source is read through its index, so only the uids
+of results are kept in memory and each suite is streamed from its source to
+the merged result file and JUnit report. If a suite ran in more than one of
+the sources, the result from the source given last is kept along with its
+test case results.
+
+Results refer to the output they captured by the paths it was written to
+when they ran, possibly on another machine. Those paths are rewritten to
+where the output is found in the source, whether as a file or in an
+archive written with --output-archive. With --copy-output the output is
+copied to the merged result path instead, so the sources can be removed.
+
+The merged files are written to temporary names and renamed into place, so
+a source may also be the merged result path.
+'''
+import os
+
+import archive
+import resultfile
+from config import config, constants
+from helper import joinpath, mkdir_p
+from logger import log
+from result import JUnitWriter, Outcome
+
+# Suffix of the merged files while they are being written.
+_partial_suffix = '.merging'
+
+
+class _Source(object):
+    '''The result file of a result path being merged.'''
+    def __init__(self, result_path):
+        self.result_path = result_path
+        self.fstream = open(joinpath(result_path, constants.pickle_filename),
+                            'rb')
+        self.reader = resultfile.ResultReader(self.fstream)
+
+    def suite_uids(self):
+        offsets = set(offset for offsets in self.reader.index.suites.values()
+                      for offset in offsets)
+        return [uid for (uid, offset) in self.reader.index.uids.items()
+                if offset in offsets]
+
+    def output_path(self, result, path):
+        '''
+        Return the path in this source of the output a result wrote to
+        path, which is relative to the result path of the run.
+        '''
+        return joinpath(self.result_path, result.uid.replace('/', '-'),
+                        os.path.basename(path))
+
+    def close(self):
+        self.fstream.close()
+
+
+def _open_sources(result_paths):
+    sources = []
+    for result_path in result_paths:
+        try:
+            sources.append(_Source(os.path.abspath(result_path)))
+        except (IOError, resultfile.ResultFileError) as e:
+            log.warn('Unable to read results from %s: %s' % (result_path, e))
+    return sources
+
+
+def merge(result_paths, merged_path, copy_output=False):
+    '''
+    Merge the results in each of result_paths into merged_path.
+
+    :param copy_output: If True, copy the output captured by each result to
+        merged_path rather than referring to it in its source.
+
+    :returns: The number of suites merged.
+    '''
+    merged_path = os.path.abspath(merged_path)
+    mkdir_p(merged_path)
+    sources = _open_sources(result_paths)
+    try:
+        # Dictionary mapping suite uid->the last source it ran in.
+        latest = {}
+        for source in sources:
+            for uid in source.suite_uids():
+                latest[uid] = source
+
+        pickle_path = joinpath(merged_path, constants.pickle_filename)
+        junit_path = joinpath(merged_path, constants.junit_filename)
+        with open(pickle_path + _partial_suffix, 'wb') as result_file, \
+                open(junit_path + _partial_suffix, 'w') as junit_file:
+            writer = resultfile.ResultWriter(result_file)
+            junit_writer = JUnitWriter(junit_file)
+            junit_writer.begin()
+            runtime = 0
+            result_path = config.result_path
+            for source in sources:
+                # Outputs archived in the source are looked up in it.
+                config.set('result_path', source.result_path)
+                try:
+                    for suite in source.reader.suites():
+                        if latest.get(suite.uid) is not source:
+                            continue
+                        for item in suite.test_case_results + [suite]:
+                            # Outcomes are copies once unpickled.
+                            item.outcome = Outcome.enums[item.outcome.val]
+                            _carry_output(source, item, merged_path,
+                                          copy_output)
+                            writer.append(item)
+                        junit_writer.add_suite(suite)
+                        runtime += suite.runtime
+                finally:
+                    config.set('result_path', result_path)
+            writer.close()
+            junit_writer.finish(runtime)
+        os.rename(pickle_path + _partial_suffix, pickle_path)
+        os.rename(junit_path + _partial_suffix, junit_path)
+        return len(latest)
+    finally:
+        for source in sources:
+            source.close()
+
+
+def _carry_output(source, result, merged_path, copy_output):
+    for attr in ('fstdout_name', 'fstderr_name'):
+        path = getattr(result, attr, None)
+        if path is None:
+            continue
+        path = source.output_path(result, path)
+        if copy_output:
+            destination = joinpath(merged_path,
+                                   os.path.relpath(path, source.result_path))
+            if destination != path \
+                    and archive.output_location(path) is not None:
+                _copy_output(path, destination)
+            path = destination
+        setattr(result, attr, path)
+
+
+def _copy_output(path, destination):
+    mkdir_p(os.path.dirname(destination))
+    with open(destination + _partial_suffix, 'w') as fstream:
+        for chunk in archive.iter_output(path):
+            fstream.write(chunk)
+    os.rename(destination + _partial_suffix, destination)
@@ -0,0 +1,302 @@
+'''
+Services the output of every subprocess started by
+:func:`whimsy.helper.log_call` from a single thread.
+
+Rather than two threads reading lines for each subprocess, the pipes of all
+running subprocesses are polled by one :class:`ProcessMultiplexer` thread.
+Output is read in large chunks and handed to an :class:`OutputSink`, which
+writes it straight to the redirects and capture of the test which started the
+process. While the capture engine of :mod:`whimsy.capture` captures the whole
+process, output is written to our own stdout and stderr so the engine keeps it
+with the rest of the test's output. Output is only split into lines when it
+has to be logged, and not at all if the TRACE level it's logged at is
+disabled.
+
+:func:`whimsy.helper.start_call` returns a :class:`ProcessHandle` without
+waiting for the process, so a test can start many processes and wait on them
+together with :func:`whimsy.helper.wait_calls`.
+
+.. note:: Python2 has no `selectors` module, `select.poll` is used where the
+    platform has it and `select.select` otherwise.
+'''
+import errno
+import os
+import select
+import subprocess
+import sys
+import threading
+from subprocess import CalledProcessError
+
+import logger
+import tee
+
+# Bytes to read from a pipe at once.
+_chunk_size = 64 * 1024
+
+# Timeout used while waiting on processes. Python2 ignores interrupts while
+# waiting without a timeout.
+_wait_timeout = 0.5
+
+
+def _usable_capture(capture):
+    '''
+    Return the capture (see :func:`whimsy.tee.current_capture`) if its files
+    are still open. The capture may have ended before a subprocess closed
+    its output, e.g. if the test timed out.
+    '''
+    if capture is None or any(stream.closed for stream in capture.values()):
+        return None
+    return capture
+
+
+def _write_all(fd, data):
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[written:]
+
+
+class OutputSink(object):
+    '''
+    Receives chunks of the output of one stream of a subprocess.
+
+    Chunks are written to each redirect, and to the capture of the test
+    which started the process if there is one. Otherwise they are written to
+    fd if given, or complete lines are logged at TRACE level if it's enabled.
+    '''
+    def __init__(self, name, redirects=tuple(), capture=None, fd=None):
+        '''
+        :param name: Name of the stream, 'stdout' or 'stderr'.
+
+        :param redirects: Iterable of file-like objects to write output to.
+
+        :param capture: Capture to write output to, as returned by
+            :func:`whimsy.tee.current_capture`.
+
+        :param fd: File descriptor to write output to when there is no
+            capture, used while the whole process is captured.
+        '''
+        self.name = name
+        self.redirects = redirects
+        self.capture = capture
+        self.fd = fd
+        self._partial = ''
+
+    def write(self, data):
+        for redirect in self.redirects:
+            redirect.write(data)
+        capture = _usable_capture(self.capture)
+        if capture is not None:
+            # Keep the output with that of the calling test.
+            capture[self.name].write(data)
+        elif self.fd is not None:
+            _write_all(self.fd, data)
+        elif logger.log.isEnabledFor(logger.TRACE):
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                logger.log.log(logger.TRACE, line.rstrip())
+
+    def close(self):
+        if self._partial and logger.log.isEnabledFor(logger.TRACE):
+            logger.log.log(logger.TRACE, self._partial.rstrip())
+        self._partial = ''
+
+
+class ProcessHandle(object):
+    '''
+    A process whose output is serviced by the :class:`ProcessMultiplexer`,
+    returned by :func:`whimsy.helper.start_call`.
+
+    :var process: The :class:`subprocess.Popen` object of the process.
+    '''
+    def __init__(self, process, cmdstr):
+        self.process = process
+        self.cmdstr = cmdstr
+        self._open = 2
+        self._drained = threading.Event()
+
+    def _closed(self):
+        # Called by the multiplexer thread as each pipe hits EOF.
+        self._open -= 1
+        if not self._open:
+            self._drained.set()
+
+    def done(self):
+        '''Return True if the process has exited and its output was read.'''
+        return self._drained.is_set() and self.process.poll() is not None
+
+    def wait(self):
+        '''
+        Wait for the process to exit and its output to be read.
+
+        :raises CalledProcessError: If the process failed.
+        '''
+        while not self._drained.wait(_wait_timeout):
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise CalledProcessError(returncode, self.cmdstr)
+        return returncode
+
+
+class ProcessMultiplexer(object):
+    '''
+    Thread which polls the output pipes of any number of processes, passing
+    what it reads to their :class:`OutputSink` objects.
+    '''
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        # Dictionary mapping fd->(pipe, sink, handle)
+        self._pipes = {}
+        self._added = []
+        self._thread = None
+        (self._wakeup_read, self._wakeup_write) = os.pipe()
+
+    def add(self, process, cmdstr, stdout_sink, stderr_sink):
+        '''
+        Start servicing the stdout and stderr pipes of the process.
+
+        :returns: A :class:`ProcessHandle` for the process.
+        '''
+        handle = ProcessHandle(process, cmdstr)
+        with self._lock:
+            self._added.append((process.stdout, stdout_sink, handle))
+            self._added.append((process.stderr, stderr_sink, handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        os.write(self._wakeup_write, 'x')
+        return handle
+
+    def _register(self, poller):
+        with self._lock:
+            (added, self._added) = (self._added, [])
+        for (pipe, sink, handle) in added:
+            self._pipes[pipe.fileno()] = (pipe, sink, handle)
+            poller.register(pipe.fileno())
+
+    def _service(self, fd, poller):
+        (pipe, sink, handle) = self._pipes[fd]
+        try:
+            data = os.read(fd, _chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            data = ''
+        if data:
+            sink.write(data)
+            return
+        poller.unregister(fd)
+        del self._pipes[fd]
+        pipe.close()
+        sink.close()
+        handle._closed()
+
+    def _run(self):
+        poller = _Poller()
+        poller.register(self._wakeup_read)
+        while True:
+            for fd in poller.poll():
+                if fd == self._wakeup_read:
+                    os.read(self._wakeup_read, _chunk_size)
+                    self._register(poller)
+                elif fd in self._pipes:
+                    try:
+                        self._service(fd, poller)
+                    except Exception:
+                        # Don't lose the multiplexer to a bad redirect.
+                        logger.log.warn('Failed to handle output of a'
+                                        ' subprocess.', exc_info=True)
+
+
+class _Poller(object):
+    '''Minimal poller using select.poll if available else select.select.'''
+    def __init__(self):
+        self._fds = set()
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+
+    def register(self, fd):
+        self._fds.add(fd)
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+        if self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self):
+        '''Return the fds which are readable or have hung up.'''
+        while True:
+            try:
+                if self._poll is not None:
+                    return [fd for (fd, _) in self._poll.poll()]
+                return select.select(list(self._fds), [], [])[0]
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+
+_multiplexer = None
+
+
+def multiplexer():
+    '''
+    Return the multiplexer of this process, creating it if there is none.
+    A forked process creates its own since the thread is not forked.
+    '''
+    global _multiplexer
+    if _multiplexer is None or _multiplexer.pid != os.getpid():
+        _multiplexer = ProcessMultiplexer()
+    return _multiplexer
+
+
+def _as_redirects(redirect):
+    if hasattr(redirect, 'write'):
+        return (redirect,)
+    return tuple(redirect)
+
+
+def popen(command, *popenargs, **kwargs):
+    '''
+    Start the given command as :func:`whimsy.helper.log_call` does, in its
+    own session with its output piped.
+
+    :returns: A tuple of the :class:`subprocess.Popen` object, the command
+        as a string, and the stdout and stderr :class:`OutputSink` objects
+        its output should be given to.
+    '''
+    if isinstance(command, str):
+        cmdstr = command
+    else:
+        cmdstr = ' '.join(command)
+
+    logger.log.trace('Logging call to command: %s' % cmdstr)
+
+    stdout_redirect = _as_redirects(kwargs.get('stdout', tuple()))
+    stderr_redirect = _as_redirects(kwargs.get('stderr', tuple()))
+
+    kwargs['stdout'] = subprocess.PIPE
+    kwargs['stderr'] = subprocess.PIPE
+    if 'preexec_fn' not in kwargs:
+        # In a session of its own so the watchdog can kill its group. It
+        # won't see interrupts, see whimsy.helper.terminate_processes.
+        kwargs['preexec_fn'] = os.setsid
+    process = subprocess.Popen(command, *popenargs, **kwargs)
+
+    capture = tee.current_capture()
+    (stdout_fd, stderr_fd) = (None, None)
+    if capture is None and logger.capturing():
+        # The capture engine reads our stdout and stderr.
+        (stdout_fd, stderr_fd) = (sys.__stdout__.fileno(),
+                                  sys.__stderr__.fileno())
+    return (process, cmdstr,
+            OutputSink('stdout', stdout_redirect, capture, stdout_fd),
+            OutputSink('stderr', stderr_redirect, capture, stderr_fd))
@@ -0,0 +1,566 @@
+'''
+Contains the :class:`ParallelRunner` which spreads :class:`TestSuite`
+instances across a pool of worker processes.
+
+TestSuites are self-contained, so each one can be ran in a separate process.
+Test items are created by executing test files and typically hold closures and
+fixtures which cannot be pickled, so rather than sending suites to workers the
+pool is forked after tests have been loaded and non `lazy_init` fixtures have
+been built. Workers then receive the index of the suite to run along with the
+fixtures the parent has built since (for instance when a
+:class:`whimsy.runner.FixturePipeline` is building fixtures in the
+background).
+
+Workers do not report results directly. Each worker runs its suite with
+a :class:`ResultRecorder` which records the :class:`ResultLogger` callbacks it
+receives. The recorded callbacks are sent back to the parent process and
+replayed into the parent's loggers in the order the suites were given to the
+runner, so console output, junit and pickle results look the same as they
+would for a serial run.
+
+Suites are only handed to the pool while the :class:`whimsy.suite.Resources`
+they declare fit within a :class:`ResourceBudget` of the host's cpus and
+memory, so a few heavy suites (e.g. full-system simulations) do not
+oversubscribe the host just because there are free workers.
+
+A worker which dies while running a suite (e.g. it was killed for using too
+much memory) never returns a result, so the parent watches the pid of the
+worker running each suite and reports the suite as errored once it is gone.
+
+.. note:: Since workers are forked, this requires a platform which supports
+    `fork`.
+'''
+import errno
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+import Queue
+from multiprocessing.queues import SimpleQueue
+
+from config import config
+from helper import OrderedSet, terminate_processes
+from _util import parse_size
+from logger import log
+from result import Outcome, ResultLogger
+from runner import Runner, FixturePipeline
+from suite import SuiteList
+
+# Suites the worker processes may be asked to run. This is set before the
+# pool is forked so that workers inherit it.
+_worker_suites = None
+
+# All fixtures used by _worker_suites. The parent refers to fixtures it has
+# setup since forking by their index in this list.
+_worker_fixtures = None
+
+# TimeoutPolicy of the parent runner, used by the workers.
+_worker_timeouts = None
+
+# SimpleQueue workers put the sequence number of each suite and their pid on
+# as they start it. Unlike a multiprocessing.Queue it's written to before put
+# returns, so the parent learns what a worker was running even if the worker
+# dies straight after.
+_worker_started = None
+
+# Key used to identify the suite itself (rather than one of its test cases)
+# in recorded events.
+_suite_key = None
+
+# Timeout used while waiting on results. Python2 will ignore
+# KeyboardInterrupt while blocking on a lock without a timeout.
+_poll_timeout = 0.5
+
+
+class ResultRecorder(ResultLogger):
+    '''
+    A :class:`ResultLogger` which records the callbacks it receives so they
+    can be replayed into other loggers with :func:`replay`.
+
+    Test items cannot be pickled and outcomes will lose their identity if
+    they are, so items are recorded by their position in the given suite and
+    outcomes by their value. Fixtures are recorded by their position in
+    :func:`_all_fixtures` of the suite.
+    '''
+    def __init__(self, test_suite):
+        self.events = []
+        self._keys = {id(testcase): idx for idx, testcase
+                      in enumerate(test_suite.testcases)}
+        self._keys[id(test_suite)] = _suite_key
+        self._fixture_keys = {id(fixture): idx for idx, fixture
+                              in enumerate(_all_fixtures((test_suite,)))}
+
+    def _key(self, item):
+        return self._keys[id(item)]
+
+    def begin_testing(self):
+        pass
+
+    def begin(self, item):
+        self.events.append(('begin', self._key(item)))
+
+    def skip(self, item, **kwargs):
+        self.events.append(('skip', self._key(item), kwargs))
+
+    def set_current_outcome(self, outcome, **kwargs):
+        self.events.append(('set_current_outcome', outcome.val, kwargs))
+
+    def end_current(self):
+        self.events.append(('end_current',))
+
+    def fixture_setup(self, fixture, runtime, error=None):
+        if id(fixture) in self._fixture_keys:
+            self.events.append(('fixture_setup',
+                                self._fixture_keys[id(fixture)],
+                                runtime, error))
+
+    def fixture_teardown(self, fixture):
+        if id(fixture) in self._fixture_keys:
+            self.events.append(('fixture_teardown',
+                                self._fixture_keys[id(fixture)]))
+
+    def end_testing(self):
+        pass
+
+
+def replay(test_suite, events, result_loggers):
+    '''
+    Replay the events recorded by a :class:`ResultRecorder` for the given
+    test_suite into each of the result_loggers.
+    '''
+    testcases = test_suite.testcases
+    fixtures = None
+
+    def item(key):
+        return test_suite if key is _suite_key else testcases[key]
+
+    for event in events:
+        name = event[0]
+        if name.startswith('fixture_') and fixtures is None:
+            fixtures = list(_all_fixtures((test_suite,)))
+        for logger in result_loggers:
+            if name == 'begin':
+                logger.begin(item(event[1]))
+            elif name == 'skip':
+                logger.skip(item(event[1]), **event[2])
+            elif name == 'set_current_outcome':
+                logger.set_current_outcome(Outcome.enums[event[1]],
+                                           **event[2])
+            elif name == 'end_current':
+                logger.end_current()
+            elif name == 'fixture_setup':
+                logger.fixture_setup(fixtures[event[1]], *event[2:])
+            elif name == 'fixture_teardown':
+                logger.fixture_teardown(fixtures[event[1]])
+
+
+def _init_worker():
+    # Let the parent handle interrupts, it will terminate us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate_worker)
+
+
+def _terminate_worker(signum, frame):
+    # Workers exit without running atexit handlers, kill the subprocesses of
+    # our tests before we go.
+    terminate_processes()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def _run_suite(seq, idx, built, failures):
+    '''
+    Run the suite at idx in a worker.
+
+    :param seq: Sequence number used to order results, returned as is.
+
+    :param built: Indices of fixtures which the parent has built since the
+        worker was forked.
+
+    :param failures: Dictionary mapping fixture index->error for fixtures
+        which failed to setup in the parent.
+
+    :returns: A tuple :code:`(seq, outcome value, events, error)`.
+    '''
+    for fixture_idx in built:
+        _worker_fixtures[fixture_idx]._built = True
+
+    _worker_started.put((seq, os.getpid()))
+    test_suite = _worker_suites[idx]
+    recorder = ResultRecorder(test_suite)
+    runner = Runner(result_loggers=(recorder,), timeouts=_worker_timeouts)
+    runner.fixture_failures = {_worker_fixtures[fixture_idx]: error
+                               for (fixture_idx, error) in failures.items()}
+    try:
+        outcome = runner.run_suite(test_suite)
+    except Exception:
+        # The recorded events may leave items unfinished, only report the
+        # suite as errored.
+        return _error_result(seq, traceback.format_exc())
+    return (seq, outcome.val, recorder.events, None)
+
+
+def _error_result(seq, error):
+    '''
+    Return the result of a suite which could not be ran to completion, only
+    reporting the suite itself as errored.
+    '''
+    events = [('begin', _suite_key),
+              ('set_current_outcome', Outcome.ERROR.val, {'runtime': 0}),
+              ('end_current',)]
+    return (seq, Outcome.ERROR.val, events, error)
+
+
+def _pid_alive(pid):
+    '''
+    Return False once the process with the given pid has exited and been
+    reaped. The pool reaps workers which die and replaces them.
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def host_memory():
+    '''Return the bytes of physical memory on the host, None if unknown.'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ResourceBudget(object):
+    '''
+    Tracks the cpus and memory in use by running suites, blocking
+    :func:`acquire` until the requested resources are free.
+
+    Requests larger than the whole budget are clamped to it, so they are
+    admitted once nothing else is running rather than never.
+    '''
+    def __init__(self, cpus=None, memory=None):
+        '''
+        :param cpus: Number of cpus available. If None, uses the number of
+            cpus on the host.
+
+        :param memory: Bytes of memory available. If None, uses the memory
+            of the host. If that is unknown memory is not limited.
+        '''
+        self.cpus = cpus if cpus is not None else multiprocessing.cpu_count()
+        self.memory = memory if memory is not None else host_memory()
+        self._used_cpus = 0
+        self._used_memory = 0
+        self._cancelled = False
+        self._condition = threading.Condition()
+
+    def _clamp(self, resources):
+        cpus = min(resources.cpus, self.cpus)
+        memory = resources.memory
+        if self.memory is not None:
+            memory = min(memory, self.memory)
+        return (cpus, memory)
+
+    def _fits(self, cpus, memory):
+        if self._used_cpus + cpus > self.cpus:
+            return False
+        if self.memory is not None \
+                and self._used_memory + memory > self.memory:
+            return False
+        return True
+
+    def acquire(self, resources):
+        '''
+        Block until the given resources are free and mark them as in use.
+
+        :returns: False if the budget was cancelled while waiting.
+        '''
+        (cpus, memory) = self._clamp(resources)
+        with self._condition:
+            while not self._cancelled and not self._fits(cpus, memory):
+                self._condition.wait(_poll_timeout)
+            if self._cancelled:
+                return False
+            self._used_cpus += cpus
+            self._used_memory += memory
+            return True
+
+    def release(self, resources):
+        '''Mark the given resources acquired earlier as free.'''
+        (cpus, memory) = self._clamp(resources)
+        with self._condition:
+            self._used_cpus -= cpus
+            self._used_memory -= memory
+            self._condition.notify_all()
+
+    def cancel(self):
+        '''Wake up and fail any waiting :func:`acquire` calls.'''
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+
+def _all_fixtures(suites):
+    '''
+    Return an OrderedSet of all fixtures used by the suites and the fixtures
+    they require.
+    '''
+    fixtures = OrderedSet()
+    stack = list(SuiteList(suites).iter_fixtures())
+    while stack:
+        fixture = stack.pop()
+        if fixture not in fixtures:
+            fixtures.add(fixture)
+            stack.extend(fixture.requires)
+    return fixtures
+
+
+class ParallelRunner(Runner):
+    '''
+    A :class:`Runner` which runs suites in a pool of worker processes.
+    '''
+    def __init__(self, suites=tuple(), result_loggers=tuple(), jobs=None,
+                 budget=None):
+        '''
+        :param jobs: Number of worker processes to run suites in. If None,
+            uses the config's jobs.
+
+        :param budget: :class:`ResourceBudget` suites must fit in to be ran.
+            If None, uses the config's max_cpus and max_memory.
+
+        .. seealso:: :func:`Runner.__init__`
+        '''
+        super(ParallelRunner, self).__init__(suites, result_loggers)
+        if jobs is None:
+            jobs = config.jobs
+        if budget is None:
+            budget = ResourceBudget(config.max_cpus,
+                                    parse_size(config.max_memory))
+        self.jobs = jobs
+        self.budget = budget
+
+    def run_suites(self, suites):
+        '''
+        Run the given suites in the worker pool, replaying their results into
+        our loggers in the order the suites were given.
+
+        Suites are handed to the pool as the given iterable produces them,
+        so a :class:`whimsy.runner.FixturePipeline` can be used to start
+        running suites while fixtures for others are still being setup.
+
+        If the --fail-fast flag was given, the first failing suite will cause
+        all running and queued suites to be cancelled.
+
+        :returns: The set of outcomes of the suites which were ran.
+        '''
+        global _worker_suites, _worker_fixtures, _worker_timeouts, \
+                _worker_started
+        if isinstance(suites, FixturePipeline):
+            _worker_suites = list(suites.suites)
+        else:
+            suites = list(suites)
+            _worker_suites = suites
+        _worker_fixtures = list(_all_fixtures(_worker_suites))
+        _worker_timeouts = self.timeouts
+        _worker_started = SimpleQueue()
+
+        finished = Queue.Queue()
+        pool = multiprocessing.Pool(self.jobs, _init_worker)
+        submitter = _Submitter(suites, pool, finished, self.fixture_failures,
+                               self.budget)
+        try:
+            submitter.start()
+            outcomes = self._collect(submitter, finished, pool)
+        except:
+            submitter.cancel()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_suites = None
+            _worker_fixtures = None
+            _worker_timeouts = None
+            _worker_started = None
+        return outcomes
+
+    def _collect(self, submitter, finished, pool):
+        completed = {}
+        outcomes = set()
+        # Dictionary mapping worker pid->sequence number of the last suite it
+        # started.
+        running = {}
+        # Sequence numbers of the suites a result was received for.
+        received = set()
+        next_seq = 0
+        total = None
+        cancelled = False
+        lost = False
+
+        while total is None or len(received) < total:
+            self._report_started(submitter, running)
+            lost = self._check_workers(submitter, finished, running,
+                                       received) or lost
+            try:
+                result = finished.get(True, _poll_timeout)
+            except Queue.Empty:
+                continue
+            if result is _submitted_all:
+                total = submitter.submitted
+                continue
+
+            (seq, outcome, events, error) = result
+            if seq in received:
+                # The suite was reported as lost, yet its result arrived.
+                continue
+            received.add(seq)
+            outcome = Outcome.enums[outcome]
+            if error is not None:
+                log.warn('Worker failed to run %s'
+                         % submitter.suites[seq].name)
+                log.warn(error)
+            completed[seq] = (outcome, events)
+
+            if outcome in Outcome.failfast and config.fail_fast:
+                log.bold('Suite failed with the --fail-fast flag provided.')
+                log.bold('Cancelling remaining suites.')
+                submitter.cancel()
+                pool.terminate()
+                cancelled = True
+                break
+
+            # Report suites started while we were waiting first.
+            self._report_started(submitter, running)
+            # Replay the contiguous run of completed suites.
+            while next_seq in completed:
+                outcomes.add(self._replay(submitter.suites[next_seq],
+                                          *completed.pop(next_seq)))
+                next_seq += 1
+
+        if cancelled:
+            # Report whatever finished before we cancelled, still in order.
+            for seq in sorted(completed):
+                outcomes.add(self._replay(submitter.suites[seq],
+                                          *completed[seq]))
+        elif lost:
+            # The pool never considers the tasks of lost workers finished,
+            # it would wait on them forever once closed.
+            pool.terminate()
+        return outcomes
+
+    def _check_workers(self, submitter, finished, running, received):
+        '''
+        Report the suite each worker which died (e.g. was killed for using
+        too much memory) was running as errored, since the pool will never
+        return its result.
+
+        :returns: True if any worker died.
+        '''
+        lost = False
+        for (pid, seq) in running.items():
+            if seq in received or _pid_alive(pid):
+                continue
+            del running[pid]
+            lost = True
+            submitter.release(seq)
+            finished.put(_error_result(
+                    seq, 'Worker %d exited while running the suite.' % pid))
+        return lost
+
+    def _report_started(self, submitter, running):
+        while not _worker_started.empty():
+            (seq, pid) = _worker_started.get()
+            running[pid] = seq
+            self._suite_started(submitter.suites[seq], 'worker %d' % pid)
+
+    def _replay(self, test_suite, outcome, events):
+        replay(test_suite, events, self.result_loggers)
+        return outcome
+
+
+# Placed in the finished queue once all suites have been submitted.
+_submitted_all = object()
+
+
+class _Submitter(threading.Thread):
+    '''
+    Thread which submits suites to the pool as they are produced by the
+    iterable of suites, leaving the main thread free to report results.
+
+    Suites are submitted in order, each waiting until its required resources
+    fit in the budget.
+
+    :var suites: Dictionary mapping sequence number->suite for each suite
+        submitted.
+    '''
+    def __init__(self, suites, pool, finished, fixture_failures, budget):
+        super(_Submitter, self).__init__()
+        self.setDaemon(True)
+        self._iterable = suites
+        self._pool = pool
+        self._finished = finished
+        self._fixture_failures = fixture_failures
+        self._budget = budget
+        self._cancelled = threading.Event()
+        # Dictionary mapping sequence number->resources of each suite which
+        # has not finished.
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+        self.suites = {}
+        self.submitted = 0
+
+    def cancel(self):
+        self._cancelled.set()
+        self._budget.cancel()
+        if isinstance(self._iterable, FixturePipeline):
+            self._iterable.cancel()
+
+    def run(self):
+        suite_indices = {id(suite): idx for idx, suite
+                         in enumerate(_worker_suites)}
+        fixture_indices = {fixture: idx for idx, fixture
+                           in enumerate(_worker_fixtures)}
+        try:
+            for suite in self._iterable:
+                resources = suite.required_resources
+                if not self._budget.acquire(resources) \
+                        or self._cancelled.is_set():
+                    break
+                built = [idx for idx, fixture in enumerate(_worker_fixtures)
+                         if fixture.built]
+                failures = {fixture_indices[fixture]: error
+                            for (fixture, error)
+                            in self._fixture_failures.items()
+                            if fixture in fixture_indices}
+
+                seq = self.submitted
+                self.suites[seq] = suite
+                with self._resources_lock:
+                    self._resources[seq] = resources
+                self._pool.apply_async(
+                        _run_suite,
+                        (seq, suite_indices[id(suite)], built, failures),
+                        callback=self._callback)
+                self.submitted += 1
+        except Exception:
+            if not self._cancelled.is_set():
+                log.warn('Failed to submit suites to the worker pool.')
+                log.warn(traceback.format_exc())
+        finally:
+            if not self._cancelled.is_set():
+                self._pool.close()
+            self._finished.put(_submitted_all)
+
+    def release(self, seq):
+        '''
+        Release the resources of the suite with the given sequence number
+        back to the budget, if they have not been already.
+        '''
+        with self._resources_lock:
+            resources = self._resources.pop(seq, None)
+        if resources is not None:
+            self._budget.release(resources)
+
+    def _callback(self, result):
+        self.release(result[0])
+        self._finished.put(result)
@@ -0,0 +1,208 @@
+'''
+Reports the progress of a run with the --progress flag, rather than a line for
+every test.
+
+A :class:`ProgressLogger` only logs the tests which did not pass. When stdout
+is a terminal it draws a status view below them, showing how many tests have
+completed out of the total, the tests ran per minute, an estimate of the time
+left and the suite each worker is running::
+
+    [ 1234/20000 tests | 310.5 tests/min | ETA 1:00:32 ]
+      worker 5121: gem5/x86/hello (0:12)
+      worker 5122: gem5/arm/linux-boot (1:03)
+
+The status is redrawn at most every :data:`redraw_interval` seconds. When
+stdout isn't a terminal a single summary line is logged at most every
+:data:`summary_interval` seconds instead.
+
+The estimate uses the runtimes of the previous run, see
+:func:`whimsy.schedule.expected_runtimes`, scaled by how long the suites
+completed so far took compared to their expected runtimes.
+'''
+import time
+
+import logger
+import terminal
+from helper import OrderedDict
+from logger import log
+from result import ConsoleLogger, Outcome
+from schedule import expected_runtimes
+from suite import TestSuite
+
+# Minimum seconds between redraws of the status view.
+redraw_interval = 0.2
+
+# Minimum seconds between summary lines when stdout isn't a terminal.
+summary_interval = 30
+
+# Suites listed in the status view at most, the rest are only counted.
+max_running_lines = 10
+
+
+def format_duration(seconds):
+    '''Format seconds as H:MM:SS, or M:SS if less than an hour.'''
+    seconds = int(seconds)
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+
+class _StatusStream(object):
+    '''
+    Wraps the stream of the console log handler, erasing the status view
+    before anything else is written below it.
+    '''
+    def __init__(self, stream, progress_logger):
+        self.stream = stream
+        self.progress_logger = progress_logger
+
+    def write(self, data):
+        self.progress_logger._erase()
+        self.stream.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+class ProgressLogger(ConsoleLogger):
+    '''
+    :class:`ConsoleLogger` which reports the progress of the run as a whole,
+    only logging tests which did not pass.
+    '''
+    cursor_up = terminal.cap_string('cuu1')
+    clear_line = terminal.cap_string('el')
+
+    def __init__(self, suites, history):
+        '''
+        :param suites: Suites the run will report, used for the totals.
+
+        :param history: :class:`whimsy.history.ResultHistory` of a previous
+            run used to estimate the time left.
+        '''
+        super(ProgressLogger, self).__init__()
+        suites = list(suites)
+        self.total = sum(len(suite) for suite in suites)
+        self.completed = 0
+        self._expected = dict(zip((suite.uid for suite in suites),
+                                  expected_runtimes(suites, history)))
+        self._remaining = sum(self._expected.values())
+        self._expected_done = 0
+        # Dictionary mapping suite uid->(name, worker, start time)
+        self._running = OrderedDict()
+        self._start = None
+        self._handler = logger.stdout_logger
+        self._stream = None
+        self._live = False
+        self._drawn = 0
+        self._last_update = 0
+
+    def begin_testing(self):
+        super(ProgressLogger, self).begin_testing()
+        self._start = time.time()
+        stream = self._handler.stream
+        self._live = stream.isatty() and bool(self.cursor_up) \
+                and bool(self.clear_line)
+        if self._live:
+            self._stream = stream
+            self._handler.stream = _StatusStream(stream, self)
+        self._last_update = self._start
+
+    def suite_started(self, test_suite, worker=None):
+        self._running[test_suite.uid] = (test_suite.name, worker, time.time())
+        self._update()
+
+    def begin(self, item):
+        super(ProgressLogger, self).begin(item)
+        if isinstance(item, TestSuite) and item.uid not in self._running:
+            self._running[item.uid] = (item.name, None, time.time())
+            self._update()
+
+    def _set_testcase_outcome(self, test_case, outcome, reason=None,
+                              **kwargs):
+        self.completed += 1
+        if outcome == Outcome.PASS:
+            self.outcome_count[outcome] += 1
+        else:
+            super(ProgressLogger, self)._set_testcase_outcome(
+                    test_case, outcome, reason=reason, **kwargs)
+        self._update()
+
+    def _skip_testcase(self, test_case, reason):
+        self.completed += 1
+        self.outcome_count[Outcome.SKIP] += 1
+        self._update()
+
+    def _end_testsuite(self, test_suite):
+        self._running.pop(test_suite.uid, None)
+        expected = self._expected.pop(test_suite.uid, 0)
+        self._remaining -= expected
+        self._expected_done += expected
+        self._update()
+
+    def end_testing(self):
+        if self._live:
+            self._handler.acquire()
+            try:
+                self._erase()
+                self._handler.stream = self._stream
+            finally:
+                self._handler.release()
+            self._live = False
+        super(ProgressLogger, self).end_testing()
+
+    def _update(self):
+        now = time.time()
+        if self._live:
+            if now - self._last_update >= redraw_interval:
+                self._last_update = now
+                self._draw(now)
+        elif now - self._last_update >= summary_interval:
+            self._last_update = now
+            log.display(self._summary(now))
+
+    def _summary(self, now):
+        elapsed = now - self._start
+        rate = self.completed * 60.0 / elapsed if elapsed > 0 else 0
+        eta = '?'
+        if self._expected_done > 0:
+            eta = format_duration(self._remaining * elapsed
+                                  / self._expected_done)
+        return '[ %d/%d tests | %.1f tests/min | ETA %s ]' % (
+                self.completed, self.total, rate, eta)
+
+    def _lines(self, now):
+        lines = [self._summary(now)]
+        running = list(self._running.values())
+        for (name, worker, start) in running[:max_running_lines]:
+            started = format_duration(now - start)
+            if worker is None:
+                lines.append('  %s (%s)' % (name, started))
+            else:
+                lines.append('  %s: %s (%s)' % (worker, name, started))
+        if len(running) > max_running_lines:
+            lines.append('  ... and %d more'
+                         % (len(running) - max_running_lines))
+        return lines
+
+    def _draw(self, now):
+        lines = self._lines(now)
+        (width, _) = terminal.terminal_size()
+        if width > 1:
+            # Lines which wrap would throw off erasing them.
+            lines = [line[:width - 1] for line in lines]
+        self._handler.acquire()
+        try:
+            self._erase()
+            self._stream.write(''.join(line + '\n' for line in lines))
+            self._stream.flush()
+            self._drawn = len(lines)
+        finally:
+            self._handler.release()
+
+    def _erase(self):
+        if self._drawn:
+            self._stream.write((self.cursor_up + self.clear_line)
+                               * self._drawn)
+            self._drawn = 0
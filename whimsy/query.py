@@ -2,6 +2,9 @@
 File which implements querying and display logic for metadata about loaded
 items.
 '''
+import time
+
+import schedule
 from logger import log
 from terminal import separator
 
@@ -33,6 +36,22 @@ def list_tags(loader):
     for tag in loader.tags:
         log.display(tag)
 
+def list_failed(reader, outcomes):
+    '''
+    List the suites and test cases with one of the given outcomes in the
+    results read by the :class:`whimsy.resultfile.ResultReader`.
+    '''
+    log.display(separator())
+    log.display('Listing failed TestSuites.')
+    log.display(separator())
+    for suite in reader.suites(outcomes):
+        log.display('%s %s' % (suite.uid, suite.outcome.name))
+    log.display(separator())
+    log.display('Listing failed TestCases.')
+    log.display(separator())
+    for test in reader.testcases(outcomes):
+        log.display('%s %s' % (test.uid, test.outcome.name))
+
 def list_tests_with_tags(loader, tags):
     log.display('Listing tests based on tags.')
     for tag in tags:
@@ -41,3 +60,43 @@ def list_tests_with_tags(loader, tags):
         log.display(separator())
         for test in loader.tag_index(tag):
             log.display(test.uid)
+
+def list_shards(loader, count, history):
+    for (idx, shard) in enumerate(
+            schedule.shard_suites(loader.suites, count, history)):
+        expected = sum(history.runtime(
+                suite.uid, suite.required_resources.duration or 0)
+                for suite in shard)
+        log.display(separator())
+        log.display('Shard %d/%d (%d suites, %.2f seconds expected):'
+                    % (idx + 1, count, len(shard), expected))
+        log.display(separator())
+        for suite in shard:
+            log.display(suite.uid)
+
+def list_slowest(result_store, count, runs):
+    log.display(separator())
+    log.display('Listing the %d slowest TestCases over the last %d runs.'
+                % (count, runs))
+    log.display(separator())
+    for (uid, mean, longest, samples) in result_store.slowest(count, runs):
+        log.display('%s: %.2f seconds mean, %.2f max of %d runs'
+                    % (uid, mean, longest, samples))
+
+def list_trend(result_store, uid):
+    log.display(separator())
+    log.display('Listing results of %s.' % uid)
+    log.display(separator())
+    for (run, started, revision, outcome, runtime) in result_store.trend(uid):
+        log.display('run %d %s %s: %s in %.2f seconds'
+                    % (run, time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(started)),
+                       revision or '-', outcome, runtime))
+
+def list_flipped(result_store, runs):
+    log.display(separator())
+    log.display('Listing TestCases whose outcome changed over the last %d'
+                ' runs.' % runs)
+    log.display(separator())
+    for (uid, run, previous, outcome) in result_store.flipped(runs):
+        log.display('%s: %s -> %s in run %d' % (uid, previous, outcome, run))
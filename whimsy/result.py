@@ -4,17 +4,20 @@ is to support large amounts of results and not create large standing pools of
 strings.
 '''
 import abc
-import pickle
+import codecs
+import os
 from xml.sax.saxutils import escape as xml_escape
 from string import maketrans
 
 import terminal
+import archive
+import resultfile
 from config import config
 from helper import joinpath
 from test import TestCase
 from suite import TestSuite
 from logger import log
-from _util import Timer, Enum
+from _util import Timer, Enum, parse_size
 
 class InvalidResultException(Exception):
     pass
@@ -52,7 +55,15 @@ def test_results_output_path(test_case):
     Return the path which results for a specific test case should be
     stored.
     '''
-    return joinpath(config.result_path, test_case.uid.replace('/','-'))
+    return uid_output_path(test_case.uid)
+
+
+def uid_output_path(uid):
+    '''
+    Return the path which results for the test case with the given uid should
+    be stored.
+    '''
+    return joinpath(config.result_path, uid.replace('/','-'))
 
 
 # TODO: I'd like to re-factor this interface into an explicit callback
@@ -106,6 +117,31 @@ class ResultLogger(object):
         '''
         pass
 
+    def suite_started(self, test_suite, worker=None):
+        '''
+        Signal that the given suite started running. Only called by runners
+        which report the results of a suite after it finishes (e.g. the
+        :class:`whimsy.parallel.ParallelRunner`), otherwise :func:`begin`
+        is called as it starts.
+
+        :param worker: Name of the worker running the suite, None if the
+            runner has none.
+        '''
+        pass
+
+    def fixture_setup(self, fixture, runtime, error=None):
+        '''
+        Signal that the given fixture was setup.
+
+        :param error: String describing why the fixture failed to setup, None
+            if it was setup successfully.
+        '''
+        pass
+
+    def fixture_teardown(self, fixture):
+        '''Signal that the given fixture was torn down.'''
+        pass
+
 
 class ConsoleLogger(ResultLogger):
     '''
@@ -248,11 +284,12 @@ class TestResult(object):
 
 class TestCaseResult(TestResult):
     def __init__(self, testitem, outcome, runtime, fstdout_name,
-                 fstderr_name, reason=None, **kwargs):
+                 fstderr_name, reason=None, timed_out=False, **kwargs):
 
         self.fstdout_name = fstdout_name
         self.fstderr_name = fstderr_name
         self.reason = reason
+        self.timed_out = timed_out
         super(TestCaseResult, self).__init__(testitem, outcome,
                                              runtime,
                                              **kwargs)
@@ -269,8 +306,9 @@ class TestSuiteResult(TestResult):
 
 class InternalLogger(ResultLogger):
     '''
-    An internal logger which writes streaming pickle items on completion of
-    TestSuite items.
+    An internal logger which appends each result to a result file (see
+    :mod:`whimsy.resultfile`) as it completes, flushing the file on
+    completion of TestSuite items.
 
     This logger also offers some metadata methods to and can load back out
     previous results.
@@ -283,14 +321,56 @@ class InternalLogger(ResultLogger):
         self.timer = Timer()
         self.filestream = filestream
         self.results = []
+        self._writer = None
+        self._resumed = []
+        self._replace = None
+        # Total runtime of the suites of the run being resumed.
+        self.resumed_runtime = 0
 
         self._current_suite_testcases = []
 
     def _write(self, obj):
-        pickle.dump(obj, self.filestream)
+        if self._writer is None:
+            self._writer = resultfile.ResultWriter(self.filestream)
+        self._writer.append(obj)
+        if isinstance(obj, TestSuiteResult):
+            self._writer.sync()
 
     def begin_testing(self):
         self.timer.start()
+        self._record_resumed()
+
+    def resume(self, suite_results, replace=None):
+        '''
+        Record the results of suites which finished in an interrupted run
+        first once testing begins, so the results look as if the run was
+        never interrupted.
+
+        :param suite_results: Iterable of :class:`TestSuiteResult`
+            objects, each recorded along with its test case results.
+
+        :param replace: Path of the result file being resumed. If given our
+            file stream is a new file, which is renamed over it once the
+            resumed results are synced to disk. Killing the resumed run
+            never loses them.
+        '''
+        self._resumed = list(suite_results)
+        self.resumed_runtime = sum(suite_result.runtime
+                                   for suite_result in self._resumed)
+        self._replace = replace
+
+    def _record_resumed(self):
+        for suite_result in self._resumed:
+            for result in suite_result.test_case_results + [suite_result]:
+                # Outcomes are copies once unpickled, use the originals.
+                result.outcome = Outcome.enums[result.outcome.val]
+                self._record(result)
+        self._resumed = []
+        if self._replace is not None:
+            if self._writer is not None:
+                self._writer.sync(force=True)
+            os.rename(self.filestream.name, self._replace)
+            self._replace = None
 
     def begin(self, item):
         self._item_list.append(self._current_item)
@@ -309,8 +389,7 @@ class InternalLogger(ResultLogger):
 
         elif __debug__:
             raise AssertionError(self.bad_item)
-        self._write(result)
-        self.results.append(result)
+        self._record(result)
 
     def set_current_outcome(self, outcome, runtime, **kwargs):
         '''Set the outcome of the current item.'''
@@ -327,6 +406,9 @@ class InternalLogger(ResultLogger):
         elif __debug__:
             raise AssertionError(self.bad_item)
 
+        self._record(result)
+
+    def _record(self, result):
         self._write(result)
         self.results.append(result)
 
@@ -335,20 +417,20 @@ class InternalLogger(ResultLogger):
 
     def end_testing(self):
         self.timer.stop()
+        if self._writer is None:
+            self._writer = resultfile.ResultWriter(self.filestream)
+        self._writer.close()
 
     @staticmethod
     def load(filestream):
-        '''Load results out of a dumped file replacing our own results.'''
-        loaded_results = []
-        try:
-            while True:
-                item = pickle.load(filestream)
-                loaded_results.append(item)
-        except EOFError:
-            pass
+        '''
+        Load results out of a dumped file replacing our own results.
 
+        .. seealso:: :class:`whimsy.resultfile.ResultReader` to only read
+            some of the results.
+        '''
         new_logger = InternalLogger(filestream)
-        new_logger.results = loaded_results
+        new_logger.results = list(resultfile.ResultReader(filestream))
         return new_logger
 
     @property
@@ -363,9 +445,11 @@ class InternalLogger(ResultLogger):
 
 class JUnitLogger(InternalLogger):
     '''
-    Logger which uses the internal logger to collect streaming results to the
-    internal_fstream, and on completion of testing writes the results out to
-    a junit_fstream.
+    Logger which uses the internal logger to stream results to the
+    internal_fstream, and writes each suite to a junit_fstream as it
+    finishes with a :class:`JUnitWriter`.
+
+    Results are not kept in memory, so :attr:`results` stays empty.
 
     :param junit_fstream: File stream to write junit formatted results to.
 
@@ -374,19 +458,59 @@ class JUnitLogger(InternalLogger):
 
     .. seealso:: :class:`~InternalLogger`
     '''
-    # We use an internal logger to stream the output into a format we can
-    # retrieve at the end and then format it into JUnit.
     def __init__(self, junit_fstream, internal_fstream):
         super(JUnitLogger, self).__init__(internal_fstream)
-        self._junit_fstream = junit_fstream
+        self._junit_writer = JUnitWriter(junit_fstream)
+
+    def begin_testing(self):
+        # Resumed results are written once the report has begun.
+        self._junit_writer.begin()
+        super(JUnitLogger, self).begin_testing()
+
+    def _record(self, result):
+        self._write(result)
+        if isinstance(result, TestSuiteResult):
+            self._junit_writer.add_suite(result)
 
     def end_testing(self):
         '''
-        Signal the end of writing to the file stream. We will write all our
-        results to our junit_fstream.
+        Signal the end of writing to the file stream. We will write the
+        total runtime to our junit_fstream, including that of the suites of
+        a resumed run.
         '''
         super(JUnitLogger, self).end_testing()
-        JUnitFormatter(self).dump(self._junit_fstream)
+        self._junit_writer.finish(self.timer.runtime() + self.resumed_runtime)
+
+
+# Characters which may not appear in XML 1.0 documents.
+_xml_invalid = ''.join(chr(c) for c in range(32) if c not in (9, 10, 13))
+
+
+def _iter_escaped(chunks):
+    '''
+    Escape blocks of output for XML text. Output which isn't UTF-8, such as
+    a character split by truncation, is replaced rather than making the
+    report unreadable.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk).encode('utf-8')
+        if text:
+            yield xml_escape(text.translate(None, _xml_invalid))
+    text = decoder.decode('', final=True).encode('utf-8')
+    if text:
+        yield xml_escape(text.translate(None, _xml_invalid))
+
+
+def _escape_text(chunks):
+    return ''.join(_iter_escaped(chunks))
+
+
+def _escape_attr(value):
+    if value is None:
+        return ''
+    return _escape_text((str(value),)).replace('"', '&quot;')\
+            .replace('\n', '&#10;')
 
 
 class JUnitFormatter(object):
@@ -404,14 +528,18 @@ class JUnitFormatter(object):
     # Indicates test skipped
     skipped_tag = '<skipped/>'
     error_tag = '<error message="{message}"></error>\n'
-    fail_tag = '<failure message="{message}"></error>\n'
+    fail_tag = '<failure message="{message}"></failure>\n'
     system_out_opening = '<system-out>'
     system_err_opening = '<system-err>'
+    # Written in place of the middle of output longer than the output limit.
+    truncated_message = '\n[... {omitted} bytes of output omitted ...]\n'
+    # Written in place of output when only referring to where it's stored.
+    reference_message = 'Output stored in {location}\n'
 
     # Testsuite stuff
     testsuite_opening = ('<testsuite name="{name}" tests="{numtests}"'
                          ' errors="{errors}" failures="{failures}"'
-                         ' skipped="{skipped}" id={suitenum}'
+                         ' skipped="{skipped}" id="{suitenum}"'
                          ' time="{time}">\n'
                          )
     # Testsuites stuff
@@ -422,9 +550,31 @@ class JUnitFormatter(object):
     generic_closing = '</{tag}>\n'
 
 
-    def __init__(self, internal_results, translate_names=True):
-        self.results = internal_results.results
-        self.runtime = internal_results.timer.runtime()
+    def __init__(self, internal_results, translate_names=True,
+                 output_limit=None, output_mode=None):
+        '''
+        :param internal_results: :class:`InternalLogger` holding the results
+            to format, None if results are given as they finish.
+
+        :param output_limit: Bytes of each output stream of a test to
+            include, taken from its start and end. 0 includes all of it. If
+            None, uses the config's junit_output_limit.
+
+        :param output_mode: `inline` to include output in the report or
+            `reference` to only say where it is stored. If None, uses the
+            config's junit_output.
+        '''
+        if internal_results is None:
+            (self.results, self.runtime) = ([], 0)
+        else:
+            self.results = internal_results.results
+            self.runtime = internal_results.timer.runtime()
+        if output_limit is None:
+            output_limit = parse_size(config.junit_output_limit)
+        self.output_limit = output_limit
+        if output_mode is None:
+            output_mode = config.junit_output
+        self.output_mode = output_mode
 
         if translate_names:
             self.name_table = maketrans('/.', '.-')
@@ -444,11 +594,11 @@ class JUnitFormatter(object):
         elif testcase.outcome == FAIL:
             outcome = SKIP
             status = 'failed'
-            tag = self.fail_tag.format(message=testcase.reason)
+            tag = self.fail_tag.format(message=_escape_attr(testcase.reason))
         elif testcase.outcome == ERROR:
             outcome = SKIP
             status = 'errored'
-            tag = self.error_tag.format(message=testcase.reason)
+            tag = self.error_tag.format(message=_escape_attr(testcase.reason))
         elif __debug__:
             raise AssertionError('Unknown test state')
 
@@ -460,29 +610,54 @@ class JUnitFormatter(object):
 
         fstream.write(tag)
 
-        # Write out systemout and systemerr from their containing files.
+        # Write out systemout and systemerr from their containing files or
+        # the output archive. Depending on the --capture mode they may not
+        # have been written.
         fstream.write(self.system_out_opening)
-        with open(testcase.fstdout_name, 'r') as testout_stdout:
-            for line in testout_stdout:
-                fstream.write(xml_escape(line))
+        self.dump_output(fstream, testcase.fstdout_name)
         fstream.write(self.generic_closing.format(tag='system-out'))
 
         fstream.write(self.system_err_opening)
-        with open(testcase.fstderr_name, 'r') as testout_stderr:
-            for line in testout_stderr:
-                fstream.write(xml_escape(line))
+        self.dump_output(fstream, testcase.fstderr_name)
         fstream.write(self.generic_closing.format(tag='system-err'))
 
         fstream.write(self.generic_closing.format(tag='testcase'))
 
-    def dump_testsuite(self, fstream, suite, idx):
-        # Tally results first.
-        outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
-        for testcase in suite.test_case_results:
+    def dump_output(self, fstream, path):
+        '''
+        Write the output captured in path, keeping only its start and end if
+        it's longer than the output limit.
+        '''
+        if self.output_mode == 'reference':
+            location = archive.output_location(path)
+            if location is not None:
+                fstream.write(_escape_text(
+                        (self.reference_message.format(location=location),)))
+        elif self.output_limit:
+            (head, omitted, tail) = archive.head_and_tail(path,
+                                                          self.output_limit)
+            fstream.write(_escape_text((head,)))
+            if omitted:
+                fstream.write(self.truncated_message.format(omitted=omitted))
+                fstream.write(_escape_text((tail,)))
+        else:
+            for block in _iter_escaped(archive.iter_output(path)):
+                fstream.write(block)
+
+    def tally(self, testcases, outcome_tally=None):
+        '''Add the outcomes of the given test case results to the tally.'''
+        if outcome_tally is None:
+            outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
+        for testcase in testcases:
             if testcase.outcome in self.passing_results:
                 outcome_tally[PASS] += 1
             else:
                 outcome_tally[testcase.outcome] += 1
+        return outcome_tally
+
+    def dump_testsuite(self, fstream, suite, idx):
+        # Tally results first.
+        outcome_tally = self.tally(suite.test_case_results)
 
         fstream.write(
                 self.testsuite_opening.format(
@@ -503,13 +678,8 @@ class JUnitFormatter(object):
         idx = 0
 
         # First tally results.
-        outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
-        for item in self.results:
-            if isinstance(item, TestCaseResult):
-                if item.outcome in self.passing_results:
-                    outcome_tally[PASS] += 1
-                else:
-                    outcome_tally[item.outcome] += 1
+        outcome_tally = self.tally(item for item in self.results
+                                   if isinstance(item, TestCaseResult))
 
         dumpfile.write(self.testsuites_opening.format(
             tests=outcome_tally[PASS],
@@ -525,3 +695,68 @@ class JUnitFormatter(object):
                 idx += 1
 
         dumpfile.write(self.generic_closing.format(tag='testsuites'))
+
+
+class JUnitWriter(JUnitFormatter):
+    '''
+    Writes a JUnit XML report one suite at a time as the suites finish, so
+    results don't need to be kept in memory.
+
+    After each suite the closing tag is rewritten after it and the totals at
+    the top of the report are patched in place, so the report is valid and
+    up to date if the run is killed. The file stream must be seekable.
+    '''
+    # Bytes reserved for the testsuites opening tag, which is padded with
+    # whitespace so its totals can be rewritten in place.
+    header_size = 160
+    trailer = '</testsuites>\n'
+
+    def __init__(self, fstream, **kwargs):
+        '''
+        .. seealso:: :func:`JUnitFormatter.__init__`
+        '''
+        super(JUnitWriter, self).__init__(None, **kwargs)
+        self.fstream = fstream
+        self.outcome_tally = self.tally(())
+        self._suites = 0
+        self._end = None
+
+    def begin(self):
+        '''Write an empty report.'''
+        self.fstream.write(self.xml_header)
+        self._header_offset = self.fstream.tell()
+        self._write_header()
+        self._end = self.fstream.tell()
+        self._write_trailer()
+
+    def add_suite(self, suite):
+        '''Append the results of a finished suite to the report.'''
+        self.fstream.seek(self._end)
+        self.dump_testsuite(self.fstream, suite, self._suites)
+        self._suites += 1
+        self.tally(suite.test_case_results, self.outcome_tally)
+        self._end = self.fstream.tell()
+        self._write_trailer()
+        self._write_header()
+
+    def finish(self, runtime):
+        '''Write the total runtime of the run.'''
+        self.runtime = runtime
+        self._write_header()
+
+    def _write_header(self):
+        opening = self.testsuites_opening.format(
+                tests=self.outcome_tally[PASS],
+                errors=self.outcome_tally[ERROR],
+                failures=self.outcome_tally[FAIL],
+                time=self.runtime)
+        # Whitespace is allowed before the end of a tag.
+        padding = ' ' * (self.header_size - len(opening))
+        self.fstream.seek(self._header_offset)
+        self.fstream.write(opening[:-2] + padding + opening[-2:])
+        self.fstream.flush()
+
+    def _write_trailer(self):
+        self.fstream.write(self.trailer)
+        self.fstream.truncate()
+        self.fstream.flush()
@@ -0,0 +1,262 @@
+'''
+Reads and writes the internal results of a run, the file named by
+`constants.pickle_filename` in the result path.
+
+The file starts with a header holding its format :data:`version`, followed by
+a frame for each result. A frame is a small header with the kind of frame,
+the length of its payload and a CRC of it, followed by the payload: the
+result pickled with `constants.pickle_protocol`. Once the run finishes an
+index frame is appended holding the offsets of results by uid and by
+outcome, and the file ends with the offset of the index.
+
+A :class:`ResultReader` reads the index and seeks straight to the results it
+needs, e.g. the suites which failed for the `rerun` command. If a run was
+killed before it wrote the index, the frames are scanned instead, stopping at
+the first incomplete frame, which is how `run --resume` finds the suites that
+finished. Files written before this format, a plain stream
+of pickles, are still read.
+
+Results are flushed as each suite finishes, but only synced to disk every
+:data:`sync_interval` seconds so that a run of many short suites isn't
+bounded by the disk.
+'''
+import cPickle as pickle
+import os
+import struct
+import time
+import zlib
+
+from config import constants
+
+# Version of the format, written after the magic.
+version = 1
+
+# Minimum seconds between syncs of the file to disk.
+sync_interval = 1.0
+
+_magic = 'WHIMSYRF'
+_header = struct.Struct('>8sH')
+
+# Kind, payload length and CRC of each frame.
+_frame = struct.Struct('>BII')
+_result_frame = 1
+_index_frame = 2
+
+# Offset of the index frame followed by the magic, at the very end.
+_trailer = struct.Struct('>Q8s')
+_trailer_magic = 'WHIMSYIX'
+
+
+class ResultFileError(Exception):
+    pass
+
+
+def _is_suite(result):
+    return hasattr(result, 'test_case_results')
+
+
+class _Index(object):
+    '''Offsets of results by uid and by the outcome of suites and tests.'''
+    def __init__(self):
+        # Dictionary mapping uid->offset of its latest result.
+        self.uids = {}
+        # Dictionaries mapping outcome value->offsets of suites/testcases.
+        self.suites = {}
+        self.testcases = {}
+
+    def add(self, offset, result):
+        self.uids[result.uid] = offset
+        by_outcome = self.suites if _is_suite(result) else self.testcases
+        by_outcome.setdefault(result.outcome.val, []).append(offset)
+
+    def dumps(self):
+        return pickle.dumps({'uids': self.uids, 'suites': self.suites,
+                             'testcases': self.testcases},
+                            constants.pickle_protocol)
+
+    @staticmethod
+    def loads(data):
+        fields = pickle.loads(data)
+        index = _Index()
+        index.uids = fields['uids']
+        index.suites = fields['suites']
+        index.testcases = fields['testcases']
+        return index
+
+
+class ResultWriter(object):
+    '''
+    Appends results to a new result file, writing the index once
+    :func:`close` is called.
+    '''
+    def __init__(self, fstream):
+        self.fstream = fstream
+        self._index = _Index()
+        self._last_sync = time.time()
+        self.fstream.write(_header.pack(_magic, version))
+        self._offset = _header.size
+
+    def _write_frame(self, kind, payload):
+        offset = self._offset
+        self.fstream.write(_frame.pack(kind, len(payload),
+                                       zlib.crc32(payload) & 0xffffffff))
+        self.fstream.write(payload)
+        self._offset += _frame.size + len(payload)
+        return offset
+
+    def append(self, result):
+        '''Append a :class:`whimsy.result.TestResult`.'''
+        payload = pickle.dumps(result, constants.pickle_protocol)
+        self._index.add(self._write_frame(_result_frame, payload), result)
+
+    def sync(self, force=False):
+        '''
+        Flush the results written so far, syncing them to disk if it has
+        been :data:`sync_interval` seconds since the last sync.
+        '''
+        self.fstream.flush()
+        now = time.time()
+        if force or now - self._last_sync >= sync_interval:
+            self._last_sync = now
+            try:
+                os.fsync(self.fstream.fileno())
+            except (AttributeError, OSError):
+                # Not a file on disk.
+                pass
+
+    def close(self):
+        '''Write the index, after which no more results can be appended.'''
+        offset = self._write_frame(_index_frame, self._index.dumps())
+        self.fstream.write(_trailer.pack(offset, _trailer_magic))
+        self.sync(force=True)
+
+
+class ResultReader(object):
+    '''
+    Reads the results in a result file.
+    '''
+    def __init__(self, fstream):
+        self.fstream = fstream
+        self._legacy = None
+        self._index = None
+        fstream.seek(0)
+        header = fstream.read(_header.size)
+        if len(header) < _header.size \
+                or _header.unpack(header)[0] != _magic:
+            # Written before results were framed, only a stream of pickles.
+            fstream.seek(0)
+            self._legacy = _load_pickles(fstream)
+            return
+        file_version = _header.unpack(header)[1]
+        if file_version > version:
+            raise ResultFileError('Results were written by a newer version'
+                                  ' (%d) of the format' % file_version)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._read_index()
+        return self._index
+
+    def _read_index(self):
+        if self._legacy is None:
+            self.fstream.seek(0, os.SEEK_END)
+            size = self.fstream.tell()
+            if size >= _header.size + _trailer.size:
+                self.fstream.seek(size - _trailer.size)
+                (offset, magic) = _trailer.unpack(
+                        self.fstream.read(_trailer.size))
+                if magic == _trailer_magic:
+                    frame = self._read_frame(offset)
+                    if frame is not None and frame[0] == _index_frame:
+                        return _Index.loads(frame[1])
+        # The run was killed before writing an index, build one.
+        index = _Index()
+        for (offset, result) in self._iter_offsets():
+            index.add(offset, result)
+        return index
+
+    def _read_frame(self, offset):
+        '''Return the (kind, payload) of the frame at offset, or None.'''
+        self.fstream.seek(offset)
+        header = self.fstream.read(_frame.size)
+        if len(header) < _frame.size:
+            return None
+        (kind, length, crc) = _frame.unpack(header)
+        payload = self.fstream.read(length)
+        if len(payload) < length \
+                or zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return (kind, payload)
+
+    def _iter_offsets(self):
+        if self._legacy is not None:
+            for (idx, result) in enumerate(self._legacy):
+                yield (idx, result)
+            return
+        offset = _header.size
+        while True:
+            frame = self._read_frame(offset)
+            if frame is None or frame[0] != _result_frame:
+                # The end of the results, or a frame left incomplete by a
+                # run which was killed.
+                return
+            yield (offset, pickle.loads(frame[1]))
+            offset += _frame.size + len(frame[1])
+
+    def __iter__(self):
+        '''Iterate over every result in the order they were written.'''
+        for (_, result) in self._iter_offsets():
+            yield result
+
+    def _load(self, offset):
+        if self._legacy is not None:
+            return self._legacy[offset]
+        frame = self._read_frame(offset)
+        if frame is None or frame[0] != _result_frame:
+            raise ResultFileError('Corrupt result at offset %d' % offset)
+        return pickle.loads(frame[1])
+
+    def lookup(self, uid):
+        '''Return the latest result of the item with uid, None if none.'''
+        offset = self.index.uids.get(uid)
+        return None if offset is None else self._load(offset)
+
+    def suites(self, outcomes=None):
+        '''
+        Return an iterator over suite results, only those with one of the
+        given outcomes if outcomes isn't None.
+        '''
+        return self._select(self.index.suites, outcomes)
+
+    def testcases(self, outcomes=None):
+        '''
+        Return an iterator over test case results, only those with one of
+        the given outcomes if outcomes isn't None.
+        '''
+        return self._select(self.index.testcases, outcomes)
+
+    def _select(self, by_outcome, outcomes):
+        if outcomes is None:
+            offsets = [offset for offsets in by_outcome.values()
+                       for offset in offsets]
+        else:
+            offsets = [offset for outcome in outcomes
+                       for offset in by_outcome.get(outcome.val, ())]
+        uids = self.index.uids
+        for offset in sorted(offsets):
+            result = self._load(offset)
+            # Skip results replaced by a later one for the same item.
+            if uids.get(result.uid) == offset:
+                yield result
+
+
+def _load_pickles(fstream):
+    results = []
+    while True:
+        try:
+            results.append(pickle.load(fstream))
+        except Exception:
+            # The end of the results, or a partial result left by a run
+            # which was killed.
+            return results
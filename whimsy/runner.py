@@ -30,13 +30,20 @@ When either run function is used the :class:`Runner` object first calls
 and are required by at least one of the tests suites.  Once all these fixtures
 have been set up the Runner begins to iterate through its test items.
 
+If the --pipeline flag is given, :func:`Runner.run` will instead setup the
+remaining fixtures of each suite in the background with
+a :class:`FixturePipeline` and start running suites as soon as their fixtures
+are ready, overlapping builds with testing.
+
 
 The run of a suite takes the following steps:
 
 1. Iterate through each TestCase passing suite level fixtures to them.
 
 2. Before the run of the TestCase takes place, start capturing stdout and
-   stderr to a directory named after the test case's uid.
+   stderr to a directory named after the test case's uid. Output is captured
+   with :func:`whimsy.capture.capture`, which only switches the target files
+   of a reader thread kept for the whole run.
 
 3. Build any fixtures that the the test relies on, if
    a :func:`whimsy.fixture.Fixture.setup` call fails the test outcome will
@@ -49,6 +56,11 @@ The run of a suite takes the following steps:
    skip their test while inside of it if they raise the TestSkipException by
    calling the :func:`whimsy.test.skip` function in :mod:`whimsy.test`.
 
+   The test runs under a :class:`whimsy.watchdog.Watchdog`, if it runs
+   longer than the timeout chosen by the runner's
+   :class:`whimsy.watchdog.TimeoutPolicy` (or past the timeout of its
+   TestSuite) it is stopped and marked as a failure which `timed_out`.
+
 Now returned from the test case with an outcome, we continue the same process
 for the remaining tests in the test suite, however, there are a couple
 remaining edge cases:
@@ -66,33 +78,234 @@ If a test fails in a `fail_fast` TestList then all the remaining items in that
 
 If a TestSuite is marked `fail_fast` and a test fails, then the remaining
 TestCase instances in that TestSuite will be skipped.
+
+If a TestSuite has a `timeout` and it expires, the remaining TestCase
+instances in that TestSuite will be skipped.
+
+If the --test-threads flag is greater than one, the TestCase instances of
+a `concurrent` :class:`whimsy.suite.TestList` are ran at the same time in
+a pool of threads. Output of each test is captured with
+:func:`whimsy.capture.thread_capture` and results are buffered, then both are
+reported in order as if the tests had been ran one after the other. Output
+of these tests is always written to their files, it is only echoed in the
+`tee` --capture mode.
+
+Suites and tests are ran as coroutines (see :mod:`whimsy.eventloop`), so tests
+which are coroutines themselves are waited on rather than called. The
+:class:`whimsy.coroutine.CoroutineRunner` uses this to run many suites at once
+in a single thread.
 '''
+import contextlib
+import sys
 import traceback
 import itertools
+import threading
+import time
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from terminal import separator
 import test
 import _util
-from result import ConsoleLogger, Outcome, test_results_output_path
+from result import ConsoleLogger, Outcome, ResultLogger, \
+        test_results_output_path
+import archive
+from capture import capture, capture_mode, thread_capture
 from config import config
-from helper import mkdir_p, joinpath
+import eventloop
+from eventloop import Return
+from fixture import setup_fixtures, setup_fixtures_async
+from helper import mkdir_p, joinpath, OrderedSet
+import logger
 from logger import log
-from suite import TestSuite, SuiteList
-from tee import tee
+from suite import TestSuite, SuiteList, TestList
+from tee import thread_streams, ThreadLocalStream
 from test import TestCase
+from watchdog import Watchdog, TimeoutPolicy, timeout_reason
+
+
+class FixturePipeline(object):
+    '''
+    Iterable which sets up the fixtures of the given suites in a background
+    thread, yielding each suite as soon as all of its fixtures (and those of
+    its test cases) have been setup.
+
+    Suites are built in the order given, but any suite whose fixtures are
+    already built is yielded immediately. For example, once an X86 gem5
+    binary has been built every X86 suite will be yielded while the ARM
+    binary is still building.
+
+    :var failures: Dictionary mapping fixture->error string for fixtures which
+        failed to setup.
+    '''
+    def __init__(self, suites, threads=1, on_setup=None):
+        '''
+        :param suites: Iterable of suites to build fixtures for.
+
+        :param threads: Number of fixtures which may be setup at once. See
+            :func:`whimsy.fixture.setup_fixtures`
+
+        :param on_setup: Function called with the :code:`(fixture, runtime,
+            error)` of each fixture setup, from the background thread.
+        '''
+        self.suites = tuple(suites)
+        self.threads = threads
+        self.on_setup = on_setup
+        self.failures = {}
+        self._ready = Queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def cancel(self):
+        '''Stop building fixtures once the current setup completes.'''
+        self._cancelled.set()
+
+    def _build(self):
+        done = set()
+        pending = [(suite, OrderedSet(SuiteList((suite,)).iter_fixtures()))
+                   for suite in self.suites]
+
+        def processed(fixture):
+            return fixture.built or fixture in done
+
+        while pending and not self._cancelled.is_set():
+            (_, fixtures) = pending[0]
+            unbuilt = [fixture for fixture in fixtures
+                       if not processed(fixture)]
+            for (fixture, runtime, error) in setup_fixtures(
+                    unbuilt, threads=self.threads):
+                done.add(fixture)
+                if error is not None:
+                    self.failures[fixture] = error
+                if self.on_setup is not None:
+                    self.on_setup(fixture, runtime, error)
+
+            # Release every suite which is now able to run.
+            still_pending = []
+            for (suite, fixtures) in pending:
+                if all(processed(fixture) for fixture in fixtures):
+                    self._ready.put(suite)
+                else:
+                    still_pending.append((suite, fixtures))
+            pending = still_pending
+        self._ready.put(None)
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._build)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        try:
+            while True:
+                try:
+                    suite = self._ready.get(True, _wait_timeout)
+                except Queue.Empty:
+                    continue
+                if suite is None:
+                    break
+                yield suite
+        finally:
+            self.cancel()
+
+
+# Timeout used when blocking on a queue. Python2 ignores interrupts while
+# waiting without a timeout.
+_wait_timeout = 0.5
+
+
+class _BufferedLogger(ResultLogger):
+    '''
+    A :class:`ResultLogger` which buffers the calls made to it so they can be
+    replayed into other loggers later with :func:`replay`.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, name, *args, **kwargs):
+        self.calls.append((name, args, kwargs))
+
+    def begin_testing(self):
+        pass
+
+    def begin(self, item):
+        self._record('begin', item)
+
+    def skip(self, item, **kwargs):
+        self._record('skip', item, **kwargs)
+
+    def set_current_outcome(self, outcome, **kwargs):
+        self._record('set_current_outcome', outcome, **kwargs)
+
+    def end_current(self):
+        self._record('end_current')
+
+    def fixture_setup(self, fixture, runtime, error=None):
+        self._record('fixture_setup', fixture, runtime, error)
+
+    def fixture_teardown(self, fixture):
+        self._record('fixture_teardown', fixture)
+
+    def end_testing(self):
+        pass
+
+    def replay(self, result_loggers, after_begin=None):
+        '''
+        :param after_begin: Function called with the item after replaying
+            each begin call.
+        '''
+        for (name, args, kwargs) in self.calls:
+            for result_logger in result_loggers:
+                getattr(result_logger, name)(*args, **kwargs)
+            if name == 'begin' and after_begin is not None:
+                after_begin(*args)
+
+
+@contextlib.contextmanager
+def _no_capture():
+    yield
+
+
+def _echo(path, stream):
+    for chunk in archive.iter_output(path):
+        stream.write(chunk)
+
+
+@contextlib.contextmanager
+def thread_local_output():
+    '''
+    Install :class:`whimsy.tee.ThreadLocalStream` objects as sys.stdout,
+    sys.stderr and the stream of the console log handler so that
+    :func:`whimsy.capture.thread_capture` captures both prints and log
+    messages.
+    '''
+    handler = logger.stdout_logger
+    with thread_streams():
+        stream = handler.stream
+        handler.stream = ThreadLocalStream('stdout', stream)
+        try:
+            yield
+        finally:
+            handler.stream = stream
 
 
 class Runner(object):
     '''
     The default runner class used for running test suites and cases.
     '''
-    def __init__(self, suites=tuple(), result_loggers=tuple()):
+    def __init__(self, suites=tuple(), result_loggers=tuple(),
+                 timeouts=None):
         '''
         :param suites: An iterable containing suites which are run when
         :func:`run` is called.
 
         :param result_loggers: Iterable containing items supporting the
         `ResultLogger` interface .
+
+        :param timeouts: :class:`whimsy.watchdog.TimeoutPolicy` used to choose
+        the timeout of each test. If None, uses the config's timeout.
+
+        :var fixture_failures: Dictionary mapping fixture->error for fixtures
+            which failed to setup ahead of time in a :class:`FixturePipeline`.
+            Tests requiring them will be marked as an ERROR.
         '''
         if not isinstance(suites, SuiteList):
             suites = SuiteList(suites)
@@ -100,6 +313,10 @@ class Runner(object):
         if not result_loggers:
             result_loggers = (ConsoleLogger(),)
         self.result_loggers = tuple(result_loggers)
+        if timeouts is None:
+            timeouts = TimeoutPolicy(config.timeout)
+        self.timeouts = timeouts
+        self.fixture_failures = {}
 
     @staticmethod
     def run_items(*items, **kwargs):
@@ -164,17 +381,38 @@ class Runner(object):
             log.warn('Error(s) while building non lazy_init fixtures.')
             log.warn(error_str)
 
+        if config.pipeline:
+            log.info('Building remaining fixtures in the background.')
+            suites = FixturePipeline(self.suites,
+                                     threads=config.setup_threads,
+                                     on_setup=self._log_fixture_setup)
+            self.fixture_failures = suites.failures
+        else:
+            suites = self.suites
+
+        outcomes = self.run_suites(suites)
+
+        for logger in self.result_loggers:
+            logger.end_testing()
+        return self._suite_outcome(outcomes)
+
+    def run_suites(self, suites):
+        '''
+        Run each of the given suites in order.
+
+        :returns: The set of outcomes of the suites which were ran.
+        '''
         outcomes = set()
-        for suite in self.suites:
+        for suite in suites:
             outcome = self.run_suite(suite)
             outcomes.add(outcome)
             if outcome in Outcome.failfast and config.fail_fast:
                 break
+        return outcomes
 
+    def _suite_started(self, test_suite, worker=None):
         for logger in self.result_loggers:
-            logger.end_testing()
-        return self._suite_outcome(outcomes)
-
+            logger.suite_started(test_suite, worker)
 
     def run_suite(self, test_suite):
         '''
@@ -185,6 +423,10 @@ class Runner(object):
            - Collect results as tests are performed.
         2. Handle teardown for all fixtures in the test_suite.
         '''
+        return eventloop.run(self.run_suite_async(test_suite))
+
+    def run_suite_async(self, test_suite):
+        '''Coroutine version of :func:`run_suite`.'''
         for logger in self.result_loggers:
             logger.begin(test_suite)
 
@@ -192,12 +434,40 @@ class Runner(object):
 
         outcomes = set()
 
+        deadline = None
+        if test_suite.timeout is not None:
+            deadline = time.time() + test_suite.timeout
+
         suite_timer = _util.Timer()
         suite_timer.start()
         for (idx, (testlist, testcase)) in suite_iterator:
             assert isinstance(testcase, TestCase)
-            outcome = self.run_test(testcase, fixtures=test_suite.fixtures)
-            outcomes.add(outcome)
+            if deadline is not None and time.time() >= deadline:
+                log.bold('TestSuite timed out. Skipping remaining tests.')
+                rem_iter = itertools.chain(
+                        (testcase,),
+                        (testcase for _, (_, testcase) in suite_iterator))
+                self._generate_skips(
+                        testcase.name, rem_iter,
+                        reason='TestSuite timed out after %s seconds.'
+                               % test_suite.timeout)
+                break
+            if self._runs_concurrently(testlist):
+                batch = self._concurrent_batch(testlist, testcase)
+                for _ in batch[1:]:
+                    next(suite_iterator)
+                reported = self._run_concurrently(test_suite, batch, deadline)
+                outcomes.update(outcome for (_, outcome) in reported)
+                (testcase, outcome) = reported[-1]
+                idx += len(reported) - 1
+                unreported = batch[len(reported):]
+            else:
+                outcome = yield self.run_test_async(
+                        testcase,
+                        fixtures=test_suite.fixtures,
+                        deadline=deadline)
+                outcomes.add(outcome)
+                unreported = ()
 
             # If there was a chance we might need to skip the remaining
             # tests...
@@ -210,8 +480,10 @@ class Runner(object):
                 elif test_suite.fail_fast:
                     log.bold('Test failed in a fail_fast TestSuite. Skipping'
                              ' remaining tests.')
-                    rem_iter = (testcase for _, (_, testcase) \
-                                in suite_iterator)
+                    rem_iter = itertools.chain(
+                            unreported,
+                            (testcase for _, (_, testcase) \
+                             in suite_iterator))
                     self._generate_skips(testcase.name, rem_iter)
                 elif testlist.fail_fast:
                     log.bold('Test failed in a fail_fast TestList. Skipping'
@@ -222,8 +494,7 @@ class Runner(object):
                     # Iterate through the current testlist skipping its tests.
                     self._generate_skips(testcase.name, rem_iter)
 
-        for fixture in test_suite.fixtures.values():
-            fixture.teardown()
+        self._teardown_fixtures(test_suite.fixtures.values())
         suite_timer.stop()
 
         outcome = self._suite_outcome(outcomes)
@@ -231,7 +502,7 @@ class Runner(object):
         for logger in self.result_loggers:
             logger.end_current()
 
-        return outcome
+        raise Return(outcome)
 
     def _suite_outcome(self, outcomes):
         '''
@@ -257,7 +528,7 @@ class Runner(object):
         else:
             return Outcome.PASS
 
-    def run_test(self, testobj, fixtures=None):
+    def run_test(self, testobj, fixtures=None, deadline=None):
         '''
         Run the given test.
 
@@ -269,19 +540,189 @@ class Runner(object):
 
         3. Teardown the fixtures for the test which are tied locally to the\
             test.
+
+        :param deadline: Time (as given by :func:`time.time`) the test must
+            be finished by regardless of its own timeout, e.g. the timeout
+            of its suite.
         '''
-        outdir = test_results_output_path(testobj)
-        mkdir_p(outdir)
-        fstdout_name = joinpath(outdir, config.constants.system_err_name)
-        fstderr_name = joinpath(outdir, config.constants.system_out_name)
+        return eventloop.run(self.run_test_async(testobj, fixtures, deadline))
+
+    def run_test_async(self, testobj, fixtures=None, deadline=None):
+        '''Coroutine version of :func:`run_test`.'''
+        (fstdout_name, fstderr_name) = self._output_paths(testobj)
 
         # Capture the output into a file.
-        with tee(fstderr_name, stderr=True, stdout=False),\
-                tee(fstdout_name, stderr=False, stdout=True):
-            return self._run_test(testobj, fstdout_name,
-                                  fstderr_name, fixtures)
+        outcome = yield self._run_test(
+                testobj, fstdout_name, fstderr_name, fixtures, deadline,
+                capture=self._capture(fstdout_name, fstderr_name))
+        raise Return(outcome)
+
+    def _capture(self, fstdout_name, fstderr_name):
+        '''
+        Capture the output of a test into the given files, returning
+        a context manager.
+        '''
+        return capture(fstdout_name, fstderr_name)
+
+    def _output_paths(self, testobj):
+        '''
+        Create the output directory of the test, returning the paths to
+        capture its stdout and stderr in.
+        '''
+        outdir = test_results_output_path(testobj)
+        if not archive.enabled():
+            mkdir_p(outdir)
+        fstdout_name = joinpath(outdir, config.constants.system_out_name)
+        fstderr_name = joinpath(outdir, config.constants.system_err_name)
+        return (fstdout_name, fstderr_name)
+
+    def _runs_concurrently(self, testlist):
+        return config.test_threads > 1 and testlist.concurrent \
+                and not testlist.fail_fast
+
+    def _concurrent_batch(self, testlist, testcase):
+        '''
+        Return the tests directly in testlist starting at testcase, up to the
+        next TestList within it.
+        '''
+        batch = []
+        for item in testlist.items[testlist.items.index(testcase):]:
+            if isinstance(item, TestList):
+                break
+            batch.append(item)
+        return batch
+
+    def _run_concurrently(self, test_suite, tests, deadline=None):
+        '''
+        Run the given tests at the same time in a pool of --test-threads
+        threads. Each test is ran by its own runner which buffers its
+        results, these are then reported in order along with the output the
+        test captured.
+
+        :returns: A list of :code:`(testcase, outcome)` tuples of the tests
+            reported. Reporting stops after the first test to fail if the
+            --fail-fast flag was given or the suite is `fail_fast`, since
+            a serial run would not have ran the following tests.
+        '''
+        fixtures = test_suite.fixtures
+
+        # Setup lazy fixtures here rather than racing to set them up in each
+        # thread.
+        failures = dict(self.fixture_failures)
+        failures.update(self.setup_unbuilt(
+                itertools.chain(fixtures.values(),
+                                *(testobj.fixtures.values()
+                                  for testobj in tests)),
+                setup_lazy_init=True))
+
+        def run(testobj):
+            buffered = _BufferedLogger()
+            runner = Runner(result_loggers=(buffered,),
+                            timeouts=self.timeouts)
+            runner.fixture_failures = failures
+            (fstdout_name, fstderr_name) = self._output_paths(testobj)
+            outcome = eventloop.run(runner._run_test(
+                    testobj, fstdout_name, fstderr_name, fixtures, deadline,
+                    capture=thread_capture(fstdout_name, fstderr_name)))
+            return (outcome, buffered)
+
+        pool = ThreadPool(min(config.test_threads, len(tests)))
+        with thread_local_output():
+            try:
+                results = pool.map_async(run, tests)
+                while not results.ready():
+                    results.wait(_wait_timeout)
+                results = results.get()
+            finally:
+                pool.close()
+                pool.join()
+
+        reported = []
+        for (testobj, (outcome, buffered)) in zip(tests, results):
+            buffered.replay(self.result_loggers,
+                            after_begin=self._echo_output)
+            reported.append((testobj, outcome))
+            if outcome in Outcome.failfast \
+                    and (config.fail_fast or test_suite.fail_fast):
+                break
+        return reported
+
+    def _echo_output(self, item):
+        '''
+        Write the output captured for the item if it's a test and the
+        --capture mode echoes output.
+        '''
+        if isinstance(item, TestCase) and capture_mode() == 'tee':
+            (fstdout_name, fstderr_name) = self._output_paths(item)
+            _echo(fstdout_name, sys.stdout)
+            _echo(fstderr_name, sys.stderr)
+
+    def _test_timeout(self, testobj, deadline):
+        timeout = self.timeouts.timeout(testobj)
+        if deadline is not None:
+            remaining = max(deadline - time.time(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def _call_test(self, testobj, fixtures, timeout):
+        '''
+        Coroutine which runs the test, waiting on it if it's a coroutine and
+        otherwise calling it under a :class:`whimsy.watchdog.Watchdog`.
+
+        :returns: A tuple :code:`(outcome, reason, timed_out)`.
+        '''
+        watchdog = Watchdog(timeout, name=testobj.name)
+        timed_out = False
+        reason = None
+        try:
+            if testobj.is_coroutine:
+                yield eventloop.wait_for(testobj.coroutine(fixtures), timeout)
+            else:
+                with watchdog:
+                    testobj(fixtures=fixtures)
+        except eventloop.TimeoutError as e:
+            log.warn('%s timed out after %.2f seconds.'
+                     % (testobj.name, e.timeout))
+            reason = timeout_reason(e.timeout, e.stack)
+            outcome = Outcome.FAIL
+            timed_out = True
+        except AssertionError as e:
+            reason = e.message
+            if not reason:
+                reason = traceback.format_exc()
+            outcome = Outcome.FAIL
+        except test.TestSkipException as e:
+            reason = e.message
+            outcome = Outcome.SKIP
+        except test.TestFailException as e:
+            reason = e.message
+            outcome = Outcome.FAIL
+        except Exception as e:
+            reason = traceback.format_exc()
+            outcome = Outcome.FAIL
+        else:
+            outcome = Outcome.PASS
+
+        if watchdog.expired:
+            # Whatever the test raised was caused by us stopping it.
+            outcome = Outcome.FAIL
+            reason = watchdog.reason
+            timed_out = True
+        raise Return((outcome, reason, timed_out))
 
-    def _run_test(self, testobj, fstdout_name, fstderr_name, fixtures):
+    def _run_test(self, testobj, fstdout_name, fstderr_name, fixtures,
+                  deadline=None, capture=None):
+        '''
+        Coroutine which sets up the fixtures of the test and runs it,
+        reporting its result.
+
+        :param capture: Context manager returned by :func:`_capture` to run
+            the test in. Its result is reported once the capture has ended so
+            it isn't hidden by the --capture mode.
+        '''
+        if capture is None:
+            capture = _no_capture()
         if fixtures is None:
             fixtures = {}
 
@@ -296,47 +737,31 @@ class Runner(object):
         for logger in self.result_loggers:
             logger.begin(testobj)
 
-        def _run_test():
-            reason = None
-            try:
-                testobj(fixtures=fixtures)
-            except AssertionError as e:
-                reason = e.message
-                if not reason:
-                    reason = traceback.format_exc()
-                outcome = Outcome.FAIL
-            except test.TestSkipException as e:
-                reason = e.message
-                outcome = Outcome.SKIP
-            except test.TestFailException as e:
-                reason = e.message
-                outcome = Outcome.FAIL
-            except Exception as e:
-                reason = traceback.format_exc()
-                outcome = Outcome.FAIL
+        with capture as captured:
+            # Build any fixtures that haven't been built yet.
+            log.debug('Building fixtures for TestCase: %s' % testobj.name)
+            failed_builds = yield self.setup_unbuilt_async(
+                    fixtures.values(),
+                    setup_lazy_init=True)
+
+            timed_out = False
+
+            if failed_builds:
+                reason = ''
+                for fixture, error in failed_builds:
+                    reason += 'Failed to build %s\n' % fixture
+                    reason += '%s' % error
+                reason = reason
+                outcome = Outcome.ERROR
             else:
-                outcome = Outcome.PASS
-
-            return (outcome, reason)
-
-        # Build any fixtures that haven't been built yet.
-        log.debug('Building fixtures for TestCase: %s' % testobj.name)
-        failed_builds = self.setup_unbuilt(
-                fixtures.values(),
-                setup_lazy_init=True)
+                (outcome, reason, timed_out) = yield self._call_test(
+                        testobj, fixtures,
+                        self._test_timeout(testobj, deadline))
 
-        if failed_builds:
-            reason = ''
-            for fixture, error in failed_builds:
-                reason += 'Failed to build %s\n' % fixture
-                reason += '%s' % error
-            reason = reason
-            outcome = Outcome.ERROR
-        else:
-            (outcome, reason) = _run_test()
+            self._teardown_fixtures(testobj.fixtures.values())
 
-        for fixture in testobj.fixtures.values():
-            fixture.teardown()
+            if outcome in Outcome.failfast and captured is not None:
+                captured.keep()
 
         test_timer.stop()
         self._log_outcome(
@@ -344,12 +769,13 @@ class Runner(object):
                 reason=reason,
                 runtime=test_timer.runtime(),
                 fstdout_name=fstdout_name,
-                fstderr_name=fstderr_name)
+                fstderr_name=fstderr_name,
+                timed_out=timed_out)
 
         for logger in self.result_loggers:
             logger.end_current()
 
-        return outcome
+        raise Return(outcome)
 
     def _remaining_testlist_tests(self, current_item, testlist,
                                   suite_iterator):
@@ -383,15 +809,19 @@ class Runner(object):
         return (testcase for testcase, _ in combined_iterator)
 
 
-    def _generate_skips(self, failed_test, remaining_iterator):
+    def _generate_skips(self, failed_test, remaining_iterator, reason=None):
         '''
         Generate SKIP for all remaining tests (for use with the failfast
         suite option)
+
+        :param reason: Reason given for the skips, defaults to the failure of
+            failed_test.
         '''
+        if reason is None:
+            reason = ("Previous test '%s' failed in a failfast"
+                      " TestSuite." % failed_test)
         for testcase in remaining_iterator:
             if isinstance(testcase, TestCase):
-                reason = ("Previous test '%s' failed in a failfast"
-                        " TestSuite." % failed_test)
                 for logger in self.result_loggers:
                     logger.skip(testcase, reason=reason)
             elif __debug__:
@@ -401,14 +831,65 @@ class Runner(object):
         for logger in self.result_loggers:
             logger.set_current_outcome(outcome, **kwargs)
 
-    def setup_unbuilt(self, fixtures, setup_lazy_init=False):
-        failures = []
+    def _log_fixture_setup(self, fixture, runtime, error):
+        for logger in self.result_loggers:
+            logger.fixture_setup(fixture, runtime, error)
+
+    def _teardown_fixtures(self, fixtures):
         for fixture in fixtures:
-            if not fixture.built:
-                if fixture.lazy_init == setup_lazy_init:
-                    try:
-                        fixture.setup()
-                    except Exception as e:
-                        failures.append((fixture.name,
-                                         traceback.format_exc()))
+            fixture.teardown()
+            for logger in self.result_loggers:
+                logger.fixture_teardown(fixture)
+
+    def setup_unbuilt(self, fixtures, setup_lazy_init=False):
+        '''
+        Setup the given fixtures which are not yet built and whose
+        `lazy_init` matches setup_lazy_init.
+
+        Fixtures are setup with :func:`whimsy.fixture.setup_fixtures` using
+        up to the config's setup_threads at once. Fixtures which failed to
+        setup before are not setup again.
+
+        :returns: A list of :code:`(fixture name, error)` tuples for each
+            fixture which failed to setup.
+        '''
+        fixtures = OrderedSet(fixtures)
+        failures = [(fixture.name, self.fixture_failures[fixture])
+                    for fixture in fixtures
+                    if fixture in self.fixture_failures]
+        fixtures = OrderedSet(fixture for fixture in fixtures
+                              if not fixture.built
+                              and fixture not in self.fixture_failures
+                              and fixture.lazy_init == setup_lazy_init)
+        for (fixture, runtime, error) in setup_fixtures(
+                fixtures, threads=config.setup_threads):
+            if error is not None:
+                failures.append((fixture.name, error))
+            self._log_fixture_setup(fixture, runtime, error)
         return failures
+
+    def setup_unbuilt_async(self, fixtures, setup_lazy_init=False):
+        '''
+        Coroutine version of :func:`setup_unbuilt` which sets up fixtures on
+        the event loop with :func:`whimsy.fixture.setup_fixtures_async`.
+
+        Only fixtures which override :func:`whimsy.fixture.Fixture.setup_async`
+        let other tasks run while they are setup, others block the loop. Every
+        runner sets up the fixtures of each test this way, but only the
+        :class:`whimsy.coroutine.CoroutineRunner` has other suites to run
+        meanwhile.
+        '''
+        fixtures = OrderedSet(fixtures)
+        failures = [(fixture.name, self.fixture_failures[fixture])
+                    for fixture in fixtures
+                    if fixture in self.fixture_failures]
+        fixtures = [fixture for fixture in fixtures
+                    if not fixture.built
+                    and fixture not in self.fixture_failures
+                    and fixture.lazy_init == setup_lazy_init]
+        results = yield setup_fixtures_async(fixtures)
+        for (fixture, runtime, error) in results:
+            if error is not None:
+                failures.append((fixture.name, error))
+            self._log_fixture_setup(fixture, runtime, error)
+        raise Return(failures)
@@ -0,0 +1,153 @@
+'''
+Contains policies used to decide the order test suites are ran in.
+
+Ordering policies are functions taking a list of suites and
+a :class:`whimsy.history.ResultHistory` and returning a new list of those
+suites. They are registered by name in :data:`ordering_policies`:
+
+* discovery - The order the suites were discovered in. (Default)
+
+* longest-first - Suites with the longest previous runtime first. When
+    running in parallel this keeps long suites from being started last and
+    holding up the end of the run.
+
+* failed-first - Suites which failed or errored in the previous run first,
+    followed by suites which have not been ran before. Together with
+    --fail-fast this reports known failures as soon as possible.
+
+Suites may also be split into shards with :func:`shard_suites` so separate
+machines can each run a portion of the suites.
+'''
+import zlib
+
+from result import Outcome
+
+
+def discovery_order(suites, history):
+    '''Keep suites in the order they were given.'''
+    return list(suites)
+
+
+def _known_runtimes(suites, history):
+    '''
+    Return a list with the previous runtime of each suite, or its declared
+    :attr:`whimsy.suite.Resources.duration` if it has not been ran. None if
+    neither is known.
+    '''
+    runtimes = []
+    for suite in suites:
+        runtime = history.runtime(suite.uid)
+        if runtime is None:
+            runtime = suite.required_resources.duration
+        runtimes.append(runtime)
+    return runtimes
+
+
+def _expected_runtimes(runtimes):
+    '''
+    Fill in unknown runtimes with the mean of the known ones.
+    '''
+    known = [runtime for runtime in runtimes if runtime is not None]
+    default = float(sum(known)) / len(known) if known else 0
+    return [default if runtime is None else runtime for runtime in runtimes]
+
+
+def expected_runtimes(suites, history):
+    '''
+    Return a list with the expected runtime of each suite, its previous
+    runtime or declared duration, otherwise the mean of the others.
+    '''
+    return _expected_runtimes(_known_runtimes(suites, history))
+
+
+def longest_first_order(suites, history):
+    '''
+    Order suites by their previous runtime, longest first. Suites which
+    have not been ran are expected to take their declared duration, or if
+    they do not declare one, the mean runtime of the others.
+    '''
+    expected = dict(zip(suites, expected_runtimes(suites, history)))
+    # sorted is stable so ties remain in discovery order.
+    return sorted(suites, key=lambda suite: expected[suite], reverse=True)
+
+
+def failed_first_order(suites, history):
+    '''
+    Order suites which failed in the previous run first, followed by suites
+    which have not been ran, then all others.
+    '''
+    def rank(suite):
+        outcome = history.outcome(suite.uid)
+        if outcome in Outcome.failfast:
+            return 0
+        elif outcome is None:
+            return 1
+        return 2
+    return sorted(suites, key=rank)
+
+
+ordering_policies = {
+    'discovery': discovery_order,
+    'longest-first': longest_first_order,
+    'failed-first': failed_first_order,
+}
+
+default_ordering_policy = 'discovery'
+
+
+def order_suites(suites, policy, history):
+    '''
+    Return a list of the suites ordered by the named policy.
+
+    :param policy: Name of a policy in :data:`ordering_policies`.
+    '''
+    return ordering_policies[policy](list(suites), history)
+
+
+def shard_suites(suites, count, history):
+    '''
+    Partition the suites into count shards.
+
+    The partition only depends on the suite uids and the given history so
+    that every machine loading the same tests with the same history computes
+    the same shards. Every shard must therefore be computed from the same
+    history, not one which is updated as shards are ran.
+
+    If the history contains runtimes or suites declare durations, suites are
+    assigned longest first to the shard with the least expected runtime so
+    far. Suites without either are expected to take the mean runtime.
+    Otherwise suites are assigned by a hash of their uid.
+
+    :returns: A list of count lists of suites, each in the original order of
+        the given suites.
+    '''
+    suites = list(suites)
+    shards = [[] for _ in range(count)]
+    runtimes = _known_runtimes(suites, history)
+
+    if all(runtime is None for runtime in runtimes):
+        for idx, suite in enumerate(suites):
+            # crc32 rather than hash() since it's stable between
+            # interpreters and machines.
+            shards[(zlib.crc32(suite.uid) & 0xffffffff) % count].append(idx)
+    else:
+        expected = _expected_runtimes(runtimes)
+        loads = [0] * count
+        # Ties are broken by uid rather than discovery order.
+        for idx in sorted(range(len(suites)),
+                          key=lambda idx: (-expected[idx], suites[idx].uid)):
+            shard = loads.index(min(loads))
+            shards[shard].append(idx)
+            loads[shard] += expected[idx]
+
+    return [[suites[idx] for idx in sorted(shard)] for shard in shards]
+
+
+def select_shard(suites, shard, history):
+    '''
+    Return the suites in the given shard.
+
+    :param shard: Tuple :code:`(index, count)`, index starts at 1.
+    '''
+    (index, count) = shard
+    return shard_suites(suites, count, history)[index - 1]
@@ -0,0 +1,316 @@
+'''
+Stages results on local disk before they are copied to the result path.
+
+With --stage-dir, results and captured output are written to a directory in
+the given (local, ideally tmpfs) directory rather than to --result-path,
+which may be on a slow network filesystem. A :class:`StagingLogger` hands
+the outputs of each suite to a :class:`Stager` as the suite finishes, whose
+background thread copies them to the result path in a batch. Once testing
+ends the remaining files, such as the pickle and junit results, are copied
+last so the result path never refers to output which hasn't arrived. Paths
+of outputs in the pickled results, and those the junit report refers to with
+``--junit-output reference``, are rewritten to the result path.
+
+Every file is copied to a temporary name and renamed into place, so readers
+of the result path only see complete files. Archives written with
+--output-archive are append-only, so only the bytes appended since the last
+copy are copied, the archive before its index.
+
+If a run is killed before its results were copied, the stage directory is
+left behind. The next run given the same --stage-dir finishes copying it
+before it starts.
+'''
+import contextlib
+import errno
+import os
+import shutil
+import threading
+import Queue
+
+import archive
+import resultfile
+from config import config, constants
+from helper import joinpath, mkdir_p
+from logger import log
+from result import JUnitFormatter, ResultLogger
+from suite import TestSuite
+
+# Prefix of the directories runs are staged in.
+stage_prefix = 'whimsy-stage-'
+
+# File in a stage directory holding the result path it is copied to.
+_final_path_name = '.final-path'
+
+# Suffix of files while they are being copied.
+_partial_suffix = '.staging'
+
+_chunk_size = 1024 * 1024
+
+# Timeout used while waiting for copies. Python2 ignores interrupts while
+# waiting without a timeout.
+_wait_timeout = 0.5
+
+
+class Stager(object):
+    '''
+    Copies files written in a stage directory to the final result path on
+    a background thread.
+    '''
+    def __init__(self, stage_path, final_path):
+        self.stage_path = stage_path
+        self.final_path = final_path
+        # Dictionary mapping relative path->(size, mtime) when last copied.
+        self._copied = {}
+        # Dictionary mapping relative path of an archive->bytes copied.
+        self._appended = {}
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    @staticmethod
+    def create(stage_dir, final_path):
+        '''Create the stage directory of this process in stage_dir.'''
+        stage_path = joinpath(stage_dir, '%s%d' % (stage_prefix, os.getpid()))
+        if os.path.exists(stage_path):
+            shutil.rmtree(stage_path)
+        mkdir_p(stage_path)
+        with open(joinpath(stage_path, _final_path_name), 'w') as fstream:
+            fstream.write(final_path)
+        return Stager(stage_path, final_path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def sync(self, paths):
+        '''
+        Copy the given files in the stage directory, along with any output
+        archives, in the background.
+        '''
+        self._queue.put(('sync', list(paths)))
+
+    def flush(self):
+        '''Wait until every file given to :func:`sync` has been copied.'''
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        while not done.wait(_wait_timeout):
+            pass
+
+    def finish(self):
+        '''
+        Copy every file remaining in the stage directory and remove it.
+        '''
+        if self._thread is not None:
+            self.flush()
+            self._queue.put(('stop', None))
+            self._thread.join()
+            self._thread = None
+        self._copy_all()
+        shutil.rmtree(self.stage_path)
+
+    def _run(self):
+        while True:
+            (task, arg) = self._queue.get()
+            if task == 'stop':
+                return
+            if task == 'flush':
+                arg.set()
+                continue
+            try:
+                for path in arg:
+                    self._copy(os.path.relpath(path, self.stage_path))
+                self._copy_archives()
+            except (IOError, OSError) as e:
+                log.warn('Failed to copy staged results to %s: %s'
+                         % (self.final_path, e))
+
+    def _copy_all(self):
+        # Outputs and archives first, then results referring to them.
+        results = []
+        for (dirpath, _, filenames) in os.walk(self.stage_path):
+            for filename in filenames:
+                rel = os.path.relpath(joinpath(dirpath, filename),
+                                      self.stage_path)
+                if dirpath == self.stage_path:
+                    if filename != _final_path_name \
+                            and not _is_archive(filename):
+                        results.append(rel)
+                else:
+                    self._copy(rel)
+        self._copy_archives()
+        for rel in results:
+            self._copy(rel)
+
+    def _copy(self, rel):
+        source = joinpath(self.stage_path, rel)
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Not every --capture mode writes output.
+                return
+            raise
+        if self._copied.get(rel) == (stat.st_size, stat.st_mtime):
+            return
+        destination = joinpath(self.final_path, rel)
+        mkdir_p(os.path.dirname(destination))
+        if rel == constants.pickle_filename:
+            self._relocate_results(source, destination + _partial_suffix)
+        elif rel == constants.junit_filename:
+            self._relocate_junit(source, destination + _partial_suffix)
+        else:
+            shutil.copyfile(source, destination + _partial_suffix)
+        os.rename(destination + _partial_suffix, destination)
+        self._copied[rel] = (stat.st_size, stat.st_mtime)
+
+    def _relocate_results(self, source, destination):
+        # Results refer to the outputs they captured by their staged paths.
+        # Results which are incomplete since the run is ongoing or was
+        # killed are left out by the reader.
+        with open(source, 'rb') as fsource, \
+                open(destination, 'wb') as fdestination:
+            writer = resultfile.ResultWriter(fdestination)
+            for result in resultfile.ResultReader(fsource):
+                for item in [result] + getattr(result, 'test_case_results',
+                                               []):
+                    self._relocate(item)
+                writer.append(result)
+            writer.close()
+
+    def _relocate_junit(self, source, destination):
+        # A report which only refers to outputs refers to their staged paths.
+        prefix = JUnitFormatter.reference_message.split('{location}')[0]
+        (staged, final) = (prefix + self.stage_path + os.sep,
+                           prefix + self.final_path + os.sep)
+        with open(source, 'r') as fsource, \
+                open(destination, 'w') as fdestination:
+            for line in fsource:
+                fdestination.write(line.replace(staged, final))
+
+    def _relocate(self, result):
+        for attr in ('fstdout_name', 'fstderr_name'):
+            path = getattr(result, attr, None)
+            if path is not None \
+                    and path.startswith(self.stage_path + os.sep):
+                setattr(result, attr, joinpath(
+                        self.final_path,
+                        os.path.relpath(path, self.stage_path)))
+
+    def _copy_archives(self):
+        for filename in sorted(os.listdir(self.stage_path)):
+            if filename.endswith(archive.archive_suffix):
+                # Copy the records before the index which refers to them.
+                self._append(filename)
+                self._append(filename + archive.index_suffix)
+
+    def _append(self, rel):
+        source = joinpath(self.stage_path, rel)
+        if not os.path.exists(source):
+            return
+        copied = self._appended.get(rel, 0)
+        mode = 'ab' if copied else 'wb'
+        mkdir_p(self.final_path)
+        with open(source, 'rb') as fsource, \
+                open(joinpath(self.final_path, rel), mode) as fdestination:
+            fsource.seek(copied)
+            for chunk in iter(lambda: fsource.read(_chunk_size), ''):
+                fdestination.write(chunk)
+                copied += len(chunk)
+        self._appended[rel] = copied
+
+
+def _is_archive(filename):
+    return filename.endswith(archive.archive_suffix) \
+            or filename.endswith(archive.archive_suffix
+                                 + archive.index_suffix)
+
+
+class StagingLogger(ResultLogger):
+    '''
+    :class:`ResultLogger` which has the :class:`Stager` copy the outputs of
+    each suite once it finishes.
+    '''
+    def __init__(self, stager):
+        self.stager = stager
+        self._items = []
+        self._paths = []
+
+    def begin_testing(self):
+        pass
+
+    def begin(self, item):
+        self._items.append(item)
+
+    def skip(self, item, **kwargs):
+        self._add_paths(kwargs)
+
+    def set_current_outcome(self, outcome, **kwargs):
+        self._add_paths(kwargs)
+
+    def _add_paths(self, kwargs):
+        for key in ('fstdout_name', 'fstderr_name'):
+            if kwargs.get(key) is not None:
+                self._paths.append(kwargs[key])
+
+    def end_current(self):
+        if isinstance(self._items.pop(), TestSuite):
+            self.stager.sync(self._paths)
+            self._paths = []
+
+    def end_testing(self):
+        self.stager.flush()
+
+
+def recover(stage_dir):
+    '''
+    Finish copying the stage directories in stage_dir left behind by runs
+    which were killed.
+    '''
+    if not os.path.isdir(stage_dir):
+        return
+    for name in os.listdir(stage_dir):
+        stage_path = joinpath(stage_dir, name)
+        final_path_name = joinpath(stage_path, _final_path_name)
+        if not name.startswith(stage_prefix) \
+                or not os.path.exists(final_path_name) \
+                or _running(name[len(stage_prefix):]):
+            continue
+        with open(final_path_name, 'r') as fstream:
+            final_path = fstream.read()
+        log.display('Copying results staged by an interrupted run to %s'
+                    % final_path)
+        Stager(stage_path, final_path).finish()
+
+
+def _running(pid):
+    if not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+@contextlib.contextmanager
+def staged_results():
+    '''
+    Context manager which stages results written to the result path while
+    it is active if --stage-dir was given.
+
+    :returns: A tuple of the result loggers which should be added to the run,
+        empty if results aren't being staged.
+    '''
+    if config.stage_dir is None:
+        yield ()
+        return
+
+    final_path = config.result_path
+    stager = Stager.create(config.stage_dir, final_path)
+    stager.start()
+    config.set('result_path', stager.stage_path)
+    try:
+        yield (StagingLogger(stager),)
+    finally:
+        config.set('result_path', final_path)
+        stager.finish()
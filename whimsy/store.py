@@ -0,0 +1,233 @@
+'''
+Keeps the results of every run in a SQLite database given by --history-db,
+rather than only those of the last run in the result path.
+
+A :class:`StoreLogger` records the run (the git revision of the tests if
+they are in a repository, the host and how long it took) and appends the
+results of each suite as it finishes. Runs older than the last
+--history-keep are deleted as each run finishes, `history --compact` also
+reclaims their space.
+
+The `history` command queries the database for the slowest tests, the
+runtime trend of a test, and tests whose outcome recently flipped. When the
+database is given, :func:`whimsy.history.load_history` reads it so
+scheduling and timeouts use every run kept rather than only the last.
+'''
+import os
+import socket
+import sqlite3
+import subprocess
+import time
+
+from config import config
+from result import InternalLogger, TestSuiteResult
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    revision TEXT,
+    host TEXT,
+    runtime REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    uid TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    runtime REAL,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS results_uid ON results (uid, run);
+CREATE INDEX IF NOT EXISTS results_run ON results (run);
+'''
+
+# Values of the kind column.
+suite_kind = 'suite'
+testcase_kind = 'test'
+
+
+def git_revision(directory):
+    '''Return the git revision checked out in directory, None if unknown.'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                    ['git', 'rev-parse', 'HEAD'], cwd=directory,
+                    stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _reason(result):
+    reason = getattr(result, 'reason', None)
+    return None if reason is None else str(reason)
+
+
+class ResultStore(object):
+    '''
+    SQLite database of the results of many runs.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_schema)
+
+    def close(self):
+        self.connection.close()
+
+    def begin_run(self, revision=None, host=None):
+        '''Record a new run, returning its id.'''
+        with self.connection:
+            cursor = self.connection.execute(
+                    'INSERT INTO runs (started, revision, host)'
+                    ' VALUES (?, ?, ?)', (time.time(), revision, host))
+        return cursor.lastrowid
+
+    def end_run(self, run, runtime):
+        with self.connection:
+            self.connection.execute('UPDATE runs SET runtime = ?'
+                                    ' WHERE id = ?', (runtime, run))
+
+    def add_results(self, run, results):
+        '''
+        Append the given :class:`whimsy.result.TestResult` objects to the run
+        in a single transaction.
+        '''
+        rows = [(run, result.uid,
+                 suite_kind if isinstance(result, TestSuiteResult)
+                 else testcase_kind,
+                 result.outcome.name, result.runtime,
+                 _reason(result))
+                for result in results]
+        with self.connection:
+            self.connection.executemany(
+                    'INSERT INTO results (run, uid, kind, outcome, runtime,'
+                    ' reason) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def retain(self, runs):
+        '''
+        Delete all but the latest number of runs given, which must be at
+        least 1 so the run just recorded is kept.
+        '''
+        assert runs >= 1
+        with self.connection:
+            cutoff = self.connection.execute(
+                    'SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?',
+                    (runs,)).fetchone()
+            if cutoff is None:
+                return
+            self.connection.execute('DELETE FROM results WHERE run <= ?',
+                                    cutoff)
+            self.connection.execute('DELETE FROM runs WHERE id <= ?', cutoff)
+
+    def compact(self):
+        '''Reclaim the space of deleted runs.'''
+        self.connection.execute('VACUUM')
+
+    def _recent_runs(self, runs):
+        '''Return the id of the oldest of the latest number of runs given.'''
+        row = self.connection.execute(
+                'SELECT MIN(id) FROM (SELECT id FROM runs ORDER BY id DESC'
+                ' LIMIT ?)', (runs,)).fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def samples(self):
+        '''
+        Return an iterator over :code:`(uid, outcome name, runtime)` of every
+        result, oldest first.
+        '''
+        return self.connection.execute(
+                'SELECT uid, outcome, runtime FROM results ORDER BY run')
+
+    def slowest(self, count, runs, kind=testcase_kind):
+        '''
+        Return the count items with the longest mean runtime over the latest
+        number of runs given as :code:`(uid, mean, max, samples)` tuples.
+        '''
+        return self.connection.execute(
+                'SELECT uid, AVG(runtime), MAX(runtime), COUNT(*)'
+                ' FROM results WHERE kind = ? AND run >= ?'
+                ' GROUP BY uid ORDER BY AVG(runtime) DESC LIMIT ?',
+                (kind, self._recent_runs(runs), count)).fetchall()
+
+    def trend(self, uid):
+        '''
+        Return :code:`(run, started, revision, outcome, runtime)` for every
+        recorded result of the item with uid, oldest first.
+        '''
+        return self.connection.execute(
+                'SELECT runs.id, runs.started, runs.revision,'
+                ' results.outcome, results.runtime'
+                ' FROM results JOIN runs ON results.run = runs.id'
+                ' WHERE results.uid = ? ORDER BY runs.id', (uid,)).fetchall()
+
+    def flipped(self, runs, kind=testcase_kind):
+        '''
+        Return the items whose outcome changed between two of their results
+        in the latest number of runs given, as
+        :code:`(uid, run, previous outcome, outcome)` for each change.
+        '''
+        rows = self.connection.execute(
+                'SELECT uid, run, outcome FROM results'
+                ' WHERE kind = ? AND run >= ? ORDER BY uid, run',
+                (kind, self._recent_runs(runs)))
+        flips = []
+        (last_uid, last_outcome) = (None, None)
+        for (uid, run, outcome) in rows:
+            if uid == last_uid and outcome != last_outcome:
+                flips.append((uid, run, last_outcome, outcome))
+            (last_uid, last_outcome) = (uid, outcome)
+        return flips
+
+
+class StoreLogger(InternalLogger):
+    '''
+    :class:`whimsy.result.ResultLogger` which appends the results of a run
+    to a :class:`ResultStore`, a suite at a time.
+    '''
+    def __init__(self, result_store, revision=None):
+        super(StoreLogger, self).__init__(None)
+        self.store = result_store
+        self.revision = revision
+        self._run = None
+        self._pending = []
+
+    def begin_testing(self):
+        super(StoreLogger, self).begin_testing()
+        self._run = self.store.begin_run(self.revision, socket.gethostname())
+
+    def _record(self, result):
+        self._pending.append(result)
+        if isinstance(result, TestSuiteResult):
+            self.store.add_results(self._run, self._pending)
+            self._pending = []
+
+    def end_testing(self):
+        self.timer.stop()
+        if self._pending:
+            self.store.add_results(self._run, self._pending)
+            self._pending = []
+        self.store.end_run(self._run, self.timer.runtime())
+        self.store.retain(config.history_keep)
+        self.store.close()
+
+
+def open_store():
+    '''
+    Open the :class:`ResultStore` given by --history-db, None if there is
+    none.
+    '''
+    if config.history_db is None:
+        return None
+    return ResultStore(config.history_db)
+
+
+def store_loggers():
+    '''
+    Return a tuple of the result loggers which should be added to a run,
+    empty if there is no --history-db.
+    '''
+    result_store = open_store()
+    if result_store is None:
+        return ()
+    return (StoreLogger(result_store, git_revision(config.directory)),)
@@ -1,6 +1,45 @@
 from os import getcwd
 
-from _util import uid
+from _util import uid, parse_size
+
+class Resources(object):
+    '''
+    Declares the host resources a test item is expected to use. Used by the
+    :class:`whimsy.parallel.ParallelRunner` to only run as many suites at once
+    as fit on the host.
+
+    :ivar cpus: Number of cpus used.
+    :ivar memory: Bytes of memory used.
+    :ivar duration: Expected runtime in seconds, None if unknown.
+    '''
+    def __init__(self, cpus=1, memory=0, duration=None):
+        '''
+        :param memory: Either a number of bytes or a string with a K, M, G or
+            T suffix, e.g. '8G'.
+        '''
+        self.cpus = cpus
+        self.memory = parse_size(memory)
+        self.duration = duration
+
+    def combine(self, other):
+        '''
+        Return the resources needed to run items needing self and other one
+        after the other.
+        '''
+        if self.duration is None:
+            duration = other.duration
+        elif other.duration is None:
+            duration = self.duration
+        else:
+            duration = self.duration + other.duration
+        return Resources(max(self.cpus, other.cpus),
+                         max(self.memory, other.memory),
+                         duration)
+
+    def __repr__(self):
+        return 'Resources(cpus=%r, memory=%r, duration=%r)' % (
+                self.cpus, self.memory, self.duration)
+
 
 class TestSuite(object):
     '''
@@ -13,7 +52,7 @@ class TestSuite(object):
         will monkey patch this method in order to enumerate suites.
     '''
     def __init__(self, name, tests=tuple(), tags=None, fixtures=None,
-            fail_fast=True):
+            fail_fast=True, resources=None, timeout=None):
         '''
         :param name: Name of the TestSuite
 
@@ -25,9 +64,19 @@ class TestSuite(object):
 
         :param fail_fast: If True indicates the first test to fail in the test
             suite will cause the execution of the test suite to halt.
+
+        :param resources: :class:`Resources` used by the suite outside of
+            its test cases (e.g. by its fixtures). If None, assumes the
+            defaults of :class:`Resources`.
+
+        :param timeout: Seconds all tests in the suite may run for in total.
+            Tests which would run past it are stopped, remaining tests are
+            skipped. If None, only the timeouts of each test apply.
         '''
         self.testlist = TestList(tests)
         self.fail_fast = fail_fast
+        self.timeout = timeout
+        self.resources = resources if resources is not None else Resources()
 
         self._name = name
 
@@ -53,6 +102,17 @@ class TestSuite(object):
     def uid(self):
         return uid(self, TestSuite.__name__)
 
+    @property
+    def required_resources(self):
+        '''
+        Return the :class:`Resources` needed to run this suite, test cases are
+        ran one at a time so this is the most any one of them needs.
+        '''
+        resources = self.resources
+        for testcase in self:
+            resources = resources.combine(testcase.resources)
+        return resources
+
     @property
     def testcases(self):
         '''
@@ -134,12 +194,17 @@ class TestList(object):
     A TestList can be heirarchical, in which case iteration yields tests in
     in-order traversal.
     '''
-    def __init__(self, items=[], fail_fast=False):
+    def __init__(self, items=[], fail_fast=False, concurrent=False):
         '''
         :param fail_fast: If any TestCase fails in this TestList, all remaing
         tests in this collection should be skipped.
+
+        :param concurrent: If True the TestCase items directly in this
+        TestList do not depend on each other, so the runner may run them at
+        the same time. Ignored if fail_fast is set.
         '''
         self.fail_fast = fail_fast
+        self.concurrent = concurrent
         self.items = []
         if isinstance(items, TestList):
             self.append(items)
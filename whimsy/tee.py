@@ -2,11 +2,20 @@
 Contains two implementations of the classic unix tee command to tee output
 from this python process (and all of its subprocesses) into a file and keep
 directing output to stdout and stderr.
+
+Since tee redirects the file descriptors of the whole process it can only
+capture one test at a time. When tests run in threads,
+:func:`whimsy.capture.thread_capture` instead redirects the Python level
+output of a single thread into files through :class:`ThreadLocalStream`
+objects installed as sys.stdout and sys.stderr. Coroutines on
+a :class:`whimsy.eventloop.EventLoop` share their thread, so the loop switches
+the capture as it switches between them.
 '''
 import contextlib
 import os
 import subprocess
 import sys
+import threading
 import time
 from functools import partial
 from multiprocessing import Process, Pipe
@@ -175,6 +184,86 @@ def tee(*args, **kwargs):
         # Otherwise default to the slower python version.
         return python_tee(*args, **kwargs)
 
+# Dictionary mapping thread ident->dictionary of stream name->file which
+# output of the thread written to a ThreadLocalStream is redirected to.
+_redirects = {}
+_redirects_lock = threading.Lock()
+
+
+class ThreadLocalStream(object):
+    '''
+    File-like object which writes to the file the current thread has been
+    redirected to by :func:`whimsy.capture.thread_capture`, or to the
+    default stream if the thread is not being captured.
+    '''
+    def __init__(self, name, default):
+        '''
+        :param name: Name of the stream, 'stdout' or 'stderr'.
+        :param default: Stream to write to for threads not being captured.
+        '''
+        self.name = name
+        self.default = default
+
+    def target(self):
+        '''Return the stream the current thread writes to.'''
+        redirects = _redirects.get(threading.current_thread().ident)
+        if redirects is not None and self.name in redirects:
+            return redirects[self.name]
+        return self.default
+
+    def write(self, string):
+        self.target().write(string)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.default, attr)
+
+
+@contextlib.contextmanager
+def thread_streams():
+    '''
+    Context manager which installs :class:`ThreadLocalStream` objects as
+    sys.stdout and sys.stderr so threads may use
+    :func:`whimsy.capture.thread_capture`.
+
+    :returns: A tuple of the installed stdout and stderr streams.
+    '''
+    (original_stdout, original_stderr) = (sys.stdout, sys.stderr)
+    sys.stdout = ThreadLocalStream('stdout', original_stdout)
+    sys.stderr = ThreadLocalStream('stderr', original_stderr)
+    try:
+        yield (sys.stdout, sys.stderr)
+    finally:
+        (sys.stdout, sys.stderr) = (original_stdout, original_stderr)
+
+
+def current_capture():
+    '''
+    Return where the current thread is redirected to, None if it is not.
+    Used with :func:`set_capture` by :mod:`whimsy.eventloop` to switch
+    captures as it switches between tasks.
+    '''
+    return _redirects.get(threading.current_thread().ident)
+
+
+def set_capture(redirects):
+    '''
+    Redirect the current thread as given by :func:`current_capture`, or stop
+    redirecting it if redirects is None.
+    '''
+    ident = threading.current_thread().ident
+    with _redirects_lock:
+        if redirects is None:
+            _redirects.pop(ident, None)
+        else:
+            _redirects[ident] = redirects
+
+
 if __name__ == '__main__':
     with tee('test.out'):
         print 'ayyy'
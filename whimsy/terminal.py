@@ -28,6 +28,7 @@
 
 import sys
 import fcntl
+import signal
 import termios
 import struct
 
@@ -106,12 +107,50 @@ def get_termcap(use_colors = None):
     else:
         return no_termcap
 
+# Size used when we aren't attached to a terminal. (E.g. a worker started by
+# a batch system.)
+default_terminal_size = (80, 24)
+
+def query_terminal_size():
+    '''Ask the terminal for its (width, heigth).'''
+    try:
+        h, w, hp, wp = struct.unpack('HHHH',
+            fcntl.ioctl(0, termios.TIOCGWINSZ,
+            struct.pack('HHHH', 0, 0, 0, 0)))
+    except IOError:
+        return default_terminal_size
+    return w, h
+
+# Size of the terminal, only queried again when it's resized.
+_terminal_size = None
+
+def _resized(signum, frame):
+    global _terminal_size
+    _terminal_size = None
+    if callable(_previous_sigwinch):
+        _previous_sigwinch(signum, frame)
+
+_previous_sigwinch = None
+_cache_size = False
+if hasattr(signal, 'SIGWINCH'):
+    try:
+        _previous_sigwinch = signal.signal(signal.SIGWINCH, _resized)
+        # Resizing the terminal shouldn't interrupt system calls.
+        signal.siginterrupt(signal.SIGWINCH, False)
+        _cache_size = True
+    except ValueError:
+        # Not imported from the main thread, query the size every time.
+        pass
+
 def terminal_size():
     '''Return the (width, heigth) of the terminal screen.'''
-    h, w, hp, wp = struct.unpack('HHHH',
-        fcntl.ioctl(0, termios.TIOCGWINSZ,
-        struct.pack('HHHH', 0, 0, 0, 0)))
-    return w, h
+    global _terminal_size
+    size = _terminal_size
+    if size is None:
+        size = query_terminal_size()
+        if _cache_size:
+            _terminal_size = size
+    return size
 
 def separator(char=default_separator, color=None):
     '''
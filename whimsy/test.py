@@ -1,11 +1,12 @@
 from abc import ABCMeta, abstractmethod
 from os import getcwd
 
-from suite import TestList
+from suite import TestList, Resources
 from unittest import FunctionTestCase as _Ftc
 from functools import partial
 
 from _util import uid
+import eventloop
 
 def _steal_unittest_assertions(module):
     '''
@@ -29,6 +30,8 @@ class TestFailException(TestingException):
     '''Signals that a test has failed.'''
 class TestSkipException(TestingException):
     '''Signals that a test has been skipped.'''
+class TestTimeoutException(TestingException):
+    '''Signals that a test ran longer than its timeout.'''
 
 def fail(message):
     '''Cause the current test to fail with the given message.'''
@@ -52,7 +55,8 @@ class TestCase(object):
         called by subclasses in order for them to be discovered by the
         :class:`whimsy.loader.TestLoader`.
     '''
-    def __init__(self, name, tags=None, fixtures=None, path=None):
+    def __init__(self, name, tags=None, fixtures=None, path=None,
+                 resources=None, timeout=None):
         '''
         This must be called in subclasses for tests to be recognized by the
         test loader.
@@ -68,7 +72,16 @@ class TestCase(object):
 
         :param tags: Iterable containg tags that this testcase will have (in
         addition to those in the containing suite).
+
+        :param resources: :class:`whimsy.suite.Resources` this test is
+        expected to use. If None, assumes the defaults of Resources.
+
+        :param timeout: Seconds this test may run for before it is stopped
+        and fails. If None, uses the runner's timeout policy.
         '''
+        self.resources = resources if resources is not None else Resources()
+        self.timeout = timeout
+
         if fixtures is None:
             fixtures = {}
         elif not isinstance(fixtures, dict):
@@ -109,27 +122,62 @@ class TestCase(object):
         # manually remove a test.
         __no_collect__ = NotImplemented
 
+    # If True, :meth:`coroutine` returns a coroutine which runs the test on
+    # a :class:`whimsy.eventloop.EventLoop`. The runner will then wait on it
+    # rather than calling the test.
+    is_coroutine = False
+
+    def coroutine(self, fixtures):
+        '''
+        Return a coroutine which runs the test. Only used if
+        :code:`is_coroutine` is True.
+
+        By default the test is simply called, blocking the event loop until
+        it finishes. Subclasses override this to wait on the event loop.
+        '''
+        self(fixtures)
+        # Make this a generator.
+        return
+        yield
+
 class TestFunction(TestCase):
     '''
     A concrete implementation of the abc TestCase. Uses a function as
     a test.
+
+    Given :code:`coroutine=True` the function must return a coroutine, see
+    :mod:`whimsy.eventloop`. It is then ran on the event loop, concurrently
+    with other coroutine tests when using --coroutines. Without it the
+    function is called as is, even if it is a generator.
     '''
     def __init__(self, test, name=None, *args, **kwargs):
         if name is None:
             # If not given a name, take the name of the function.
             name = test.__name__
+        coroutine = kwargs.pop('coroutine', False)
         super(TestFunction, self).__init__(name, *args, **kwargs)
         self._test_function = test
+        self.is_coroutine = coroutine
+
+    def coroutine(self, fixtures):
+        return self._test_function(fixtures)
 
     def __call__(self, fixtures):
         '''
         Override TestCase definition of __call__
         '''
-        self._test_function(fixtures)
+        if self.is_coroutine:
+            eventloop.run(self.coroutine(fixtures))
+        else:
+            self._test_function(fixtures)
 
-def testfunction(function=None, name=None, tag=None, tags=None, fixtures=None):
+def testfunction(function=None, name=None, tag=None, tags=None, fixtures=None,
+                 resources=None, timeout=None, coroutine=False):
     '''
     A decorator used to wrap a function as a TestFunction.
+
+    :param coroutine: If True the function is a coroutine, see
+        :class:`TestFunction`.
     '''
     # If tag was given, then the test will be marked with that single tag.
     # elif tags was given, then the test will be marked with all those tags.
@@ -140,7 +188,9 @@ def testfunction(function=None, name=None, tag=None, tags=None, fixtures=None):
 
     def testfunctiondecorator(function):
         '''Decorator used to mark a function as a test case.'''
-        TestFunction(function, name=name, tags=tags, fixtures=fixtures)
+        TestFunction(function, name=name, tags=tags, fixtures=fixtures,
+                     resources=resources, timeout=timeout,
+                     coroutine=coroutine)
         return function
     if function is not None:
         return testfunctiondecorator(function)
@@ -0,0 +1,205 @@
+'''
+Enforces timeouts on running tests.
+
+A :class:`Watchdog` is armed around each test by the
+:class:`whimsy.runner.Runner`. If the test is still running once its timeout
+expires the watchdog:
+
+1. Records the Python stack of the thread running the test, so the reason
+   for the timeout can be seen in the test's result.
+2. Kills the process group of each subprocess the test started with
+   :func:`whimsy.helper.log_call`, since a hung subprocess (e.g. a gem5
+   simulation) is the usual cause.
+3. Raises a :class:`whimsy.test.TestTimeoutException` in the thread running
+   the test to stop any Python code which is stuck.
+
+Coroutine tests are instead waited on with :func:`whimsy.eventloop.wait_for`,
+which cancels the test and kills its subprocesses without a watchdog.
+
+Timeouts for each test are chosen by a :class:`TimeoutPolicy`.
+'''
+import ctypes
+import os
+import signal
+import sys
+import threading
+import traceback
+
+from config import config
+from helper import running_processes
+from logger import log
+from test import TestTimeoutException
+
+# Seconds to wait after asking subprocesses to terminate before killing them.
+kill_grace_period = 5
+
+# Smallest timeout which will be derived from the history of a test, very
+# short tests would otherwise time out due to noise.
+min_derived_timeout = 10
+
+
+def _kill_processes(ident):
+    '''
+    Terminate the process groups of processes started by the thread with the
+    given ident, killing them if they are still running after
+    :data:`kill_grace_period` seconds.
+    '''
+    processes = running_processes(ident)
+    if not processes:
+        return
+
+    def signal_all(signum):
+        for process in processes:
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signum)
+                except OSError:
+                    pass
+
+    signal_all(signal.SIGTERM)
+    timer = threading.Timer(kill_grace_period, signal_all,
+                            args=(signal.SIGKILL,))
+    timer.setDaemon(True)
+    timer.start()
+
+
+def _raise_in_thread(ident, exception_type):
+    '''
+    Raise exception_type in the thread with the given ident the next time it
+    executes Python code. If exception_type is None, clear a pending
+    exception instead.
+    '''
+    exception = ctypes.py_object(exception_type) \
+            if exception_type is not None else None
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident),
+                                               exception)
+
+
+class Watchdog(object):
+    '''
+    Context manager which stops the code ran within it once the timeout
+    expires. Must be entered in the thread running the test.
+
+    :var expired: True if the timeout expired.
+    :var stack: The formatted stack of the test when the timeout expired.
+    '''
+    def __init__(self, timeout, name=None):
+        '''
+        :param timeout: Seconds to wait, if None the watchdog is never
+            triggered.
+
+        :param name: Name of the item being watched, used in log messages.
+        '''
+        self.timeout = timeout
+        self.name = name
+        self.expired = False
+        self.stack = None
+        self._ident = None
+        self._timer = None
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._ident = threading.current_thread().ident
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.setDaemon(True)
+            self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        with self._lock:
+            self._finished = True
+            if self.expired:
+                # The exception is only delivered once the thread checks
+                # for it, it may still be pending if the test finished or
+                # raised something else (e.g. since its subprocess was
+                # killed). Don't let it escape from the watched block.
+                _raise_in_thread(self._ident, None)
+        if self._timer is not None:
+            self._timer.cancel()
+        return False
+
+    def _expire(self):
+        with self._lock:
+            if self._finished:
+                return
+            self.expired = True
+            frame = sys._current_frames().get(self._ident)
+            if frame is not None:
+                self.stack = ''.join(traceback.format_stack(frame))
+            log.warn('%s timed out after %.2f seconds.'
+                     % (self.name or 'Test', self.timeout))
+            if self.stack:
+                log.warn('Stack at the time of the timeout:\n%s'
+                         % self.stack)
+            _kill_processes(self._ident)
+            _raise_in_thread(self._ident, TestTimeoutException)
+
+    @property
+    def reason(self):
+        '''Return a description of the timeout to use as a test's reason.'''
+        return timeout_reason(self.timeout, self.stack)
+
+
+def timeout_reason(timeout, stack=None):
+    '''
+    Return a description of a timeout to use as a test's reason.
+
+    :param stack: Formatted stack of the test when it timed out.
+    '''
+    reason = 'Timed out after %.2f seconds.' % timeout
+    if stack:
+        reason += '\nStack at the time of the timeout:\n%s' % stack
+    return reason
+
+
+class TimeoutPolicy(object):
+    '''
+    Chooses the timeout of each test.
+
+    In order of priority a test will use:
+
+    1. The timeout given to the test itself.
+    2. A timeout derived from its previous runtimes, if a history and
+       percentile were given. This is the runtime at the percentile times the
+       multiplier.
+    3. The default timeout.
+    '''
+    def __init__(self, default=None, history=None, percentile=None,
+                 multiplier=3.0):
+        '''
+        :param default: Default timeout in seconds, None for no timeout.
+
+        :param history: :class:`whimsy.history.ResultHistory` to derive
+            timeouts from.
+
+        :param percentile: Percentile of previous runtimes to use, e.g. 95.
+        '''
+        self.default = default
+        self.history = history
+        self.percentile = percentile
+        self.multiplier = multiplier
+
+    @classmethod
+    def from_config(cls, history=None):
+        '''
+        Create a policy using the config's timeout settings.
+
+        :param history: History to derive timeouts from if the config
+            requests it.
+        '''
+        return cls(config.timeout,
+                   history=history,
+                   percentile=config.timeout_percentile,
+                   multiplier=config.timeout_multiplier)
+
+    def timeout(self, testobj):
+        '''Return the timeout for the given test in seconds or None.'''
+        if testobj.timeout is not None:
+            return testobj.timeout
+        if self.history is not None and self.percentile is not None:
+            runtime = self.history.percentile(testobj.uid, self.percentile)
+            if runtime is not None:
+                return max(runtime * self.multiplier, min_derived_timeout)
+        return self.default